@@ -1,27 +1,53 @@
 from powermatcher import BaseAgent, Bid
 from decimal import Decimal
 from enum import Enum
-from ext import environment
-import random
+import datetime
 import logging
 import math
-import influx
 import settings
 
 logger = logging.getLogger(settings.app_name + '.' + __name__)
 
+def sun_factor(time):
+    # Fraction of peak power of PV panels at the time of day, zero at night (18:00 - 6:00)
+    day_period = (time - time.replace(hour=0, minute=0, second=0, microsecond=0)).total_seconds() * 2 * math.pi / (3600*24)
+    return max(math.sin(day_period - math.pi/2), 0)
+
+def next_sunrise(time):
+    # First time after a time without sun at which sun_factor may be above zero again
+    sunrise = time.replace(hour=6, minute=0, second=0, microsecond=0)
+    if time.hour >= 12:
+        sunrise += datetime.timedelta(days=1)
+    return sunrise
+
+def _open_profile(profile):
+    # Reader of a profile file, None without one
+    if not profile:
+        return None
+    from profiles import open_profile # Imported here, profiles needs numpy which agents without profiles don't
+    return open_profile(profile)
+
 class LoadAgent(BaseAgent):
 
-    def __init__(self, auctioneer, id=None, load=Decimal(1000), noise_factor=Decimal(0.1)):
+    def __init__(self, auctioneer, id=None, load=Decimal(1000), noise_factor=Decimal(0.1), profile=None, site=None):
+
+        self.load = auctioneer.numeric.quantity(load)
+        self.noise_factor = auctioneer.numeric.ratio(noise_factor)
 
-        self.load = load
-        self.noise_factor = noise_factor
+        # Measured load (watt) of a site in a profile file instead of the constant load
+        self.profile = _open_profile(profile)
+        self.site_index = self.profile.profile.index(site) if profile else None
 
         super(LoadAgent, self).__init__(auctioneer, id=id)
 
     def handle_state_update(self):
 
-        new_power = self.load * (1 + self.noise_factor * Decimal(random.random()))
+        if self.profile:
+            environment = self.context.environment
+            self.load = self.numeric.quantity_from_float(
+                self.profile.value(self.site_index, environment.current_time, environment.simulation_interval))
+
+        new_power = self.numeric.scale(self.load, 1 + self.noise_factor * self.numeric.ratio(self.random.random()))
         bid = Bid(self.auctioneer, new_power)
         self.do_bid_update(bid)
 
@@ -35,20 +61,24 @@ class ImbalanceAgent(BaseAgent):
                  production_price=None, consumption_price=None,
                  production_power=Decimal(5000), consumption_power=Decimal(5000)):
 
-        if not consumption_price:
+        n = auctioneer.numeric
+
+        if consumption_price:
+            self.consumption_price = n.price(consumption_price)
+        else:
             # Set at 10% of price range from auctioneer
-            consumption_price = auctioneer.min_price + Decimal(0.1) * (auctioneer.max_price - auctioneer.min_price)
-        if not production_price:
+            self.consumption_price = auctioneer.min_price + n.scale(auctioneer.max_price - auctioneer.min_price, n.ratio(0.1))
+        if production_price:
+            self.production_price = n.price(production_price)
+        else:
             # Set at 90% of price range from auctioneer
-            production_price = auctioneer.min_price + Decimal(0.9) * (auctioneer.max_price - auctioneer.min_price)
+            self.production_price = auctioneer.min_price + n.scale(auctioneer.max_price - auctioneer.min_price, n.ratio(0.9))
 
-        self.production_price = production_price
-        self.consumption_price = consumption_price
-        self.production_power = production_power
-        self.consumption_power = consumption_power
+        self.production_power = n.quantity(production_power)
+        self.consumption_power = n.quantity(consumption_power)
 
         # Only needs initial bid, is not going to change
-        q = (self.consumption_power, Decimal(0), -self.production_power)
+        q = (self.consumption_power, n.zero, -self.production_power)
         p = (self.consumption_price, self.production_price)
         bid = Bid(auctioneer, q, p)
 
@@ -58,29 +88,57 @@ class ImbalanceAgent(BaseAgent):
         # Technically not necessary to call do_runlevel_update, since state update will not lead to new power
         self.do_runlevel_update()
 
+    def next_update_time(self):
+        # Bid never changes, the runlevel follows price updates
+        return None
+
 
 class PVAgent(BaseAgent):
 
-    def __init__(self, auctioneer, id=None, peak_power = Decimal(3000), noise_factor = Decimal(.1)):
+    def __init__(self, auctioneer, id=None, peak_power = Decimal(3000), noise_factor = Decimal(.1), profile=None, site=None):
         # self._current_power = Decimal(0)
-        self.peak_power = peak_power
-        self.noise_factor = noise_factor
+        self.peak_power = auctioneer.numeric.quantity(peak_power)
+        self.noise_factor = auctioneer.numeric.ratio(noise_factor)
+
+        # Measured production (positive watt) of a site in a profile file instead of the sun curve
+        self.profile = _open_profile(profile)
+        self.site_index = self.profile.profile.index(site) if profile else None
 
         super(PVAgent, self).__init__(auctioneer, id=id)
 
     def handle_state_update(self):
         # Calculate new bidding ladder
-        # Period of day (range 0 - 2*pi)
-        day_period = (environment.current_time - environment.current_time.replace(hour=0, minute=0, second=0, microsecond=0)).total_seconds()\
-                     * 2 * math.pi / (3600*24)
-        new_power = - self.peak_power * Decimal(max(math.sin(day_period - math.pi/2), 0)) * \
-                           (1 + self.noise_factor * Decimal(random.random()))
+        n = self.numeric
+        environment = self.context.environment
+
+        if self.profile:
+            production = self.profile.value(self.site_index, environment.current_time, environment.simulation_interval)
+            new_power = - n.scale(n.quantity_from_float(production), 1 + self.noise_factor * n.ratio(self.random.random()))
+            self.do_bid_update(Bid(self.auctioneer, new_power))
+            self.do_runlevel_update()
+            return
+
+        factor = sun_factor(environment.current_time)
+
+        if factor > 0:
+            # Multiplied in the order peak power, factor, noise: each Decimal product is rounded, so another order
+            # changes the last digits
+            new_power = - n.scale(n.scale(self.peak_power, n.ratio(factor)), 1 + self.noise_factor * n.ratio(self.random.random()))
+        else:
+            new_power = n.zero
 
         bid = Bid(self.auctioneer, new_power)
         self.do_bid_update(bid)
 
         self.do_runlevel_update()
 
+    def next_update_time(self):
+        # No production at night, nothing changes until sunrise. Measured production may change every tick
+        time = self.context.environment.current_time
+        if self.profile or sun_factor(time) > 0:
+            return super(PVAgent, self).next_update_time()
+        return next_sunrise(time)
+
 
 class ChargeState(Enum):
     IDLE, CHARGING, DISCHARGING = range(3)
@@ -88,6 +146,15 @@ class ChargeState(Enum):
 
 class BatteryAgent(BaseAgent):
 
+    # Bid at an empty or full battery depends on the price
+    price_responsive = True
+
+    # Keeps track of its charge state on every price change
+    price_subscriber = True
+
+    # An idle battery keeps its state of charge until a price change sets it to work
+    wake_on_price_change = True
+
     def __init__(self, auctioneer, id=None, soc=0.5, capacity=10,
                  max_charge_power = Decimal(4000), max_discharge_power = Decimal(3000),
                  bidding_ladder_steps = 10):
@@ -95,13 +162,13 @@ class BatteryAgent(BaseAgent):
         self._soc = None
         self.capacity = capacity # in kWh
         self.charge_state = ChargeState.IDLE
-        self.max_charge_power = max_charge_power
-        self.max_discharge_power = max_discharge_power
+        self.max_charge_power = auctioneer.numeric.quantity(max_charge_power)
+        self.max_discharge_power = auctioneer.numeric.quantity(max_discharge_power)
         self.bidding_ladder_steps = bidding_ladder_steps
 
         super(BatteryAgent, self).__init__(auctioneer, id=id)
 
-        self.current_power = Decimal(0)
+        self.current_power = self.numeric.zero
         self.soc = soc
 
     @property
@@ -119,33 +186,40 @@ class BatteryAgent(BaseAgent):
 
             self._soc = soc
 
-            # Write to influx
-            points = [
-                {
-                    "measurement": "deviceagent_soc",
-                    "tags": {
-                        "agent_id": self.id,
-                        "auctioneer_id": self.auctioneer.id
-                    },
-                    "fields": {
-                        'power': float(soc)
-                    },
-                    "time": environment.current_time
-                }
-            ]
-            influx.write_points(points, settings.influxdb_database)
+            # Write telemetry
+            self.context.write_point("deviceagent_soc", {"agent_id": self.id, "auctioneer_id": self.auctioneer.id},
+                                     {'power': float(soc)})
 
     def handle_state_update(self):
         # Update state of charge depending on what happened
         capacity_in_joules = self.capacity * 3600 * 1000
-        self.soc += float(self.current_power) * environment.simulation_interval.total_seconds() / capacity_in_joules
+        self.soc += self.numeric.quantity_to_float(self.current_power) * self.context.environment.simulation_interval.total_seconds() / capacity_in_joules
 
         bid = self.calculate_bid()
         self.do_bid_update(bid)
-        logger.debug("Updated BatteryAgent with SOC: {}, Bid: {}".format(self.soc, bid))
+        logger.debug("Updated BatteryAgent with SOC: %s, Bid: %s", self.soc, bid)
 
         self.do_runlevel_update()
 
+    def next_update_time(self):
+        if self.current_power == 0:
+            return None
+        return super(BatteryAgent, self).next_update_time()
+
+    def get_state(self):
+        state = super(BatteryAgent, self).get_state()
+        state['soc'] = self._soc
+        state['charge_state'] = self.charge_state.value
+        return state
+
+    def set_state(self, state):
+        super(BatteryAgent, self).set_state(state)
+        self._soc = state['soc']
+        self.charge_state = ChargeState(state['charge_state'])
+
+    def handle_rebid(self):
+        self.do_bid_update(self.calculate_bid())
+
     def do_runlevel_update(self):
         """ Called whenever the runlevel might need changing, which is though handle_state_update, or handle_price_update """
 
@@ -164,33 +238,42 @@ class BatteryAgent(BaseAgent):
         # - for soc=1, bid should be always discharge (unless price = min_price)
         # - for soc=0.5, bid should be from min_price until max_price
 
+        n = self.numeric
+        price_range = self.auctioneer.max_price - self.auctioneer.min_price
+
         if self.soc <= 0:
             # Always charge
             if self.auctioneer.price == self.auctioneer.max_price:
                 # Unless price is maximum, then go idle
-                return Bid(self.auctioneer, Decimal(0))
+                return Bid(self.auctioneer, n.zero)
             else:
                 return Bid(self.auctioneer, self.max_charge_power)
         elif self.soc >= 1:
             # Always discharge
             if self.auctioneer.price == self.auctioneer.min_price:
                 # Unless price is minimum, then go idle
-                return Bid(self.auctioneer, Decimal(0))
+                return Bid(self.auctioneer, n.zero)
             else:
                 return Bid(self.auctioneer, -self.max_discharge_power)
         elif self.soc <= 0.5:
             # Bid leans towards charging
-            min_price = self.auctioneer.max_price - (self.auctioneer.max_price - self.auctioneer.min_price) * Decimal(self.soc/.5)
+            min_price = self.auctioneer.max_price - n.scale(price_range, n.ratio(self.soc/.5))
             max_price = self.auctioneer.max_price
         elif self.soc < 1:
             # Bid leans towards discharging
             min_price = self.auctioneer.min_price
-            max_price = self.auctioneer.min_price + (self.auctioneer.max_price - self.auctioneer.min_price) * Decimal(2 * (1 - self.soc))
+            max_price = self.auctioneer.min_price + n.scale(price_range, n.ratio(2 * (1 - self.soc)))
 
-        charge_step = (self.max_charge_power+self.max_discharge_power) / (self.bidding_ladder_steps + 1)
-        quantities = tuple(self.max_charge_power - n * charge_step for n in range(self.bidding_ladder_steps+1))
+        charge_step = n.divide(self.max_charge_power+self.max_discharge_power, self.bidding_ladder_steps + 1)
+        quantities = tuple(self.max_charge_power - i * charge_step for i in range(self.bidding_ladder_steps+1))
 
-        price_step = (max_price - min_price) / (self.bidding_ladder_steps + 1)
-        prices = tuple(min_price + n * price_step for n in range(1, self.bidding_ladder_steps+1))
+        price_step = n.divide(max_price - min_price, self.bidding_ladder_steps + 1)
+        prices = tuple(min_price + i * price_step for i in range(1, self.bidding_ladder_steps+1))
+
+        if prices[0] <= self.auctioneer.min_price:
+            # Ladder is narrower than the price resolution (fixed point backend), which is the same as a full battery
+            if self.auctioneer.price == self.auctioneer.min_price:
+                return Bid(self.auctioneer, n.zero)
+            return Bid(self.auctioneer, -self.max_discharge_power)
 
         return Bid(self.auctioneer, quantities, prices)
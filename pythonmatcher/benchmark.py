@@ -0,0 +1,440 @@
+# Benchmarks of the simulation, run with telemetry recorded in memory (no InfluxDB needed)
+#
+# The suite covers the main costs: bid operations over ladder sizes and end-to-end runs over numbers of agents, with
+# telemetry discarded. Its results can be saved as a JSON baseline; a later run against the baseline fails (exit code 1)
+# when a result is more than the threshold worse.
+#
+# Usage: python benchmark.py suite --save --baseline baseline.json
+#        python benchmark.py suite --baseline baseline.json --threshold 0.25
+#        python benchmark.py sharding --agents 2000 --processes 1 2 4 8 16 --hours 6
+#        python benchmark.py fleets --homes 10000 --hours 24
+#        python benchmark.py events --agents 1000 --days 365
+#        python benchmark.py horizon --agents 1000 --intervals 96
+#        python benchmark.py realtime --clients 5000 --seconds 30 --window 0.05
+#        python benchmark.py startup --repeat 10
+
+import ext
+import influx
+import argparse
+import asyncio
+import datetime
+import json
+import numpy as np
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import timeit
+import tracemalloc
+from agents import PVAgent, BatteryAgent, LoadAgent, ImbalanceAgent
+from decimal import Decimal
+from fleets import BatteryFleet, LoadFleet, PVFleet
+from marketbasis import HorizonBid
+from powermatcher import Auctioneer, BaseAgent, Bid
+from recorder import ColumnarRecorder
+from scheduler import run_event_driven
+
+def create_scenario(agents, seed=0, hours=6, batch_clearing=True, agent_types=(LoadAgent, PVAgent, BatteryAgent, ImbalanceAgent)):
+    # Auctioneer with a mix of agent types on the shared environment, agents are divided equally over the types
+    random.seed(seed)
+
+    environment = ext.environment
+    environment.auctioneers = []
+    environment.start_time = datetime.datetime(2017, 6, 1)
+    environment.current_time = environment.start_time
+    environment.stop_time = environment.start_time + datetime.timedelta(hours=hours)
+
+    auctioneer = Auctioneer(id='Benchmark', batch_clearing=batch_clearing)
+    for n in range(agents):
+        agent_types[n % len(agent_types)](auctioneer, id='{}-{}'.format(agent_types[n % len(agent_types)].__name__, n))
+
+    environment.register_auctioneer(auctioneer)
+    return environment, auctioneer
+
+
+def run_scenario(agents, processes, seed=0, hours=6):
+    # Returns the duration, the recorded prices and the final state of the agents
+    environment, auctioneer = create_scenario(agents, seed=seed, hours=hours)
+    recorder = ColumnarRecorder()
+    influx.set_sink(recorder)
+
+    environment.processes = processes
+    start = time.perf_counter()
+    environment.start()
+    duration = time.perf_counter() - start
+
+    influx.set_sink(None)
+    prices = recorder.get('auctioneer_prices', auctioneer_id=auctioneer.id)
+    states = [agent.get_state() for agent in auctioneer.agents]
+    return duration, prices, states
+
+
+def random_bid(auctioneer, size, rng):
+    # Bid with a ladder of size prices
+    n = auctioneer.numeric
+    prices = sorted(n.price(Decimal(rng.randint(1, 100000)) / 100) for _ in range(size))
+    quantities = sorted((n.quantity(Decimal(rng.randint(-5000000, 5000000)) / 1000) for _ in range(size + 1)), reverse=True)
+    return Bid(auctioneer, tuple(quantities), tuple(prices))
+
+
+def time_call(function, repeat=5):
+    # Duration of a call in seconds, the best of repeat runs of calls adding up to at least 0.2 seconds
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def run_micro_benchmarks(ladder_sizes, seed=0):
+    # Microseconds per operation on bids with ladders of the given sizes
+    rng = random.Random(seed)
+    auctioneer = Auctioneer(id='Benchmark')
+    results = {}
+
+    for size in ladder_sizes:
+        bid, other_bid = random_bid(auctioneer, size, rng), random_bid(auctioneer, size, rng)
+        price = auctioneer.numeric.price(Decimal(500))
+
+        results['bid_add.{}.us'.format(size)] = time_call(lambda: bid + other_bid) * 1e6
+        # On a new bid every call, the equilibrium price of a bid is memoized
+        results['equilibrium_price.{}.us'.format(size)] = time_call(
+            lambda: Bid._create(auctioneer, bid.quantities, bid.prices).equilibrium_price()) * 1e6
+        results['find_quantity.{}.us'.format(size)] = time_call(lambda: bid.find_quantity(price)) * 1e6
+
+    return results
+
+
+def run_scenario_benchmark(agents, ticks, seed=0):
+    # Ticks per second, mean clearing latency in milliseconds and peak memory per agent of a scenario run
+    influx.set_sink(influx.TelemetrySink()) # Telemetry disabled
+    results = {}
+
+    try:
+        # Memory of creating the agents and their first tick, measured separately since tracing slows down the run
+        tracemalloc.start()
+        environment, auctioneer = create_scenario(agents, seed=seed, hours=0)
+        environment.start()
+        results['scenario.{}.bytes_per_agent'.format(agents)] = tracemalloc.get_traced_memory()[1] / agents
+        tracemalloc.stop()
+
+        environment, auctioneer = create_scenario(agents, seed=seed, hours=0)
+        environment.stop_time = environment.start_time + (ticks - 1) * environment.simulation_interval
+
+        # Clearing happens at the end of every tick (batched clearing)
+        clearing_durations = []
+        end_tick = auctioneer.end_tick
+        def timed_end_tick():
+            start = time.perf_counter()
+            end_tick()
+            clearing_durations.append(time.perf_counter() - start)
+        auctioneer.end_tick = timed_end_tick
+
+        start = time.perf_counter()
+        environment.start()
+        duration = time.perf_counter() - start
+    finally:
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        influx.set_sink(None)
+
+    results['scenario.{}.ticks_per_second'.format(agents)] = ticks / duration
+    results['scenario.{}.clearing.ms'.format(agents)] = sum(clearing_durations) / len(clearing_durations) * 1000
+    return results
+
+
+def higher_is_better(name):
+    return name.endswith('per_second')
+
+
+def find_regressions(baseline, results, threshold):
+    # Results that are more than threshold (fraction) worse than the baseline, as (name, baseline, result)
+    regressions = []
+    for name, value in sorted(results.items()):
+        if name not in baseline:
+            continue
+        if higher_is_better(name):
+            worse = value < baseline[name] / (1 + threshold)
+        else:
+            worse = value > baseline[name] * (1 + threshold)
+        if worse:
+            regressions.append((name, baseline[name], value))
+    return regressions
+
+
+def benchmark_suite(ladder_sizes, agents, ticks, seed=0, baseline=None, save=False, threshold=0.25):
+    # Returns False when a result regressed against the baseline
+    results = run_micro_benchmarks(ladder_sizes, seed=seed)
+    for n in agents:
+        results.update(run_scenario_benchmark(n, ticks, seed=seed))
+
+    baseline_results = {}
+    if baseline and not save:
+        with open(baseline) as f:
+            baseline_results = json.load(f)['results']
+
+    print("{:>40} {:>14} {:>14} {:>8}".format('benchmark', 'result', 'baseline', 'change'))
+    for name, value in sorted(results.items()):
+        if name in baseline_results:
+            print("{:>40} {:>14.2f} {:>14.2f} {:>+7.0%}".format(name, value, baseline_results[name], value / baseline_results[name] - 1))
+        else:
+            print("{:>40} {:>14.2f}".format(name, value))
+
+    if save:
+        with open(baseline, 'w') as f:
+            json.dump({'python': platform.python_version(), 'date': datetime.datetime.now().isoformat(), 'results': results}, f,
+                      indent=2, sort_keys=True)
+        print("Saved baseline to {}".format(baseline))
+        return True
+
+    regressions = find_regressions(baseline_results, results, threshold)
+    for name, base, value in regressions:
+        print("Regression of {}: {:.2f} against baseline {:.2f}".format(name, value, base))
+    return not regressions
+
+
+def benchmark_sharding(agents, processes, seed=0, hours=6):
+    duration, prices, states = run_scenario(agents, None, seed=seed, hours=hours)
+    ticks = int(hours * 60) + 1
+    print("{:>10} {:>10} {:>10} {:>10} {:>8}".format('processes', 'seconds', 'ticks/s', 'speedup', 'equal'))
+    print("{:>10} {:>10.2f} {:>10.1f} {:>10.2f} {:>8}".format(1, duration, ticks / duration, 1, 'yes'))
+
+    for n in processes:
+        sharded_duration, sharded_prices, sharded_states = run_scenario(agents, n, seed=seed, hours=hours)
+        equal = (sharded_states == states and all((sharded_prices[k] == prices[k]).all() for k in prices))
+        print("{:>10} {:>10.2f} {:>10.1f} {:>10.2f} {:>8}".format(n, sharded_duration, ticks / sharded_duration,
+                                                                    duration / sharded_duration, 'yes' if equal else 'NO'))
+
+
+def benchmark_fleets(homes, seed=0, hours=24):
+    # Neighbourhood of homes with a load, PV panels and a battery each, simulated as three fleets
+    environment, auctioneer = create_scenario(0, seed=seed, hours=hours)
+    rng = np.random.default_rng(seed)
+    LoadFleet(auctioneer, rng.uniform(200, 1000, homes))
+    PVFleet(auctioneer, rng.uniform(1000, 4000, homes))
+    BatteryFleet(auctioneer, rng.uniform(5, 15, homes), socs=rng.uniform(0, 1, homes))
+
+    influx.set_sink(ColumnarRecorder())
+    start = time.perf_counter()
+    environment.start()
+    duration = time.perf_counter() - start
+    influx.set_sink(None)
+
+    ticks = int(hours * 60) + 1
+    print("{} homes, {} ticks in {:.2f} seconds ({:.1f} ticks/s)".format(homes, ticks, duration, ticks / duration))
+
+
+def benchmark_events(agents, seed=0, days=365, compare=False):
+    # Quiet scenario of PV panels and imbalance agents, run event driven (and every tick with compare)
+    ticks = int(days * 24 * 60) + 1
+    print("{:>12} {:>10} {:>14} {:>10}".format('mode', 'seconds', 'agent updates', 'ticks/s'))
+
+    modes = ('event driven', 'every tick') if compare else ('event driven',)
+    for mode in modes:
+        environment, auctioneer = create_scenario(agents, seed=seed, hours=days * 24, agent_types=(PVAgent, ImbalanceAgent))
+        influx.set_sink(ColumnarRecorder())
+        start = time.perf_counter()
+        if mode == 'event driven':
+            updates = run_event_driven(environment)
+        else:
+            environment.start()
+            updates = ticks * agents
+        duration = time.perf_counter() - start
+        influx.set_sink(None)
+
+        print("{:>12} {:>10.2f} {:>14} {:>10.0f}".format(mode, duration, updates, ticks / duration))
+
+
+def benchmark_horizon(agents, intervals=96, ladder_size=10, seed=0):
+    # Day ahead: all intervals cleared at once against clearing interval by interval, with the same random bids
+    rng = random.Random(seed)
+    auctioneer = Auctioneer(id='Horizon', price_steps=100, batch_clearing=True)
+    planners = [BaseAgent(auctioneer) for _ in range(agents)]
+    bids = {agent: [random_bid(auctioneer, rng.randint(1, ladder_size), rng) for _ in range(intervals)] for agent in planners}
+    print("{:>16} {:>10} {:>12}".format('mode', 'seconds', 'intervals/s'))
+
+    start = time.perf_counter()
+    horizon_bids = {agent: HorizonBid.from_bids(auctioneer.market_basis, agent_bids) for agent, agent_bids in bids.items()}
+    conversion = time.perf_counter() - start
+
+    duration = time_call(lambda: auctioneer.clear_horizon(horizon_bids))
+    prices, _ = auctioneer.clear_horizon(horizon_bids)
+    print("{:>16} {:>10.4f} {:>12.0f}".format('horizon', duration, intervals / duration))
+    print("{:>16} {:>10.4f} {:>12.0f}".format('horizon of Bids', duration + conversion, intervals / (duration + conversion)))
+
+    influx.set_sink(ColumnarRecorder())
+    start = time.perf_counter()
+    for interval in range(intervals):
+        for agent in planners:
+            agent.do_bid_update(bids[agent][interval])
+        auctioneer.end_tick()
+        assert auctioneer.price == prices[interval]
+    duration = time.perf_counter() - start
+    influx.set_sink(None)
+    print("{:>16} {:>10.4f} {:>12.0f}".format('every interval', duration, intervals / duration))
+
+
+async def run_load_client(session, rng, bid_interval, read_delay, stop):
+    # Simulated agent: bids a random load or a three step ladder every bid_interval seconds (on average) and reads the
+    # prices pushed to it, after read_delay seconds for slow clients
+    n = session.market.auctioneer.numeric
+
+    async def bid():
+        while True:
+            await asyncio.sleep(min(rng.expovariate(1 / bid_interval), stop - time.perf_counter()))
+            if time.perf_counter() >= stop:
+                break
+            if rng.random() < 0.5:
+                session.submit_bid(n.quantity(Decimal(rng.randint(-3000, 3000))))
+            else:
+                prices = sorted(n.price(Decimal(rng.randint(1, 1000))) for _ in range(3))
+                quantities = sorted((n.quantity(Decimal(rng.randint(-3000, 3000))) for _ in range(4)), reverse=True)
+                session.submit_bid(quantities, prices)
+
+    async def receive():
+        while time.perf_counter() < stop:
+            await session.receive()
+            if read_delay:
+                await asyncio.sleep(read_delay)
+
+    receiver = asyncio.ensure_future(receive())
+    await bid()
+    receiver.cancel()
+
+
+async def load_test(clients, seconds, bid_interval, slow, read_delay, clearing_window, seed):
+    from realtime import RealtimeAuctioneer # Imported here, realtime needs autobahn which the other benchmarks don't
+
+    random.seed(seed)
+    ext.environment.current_time = datetime.datetime.now()
+    market = RealtimeAuctioneer(Auctioneer(id='LoadTest'), clearing_window=clearing_window)
+    sessions = [market.connect() for _ in range(clients)]
+
+    start = time.perf_counter()
+    await asyncio.gather(*(run_load_client(session, random.Random(random.getrandbits(64)), bid_interval,
+                                           read_delay if c_i < slow * clients else 0, start + seconds)
+                           for c_i, session in enumerate(sessions)))
+    duration = time.perf_counter() - start
+
+    for session in sessions:
+        session.close()
+    return market, duration
+
+
+def benchmark_realtime(clients, seconds=10, bid_interval=1, slow=0, read_delay=1, clearing_window=None, seed=0):
+    # Many in-process clients bidding on a real-time auctioneer, a fraction slow of them reads prices late
+    influx.set_sink(influx.TelemetrySink())
+    market, duration = asyncio.run(load_test(clients, seconds, bid_interval, slow, read_delay, clearing_window, seed))
+    influx.set_sink(None)
+
+    latencies = np.array(market.clearing_latencies) * 1000
+    durations = np.array(market.clearing_durations) * 1000
+    print("{} clients, {} clearings in {:.1f} seconds".format(clients, len(latencies), duration))
+    print("{:>24} {:>8} {:>8} {:>8} {:>8}".format('milliseconds', 'p50', 'p90', 'p99', 'max'))
+    for name, values in (('clearing latency', latencies), ('clearing duration', durations)):
+        if len(values):
+            print("{:>24} {:>8.2f} {:>8.2f} {:>8.2f} {:>8.2f}".format(name, *np.percentile(values, [50, 90, 99, 100])))
+    print("bids received {:.0f}/s, messages sent {:.0f}/s".format(market.messages_received / duration, market.messages_sent / duration))
+
+
+# Worker started by benchmark_startup: imports the simulation and runs an hour of a small market in its own context
+STARTUP_WORKER = '''
+import datetime
+from agents import BatteryAgent, LoadAgent
+from powermatcher import Auctioneer
+from recorder import ColumnarRecorder
+from runtime import Context
+context = Context(sink=ColumnarRecorder())
+environment = context.environment
+environment.current_time = environment.start_time = datetime.datetime(2017, 6, 1)
+environment.stop_time = environment.start_time + datetime.timedelta(hours=1)
+auctioneer = Auctioneer(id='Worker', context=context)
+for n in range(10):
+    (LoadAgent, BatteryAgent)[n % 2](auctioneer)
+environment.register_auctioneer(auctioneer)
+environment.start()
+'''
+
+def benchmark_startup(repeat=5):
+    # Fresh interpreters: importing the simulation modules and starting a worker that runs a small simulation
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)), INFLUXDB_ENABLED='false')
+    print("{:>24} {:>10} {:>10}".format('milliseconds', 'min', 'median'))
+    for name, code in (('interpreter', 'pass'), ('import agents', 'import agents'),
+                       ('import powermatcher', 'import powermatcher'), ('worker', STARTUP_WORKER)):
+        durations = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, '-c', code], check=True, env=env)
+            durations.append((time.perf_counter() - start) * 1000)
+        print("{:>24} {:>10.1f} {:>10.1f}".format(name, min(durations), sorted(durations)[len(durations) // 2]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks of pythonmatcher")
+    subparsers = parser.add_subparsers(dest='benchmark')
+
+    suite = subparsers.add_parser('suite', help="Bid microbenchmarks and scenarios, compared with a baseline")
+    suite.add_argument('--ladder-sizes', type=int, nargs='+', default=[1, 10, 100, 1000])
+    suite.add_argument('--agents', type=int, nargs='+', default=[10, 100, 1000, 10000, 100000])
+    suite.add_argument('--ticks', type=int, default=10)
+    suite.add_argument('--baseline', help="JSON file with baseline results")
+    suite.add_argument('--save', action='store_true', help="Save the results as baseline instead of comparing")
+    suite.add_argument('--threshold', type=float, default=0.25, help="Allowed fraction a result may be worse than the baseline")
+    suite.add_argument('--seed', type=int, default=0)
+
+    sharding = subparsers.add_parser('sharding', help="Single process against sharded runs, checks equal results")
+    sharding.add_argument('--agents', type=int, default=2000)
+    sharding.add_argument('--processes', type=int, nargs='+', default=[2, 4, 8, 16])
+    sharding.add_argument('--hours', type=float, default=6)
+    sharding.add_argument('--seed', type=int, default=0)
+
+    fleets = subparsers.add_parser('fleets', help="Neighbourhood simulated with vectorized fleets")
+    fleets.add_argument('--homes', type=int, default=10000)
+    fleets.add_argument('--hours', type=float, default=24)
+    fleets.add_argument('--seed', type=int, default=0)
+
+    events = subparsers.add_parser('events', help="Quiet year of PV and imbalance agents with the event-driven scheduler")
+    events.add_argument('--agents', type=int, default=1000)
+    events.add_argument('--days', type=float, default=365)
+    events.add_argument('--compare', action='store_true', help="Also run updating every agent every tick")
+    events.add_argument('--seed', type=int, default=0)
+
+    horizon = subparsers.add_parser('horizon', help="Day-ahead horizon cleared at once against interval by interval")
+    horizon.add_argument('--agents', type=int, default=1000)
+    horizon.add_argument('--intervals', type=int, default=96)
+    horizon.add_argument('--ladder-size', type=int, default=10)
+    horizon.add_argument('--seed', type=int, default=0)
+
+    realtime = subparsers.add_parser('realtime', help="Load test of the real-time auctioneer with in-process clients")
+    realtime.add_argument('--clients', type=int, default=5000)
+    realtime.add_argument('--seconds', type=float, default=10)
+    realtime.add_argument('--bid-interval', type=float, default=1, help="Mean time between bids of a client")
+    realtime.add_argument('--slow', type=float, default=0, help="Fraction of clients reading prices late")
+    realtime.add_argument('--read-delay', type=float, default=1, help="Delay of slow clients")
+    realtime.add_argument('--window', type=float, default=None, help="Clearing window in seconds")
+    realtime.add_argument('--seed', type=int, default=0)
+
+    startup = subparsers.add_parser('startup', help="Import and worker start times in fresh interpreters")
+    startup.add_argument('--repeat', type=int, default=5)
+
+    args = parser.parse_args()
+    if args.benchmark == 'suite':
+        if args.save and not args.baseline:
+            parser.error("--save requires --baseline")
+        if not benchmark_suite(args.ladder_sizes, args.agents, args.ticks, seed=args.seed, baseline=args.baseline,
+                               save=args.save, threshold=args.threshold):
+            sys.exit(1)
+    elif args.benchmark == 'sharding':
+        benchmark_sharding(args.agents, args.processes, seed=args.seed, hours=args.hours)
+    elif args.benchmark == 'fleets':
+        benchmark_fleets(args.homes, seed=args.seed, hours=args.hours)
+    elif args.benchmark == 'events':
+        benchmark_events(args.agents, seed=args.seed, days=args.days, compare=args.compare)
+    elif args.benchmark == 'horizon':
+        benchmark_horizon(args.agents, args.intervals, args.ladder_size, seed=args.seed)
+    elif args.benchmark == 'realtime':
+        benchmark_realtime(args.clients, args.seconds, args.bid_interval, args.slow, args.read_delay, args.window, seed=args.seed)
+    elif args.benchmark == 'startup':
+        benchmark_startup(args.repeat)
+    else:
+        parser.print_help()
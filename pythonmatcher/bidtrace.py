@@ -0,0 +1,290 @@
+# Traces of the bid events of markets, to run the clearing engine on a recorded workload (see replay.py)
+#
+# While a TraceRecorder is set (see set_recorder, or settings.bid_trace_path for runs of the environment), every
+# auctioneer writes its bid events to the trace: registrations and removals of agents, bid updates (handle_bid_update)
+# and clearings with the price they found. A market is written in full (settings, price, agents and their bids) with
+# its first event, so recording can start at any point of a run. Concentrators are markets of their own; they don't
+# clear, their aggregated bid is a bid update in the market of their parent.
+#
+# A trace is a stream of records, a kind byte followed by little endian fields:
+#   M  market: market (I), settings as JSON (I length)
+#   A  agent: market (I), agent (I), price subscriber (B), id (H length, utf-8), bid
+#   R  removal of an agent: market (I), agent (I)
+#   B  bid update: time (q, ns since epoch), market (I), agent (I), bid
+#   C  clearing: time (q), market (I), price
+# A bid is its number of prices (I, aggregated ladders of concentrators can be long) followed by its quantities and prices. Numbers of the fixed point backend are q
+# ints, those of the decimal backend one string of space separated numbers (I length), so they are read back exactly.
+# The stream starts with the magic bytes and is compressed as a whole, in the gzip format.
+
+from decimal import Decimal
+import atexit
+import influx
+import json
+import logging
+import os
+import settings as default_settings
+import struct
+import zlib
+
+logger = logging.getLogger(default_settings.app_name + '.' + __name__)
+
+magic = b'PMTRACE2'
+
+# Bytes of records compressed at once
+buffer_size = 1 << 20
+
+_market = struct.Struct('<II')
+_agent = struct.Struct('<IIBH')
+_removal = struct.Struct('<II')
+_bid = struct.Struct('<qII')
+_clearing = struct.Struct('<qI')
+_length = struct.Struct('<I')
+_count = struct.Struct('<I')
+
+# Recorder receiving the bid events of all auctioneers when set (see set_recorder)
+recorder = None
+_fork_hooks = False # Whether flush and _after_fork_in_child are registered to run around a fork
+
+
+class TraceRecorder(object):
+    """ Writes the bid events of all auctioneers to a trace file """
+
+    def __init__(self, path):
+        self.path = path
+        self.events = 0
+
+        # Records are buffered and compressed (gzip format) in blocks, the text of decimals compresses well
+        self._file = open(path, 'wb')
+        self._compressor = zlib.compressobj(1, zlib.DEFLATED, 31)
+        self._buffer = [magic]
+        self._buffered = len(magic)
+
+        self._markets = {} # auctioneer -> index
+        self._agents = {} # agent -> index, over all markets
+        self._time = None # Last environment time and its nanoseconds
+        self._nanoseconds = 0
+
+    def _write(self, record):
+        self._buffer.append(record)
+        self._buffered += len(record)
+        if self._buffered >= buffer_size:
+            self._compress()
+
+    def _compress(self):
+        self._file.write(self._compressor.compress(b''.join(self._buffer)))
+        self._buffer = []
+        self._buffered = 0
+
+    def _now(self, auctioneer):
+        time = auctioneer.context.environment.current_time
+        if time is not self._time:
+            self._time = time
+            self._nanoseconds = influx.to_nanoseconds(time)
+        return self._nanoseconds
+
+    def _numbers(self, auctioneer, values):
+        if auctioneer.numeric.number_type is int:
+            return struct.pack('<{}q'.format(len(values)), *values)
+        text = ' '.join(map(str, values)).encode()
+        return _length.pack(len(text)) + text
+
+    def _bid(self, auctioneer, bid):
+        return _count.pack(len(bid.prices)) + self._numbers(auctioneer, bid.quantities + bid.prices)
+
+    def _market(self, auctioneer):
+        # Index of the market, written with its agents when it is new
+        index = self._markets.get(auctioneer)
+        if index is not None:
+            return index
+
+        index = self._markets[auctioneer] = len(self._markets)
+        numeric = auctioneer.numeric
+        description = {
+            'id': str(auctioneer.id),
+            'numeric': numeric.name,
+            'min_price': str(auctioneer.min_price),
+            'max_price': str(auctioneer.max_price),
+            'price': str(auctioneer.price),
+            'price_steps': auctioneer.market_basis.price_steps if auctioneer.market_basis else None
+        }
+        if numeric.name == 'fixed':
+            description['quantity_resolution'] = str(numeric.quantity_resolution)
+            description['price_resolution'] = str(numeric.price_resolution)
+
+        description = json.dumps(description).encode()
+        self._write(b'M' + _market.pack(index, len(description)) + description)
+        for agent in auctioneer.agents:
+            self._write_agent(index, auctioneer, agent)
+        return index
+
+    def _write_agent(self, market, auctioneer, agent):
+        index = self._agents[agent] = len(self._agents)
+        id = str(agent.id).encode()
+        self._write(b'A' + _agent.pack(market, index, agent in auctioneer.price_subscribers, len(id)) + id +
+                        self._bid(auctioneer, auctioneer.bids[agent]))
+        self.events += 1
+
+    def register(self, auctioneer, agent):
+        # Called after the agent is registered
+        if auctioneer in self._markets:
+            self._write_agent(self._markets[auctioneer], auctioneer, agent)
+        else:
+            self._market(auctioneer)
+
+    def unregister(self, auctioneer, agent):
+        # Called after the agent is unregistered, a new market is written without it
+        if auctioneer in self._markets:
+            self._write(b'R' + _removal.pack(self._markets[auctioneer], self._agents.pop(agent)))
+            self.events += 1
+        else:
+            self._market(auctioneer)
+
+    def bid(self, auctioneer, agent, bid):
+        # Called before the auctioneer takes over the bid
+        market = self._market(auctioneer)
+        self._write(b'B' + _bid.pack(self._now(auctioneer), market, self._agents[agent]) + self._bid(auctioneer, bid))
+        self.events += 1
+
+    def clearing(self, auctioneer, price):
+        # Called with the price found by a clearing, before agents are notified
+        market = self._market(auctioneer)
+        self._write(b'C' + _clearing.pack(self._now(auctioneer), market) + self._numbers(auctioneer, (price,)))
+        self.events += 1
+
+    def flush(self):
+        # Everything written so far can be read from the file
+        self._compress()
+        self._file.write(self._compressor.flush(zlib.Z_SYNC_FLUSH))
+        self._file.flush()
+
+    def close(self):
+        if not self._file.closed:
+            self._compress()
+            self._file.write(self._compressor.flush())
+            self._file.close()
+            logger.info("Wrote %d bid events of %d markets to %s", self.events, len(self._markets), self.path)
+
+
+def set_recorder(new_recorder):
+    # Record the bid events of all auctioneers with new_recorder (a TraceRecorder), None stops recording. A previous
+    # recorder is closed
+    global recorder, _fork_hooks
+    if recorder is not None and recorder is not new_recorder:
+        recorder.close()
+    recorder = new_recorder
+
+    # Importing this module registers nothing. While recording, the trace is closed on shutdown and flushed before a
+    # fork. Fork hooks can't be removed, they are registered with the first recorder and do nothing without one
+    atexit.unregister(close)
+    if recorder is not None:
+        atexit.register(close)
+        if not _fork_hooks:
+            os.register_at_fork(before=flush, after_in_child=_after_fork_in_child)
+            _fork_hooks = True
+
+
+def start_recording(path=None, settings=None):
+    # Record to path (default the bid_trace_path of settings, a runtime context's settings or the settings module)
+    # unless a recorder is set already
+    if recorder is None:
+        set_recorder(TraceRecorder(path or (settings or default_settings).bid_trace_path))
+    return recorder
+
+
+def flush():
+    if recorder is not None:
+        recorder.flush()
+
+
+def close():
+    set_recorder(None)
+
+
+def _after_fork_in_child():
+    # A forked child (e.g. a shard worker) doesn't record, the trace belongs to the parent. Records were flushed before
+    # the fork, so the copy of the recorder in the child has nothing left to write to the file
+    global recorder
+    recorder = None
+
+
+class _Stream(object):
+    """ Decompressed content of a trace file, decompressed a block at a time """
+
+    def __init__(self, f):
+        self.file = f
+        self.decompressor = zlib.decompressobj(31)
+        self.data = b''
+        self.offset = 0
+
+    def read(self, size):
+        # size bytes, fewer at the end of the file
+        end = self.offset + size
+        while end > len(self.data):
+            block = self.file.read(buffer_size // 16)
+            if not block:
+                break
+            self.data = self.data[self.offset:] + self.decompressor.decompress(block)
+            self.offset, end = 0, size
+
+        data = self.data[self.offset:end]
+        self.offset = end
+        return data
+
+def _read(f, size):
+    data = f.read(size)
+    if len(data) < size:
+        raise EOFError("Bid trace ended within a record")
+    return data
+
+def _read_numbers(f, count, is_int):
+    if is_int:
+        return struct.unpack('<{}q'.format(count), _read(f, 8 * count))
+    length, = _length.unpack(_read(f, _length.size))
+    return tuple(map(Decimal, _read(f, length).decode().split()))
+
+def _read_bid(f, is_int):
+    prices, = _count.unpack(_read(f, _count.size))
+    numbers = _read_numbers(f, 2 * prices + 1, is_int)
+    return numbers[:prices + 1], numbers[prices + 1:]
+
+def read_trace(path):
+    # Yields the records of a trace as tuples, bids as a tuple of quantities and prices:
+    #   ('M', market, settings), ('A', market, agent, price_subscriber, id, bid), ('R', market, agent),
+    #   ('B', time, market, agent, bid), ('C', time, market, price)
+    # A trace that wasn't closed (e.g. of a run that is still recording or was killed) is read up to its last record
+    with open(path, 'rb') as raw:
+        f = _Stream(raw)
+        if f.read(len(magic)) != magic:
+            raise ValueError("{} is not a bid trace".format(path))
+
+        is_int = [] # per market, whether its numbers are ints
+        try:
+            while True:
+                kind = f.read(1)
+
+                if kind == b'B':
+                    time, market, agent = _bid.unpack(_read(f, _bid.size))
+                    yield ('B', time, market, agent, _read_bid(f, is_int[market]))
+                elif kind == b'C':
+                    time, market = _clearing.unpack(_read(f, _clearing.size))
+                    yield ('C', time, market, _read_numbers(f, 1, is_int[market])[0])
+                elif kind == b'A':
+                    market, agent, price_subscriber, length = _agent.unpack(_read(f, _agent.size))
+                    id = _read(f, length).decode()
+                    yield ('A', market, agent, bool(price_subscriber), id, _read_bid(f, is_int[market]))
+                elif kind == b'R':
+                    yield ('R',) + _removal.unpack(_read(f, _removal.size))
+                elif kind == b'M':
+                    market, length = _market.unpack(_read(f, _market.size))
+                    description = json.loads(_read(f, length).decode())
+                    is_int.append(description['numeric'] == 'fixed')
+                    yield ('M', market, description)
+                elif not kind:
+                    break
+                else:
+                    raise ValueError("Corrupt bid trace {}".format(path))
+        except EOFError:
+            pass
+
+        if not f.decompressor.eof:
+            logger.warning("Bid trace %s was not closed, read up to its last complete record", path)
@@ -0,0 +1,170 @@
+# Checkpoints of a simulation, to continue a run later or to fork it into variants
+#
+# A checkpoint holds the pickled object graph of the auctioneers and their agents (bids, runlevels, state of charge,
+# random generators, ...) and the simulated time to continue from. load puts the auctioneers in the shared environment,
+# after which agents can be added or removed before continuing with start. Loading one checkpoint again gives an
+# independent copy, so every variant of a fork starts from the same state.
+#
+# For periodic snapshots during a run (settings.checkpoint_interval) a Checkpointer writes the object graph only when
+# agents were added or removed since the previous snapshot. Every snapshot holds just the changing state of the markets
+# (Auctioneer.get_market_state) and refers to the object graph file it applies to.
+#
+# The runtime context of the auctioneers (see runtime.py) is not part of a checkpoint, loaded auctioneers and agents
+# run in the context of the environment they are loaded into.
+
+from runtime import Context
+import datetime
+import ext
+import logging
+import os
+import pickle
+import settings
+
+logger = logging.getLogger(settings.app_name + '.' + __name__)
+
+format_version = 1
+
+class _Pickler(pickle.Pickler):
+    """ Pickles the runtime context by reference """
+
+    def persistent_id(self, obj):
+        return 'context' if isinstance(obj, Context) else None
+
+
+class _Unpickler(pickle.Unpickler):
+    """ Refers to the runtime context of the environment a checkpoint is loaded into """
+
+    def __init__(self, f, context):
+        super(_Unpickler, self).__init__(f)
+        self.context = context
+
+    def persistent_load(self, pid):
+        if pid != 'context':
+            raise pickle.UnpicklingError("Unknown reference {} in checkpoint".format(pid))
+        return self.context
+
+
+def _write(path, content):
+    # Write through a temporary file, so an interrupted write doesn't leave a broken checkpoint
+    with open(path + '.tmp', 'wb') as f:
+        _Pickler(f, protocol=pickle.HIGHEST_PROTOCOL).dump(content)
+    os.replace(path + '.tmp', path)
+
+def _read(path, context):
+    with open(path, 'rb') as f:
+        content = _Unpickler(f, context).load()
+    if content.get('format') != format_version:
+        raise ValueError("Unsupported checkpoint format in {}".format(path))
+    return content
+
+def _environment_state(environment, time):
+    return {
+        'current_time': time,
+        'start_time': environment.start_time,
+        'stop_time': environment.stop_time,
+        'simulation_interval': environment.simulation_interval
+    }
+
+def save(path, environment=None, time=None):
+    # Checkpoint of the environment, continuing at time (default its current time)
+    environment = environment or ext.environment
+    if time is None:
+        time = environment.current_time
+
+    _write(path, {
+        'format': format_version,
+        'kind': 'full',
+        'environment': _environment_state(environment, time),
+        'auctioneers': environment.auctioneers
+    })
+
+def load(path, environment=None):
+    # Restore a checkpoint (full or snapshot) into the environment, returns the environment
+    environment = environment or ext.environment
+    content = _read(path, environment.context)
+
+    if content['kind'] == 'snapshot':
+        structure = _read(os.path.join(os.path.dirname(path), content['structure']), environment.context)
+        auctioneers = structure['auctioneers']
+        for auctioneer, state in zip(auctioneers, content['markets']):
+            auctioneer.set_market_state(state)
+    else:
+        auctioneers = content['auctioneers']
+
+    for name, value in content['environment'].items():
+        setattr(environment, name, value)
+    environment.auctioneers = auctioneers
+    environment.running = False
+    return environment
+
+
+class Checkpointer(object):
+    """ Writes snapshots of an environment every interval of simulated time into a directory """
+
+    def __init__(self, directory, interval, environment=None):
+        self.directory = directory
+        self.interval = interval
+        self.environment = environment or ext.environment
+        self.next_time = None
+
+        self._structure = None # File name of the last written object graph
+        self._agents = [] # Auctioneers and agents in that graph, to detect changes
+
+        os.makedirs(directory, exist_ok=True)
+
+    def _collect_agents(self):
+        # Auctioneers and agents of the environment, including those below concentrators
+        agents = []
+        pending = list(self.environment.auctioneers)
+        while pending:
+            auctioneer = pending.pop()
+            agents.append(auctioneer)
+            agents.extend(auctioneer.agents)
+            pending.extend(agent for agent in auctioneer.agents if hasattr(agent, 'agents'))
+        return agents
+
+    def snapshot(self, time=None):
+        # Snapshot continuing at time (default the tick after the current one), returns its path
+        environment = self.environment
+        if time is None:
+            time = environment.current_time + environment.simulation_interval
+        name = time.strftime('%Y%m%dT%H%M%S')
+
+        agents = self._collect_agents()
+        if len(agents) != len(self._agents) or any(a is not b for a, b in zip(agents, self._agents)):
+            self._structure = 'structure-{}.pickle'.format(name)
+            save(os.path.join(self.directory, self._structure), environment, time)
+            self._agents = agents
+
+        path = os.path.join(self.directory, 'snapshot-{}.pickle'.format(name))
+        _write(path, {
+            'format': format_version,
+            'kind': 'snapshot',
+            'structure': self._structure,
+            'environment': _environment_state(environment, time),
+            'markets': [auctioneer.get_market_state() for auctioneer in environment.auctioneers]
+        })
+        logger.debug("Wrote snapshot %s", path)
+        return path
+
+    def end_tick(self):
+        # Called by the environment after every tick
+        if self.next_time is None:
+            self.next_time = self.environment.current_time + self.interval
+        elif self.environment.current_time >= self.next_time:
+            self.snapshot()
+            self.next_time += self.interval
+
+    def snapshots(self):
+        # Paths of all snapshots in the directory, oldest first
+        return [os.path.join(self.directory, name) for name in sorted(os.listdir(self.directory))
+                if name.startswith('snapshot-') and name.endswith('.pickle')]
+
+
+def create_checkpointer(environment=None):
+    # Checkpointer from the settings of the environment's context, None when periodic snapshots are off
+    environment = environment or ext.environment
+    settings = environment.context.settings
+    if not settings.checkpoint_interval:
+        return None
+    return Checkpointer(settings.checkpoint_dir, datetime.timedelta(minutes=settings.checkpoint_interval), environment)
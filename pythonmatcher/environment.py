@@ -1,37 +1,147 @@
 # SimulationEnvironment is put in seperate file to prohibit circular import. See if this needs refactoring
 
+import bidtrace
 import datetime
+import influx
+import logging
+import metrics
+import settings
+
+logger = logging.getLogger(settings.app_name + '.' + __name__)
 
 class SimulationEnvironment(object):
     """ The environment is responsible for calling handle_state_update of the agents in case of an update in state """
     # Currently it only contains the (simulated) time
 
-    def __init__(self, start_time = datetime.datetime.now(), stop_time = datetime.datetime.now() + datetime.timedelta(days=365), simulation_interval = datetime.timedelta(minutes=1)):
+    def __init__(self, start_time = None, stop_time = None, simulation_interval = datetime.timedelta(minutes=1),
+                 processes = None, event_driven = False, context = None):
+        # Times default to now and a year from now, when the environment is created
+        if start_time is None:
+            start_time = datetime.datetime.now()
+        if stop_time is None:
+            stop_time = datetime.datetime.now() + datetime.timedelta(days=365)
+
         self.start_time = start_time
         self.stop_time = stop_time
         self.simulation_interval = simulation_interval
         self.running = False
         self.auctioneers = []
 
+        # Number of worker processes to shard the agents over (see sharding.py), None to run in this process
+        self.processes = processes
+
+        # Only update agents when they need it instead of every tick (see scheduler.py)
+        self.event_driven = event_driven
+
         self.current_time = start_time
 
+        # Samples ticks with cProfile during start when settings.profile_sample_interval is set
+        self.profiler = None
+
+        # Writes periodic snapshots (see checkpoint.py), created on start from the settings if not set
+        self.checkpointer = None
+
+        # Runtime context of the simulation in this environment (see runtime.py), a new one when not given
+        if context is None:
+            from runtime import Context # Imported here, runtime depends on this module
+            context = Context(environment=self)
+        self.context = context
+
+    def __getstate__(self):
+        # Without the profiler of a running start, e.g. when pickled with the context of an auctioneer
+        return dict(self.__dict__, profiler=None)
+
     def register_auctioneer(self, auctioneer):
+        # The auctioneer and its agents run in the context of this environment, also when created in another one (e.g.
+        # the default context, without a context given), so their telemetry has the time of this environment
+        if auctioneer.context is not self.context:
+            _set_context(auctioneer, self.context)
         self.auctioneers.append(auctioneer)
 
     def unregister_auctioneer(self, auctioneer):
         self.auctioneers.remove(auctioneer)
 
     def start(self):
-        self.running = True
+        if self.processes and self.event_driven:
+            raise ValueError("Event-driven runs can't be sharded over processes")
+
+        settings = self.context.settings
+        if settings.metrics_enabled:
+            metrics.enable()
+        if settings.profile_sample_interval:
+            self.profiler = metrics.Profiler(settings.profile_sample_interval)
+        if self.checkpointer is None:
+            from checkpoint import create_checkpointer # Imported here, checkpoint depends on ext which imports this module
+            self.checkpointer = create_checkpointer(self)
+        if settings.bid_trace_path:
+            bidtrace.start_recording(settings=settings)
 
-        while self.running:
-            for auctioneer in self.auctioneers:
-                for agent in auctioneer.agents:
-                    agent.handle_state_update()
+        if self.processes:
+            from sharding import run_sharded # Imported here, sharding depends on powermatcher which imports this module
+            run_sharded(self, self.processes)
+        elif self.event_driven:
+            from scheduler import run_event_driven
+            run_event_driven(self)
+        else:
+            self.running = True
 
-            self.current_time += self.simulation_interval
-            if self.current_time > self.stop_time:
-                self.running = False
+            while self.running:
+                self.start_tick()
+                for auctioneer in self.auctioneers:
+                    self.update_agents(auctioneer.agents)
+                    auctioneer.end_tick()
+                self.end_tick()
+
+                self.current_time += self.simulation_interval
+                if self.current_time > self.stop_time:
+                    self.running = False
+
+        self.context.flush_reduction() # Last rollup windows and deadband values of the run
+        bidtrace.flush()
+        self.report()
+
+    def update_agents(self, agents):
+        # State update of the agents of one auctioneer, timed per agent type when metrics are enabled
+        if metrics.enabled:
+            metrics.timed_state_updates(agents)
+        else:
+            for agent in agents:
+                agent.handle_state_update()
+
+    def start_tick(self):
+        if self.profiler is not None:
+            self.profiler.start_tick()
+
+    def end_tick(self):
+        if self.profiler is not None:
+            self.profiler.end_tick()
+        if metrics.enabled:
+            metrics.end_tick(influx.queue_size())
+        if self.checkpointer is not None:
+            self.checkpointer.end_tick()
+
+    def report(self):
+        # Profile and metrics summary of the run
+        if self.profiler is not None:
+            logger.info(self.profiler.summary())
+            if self.context.settings.profile_output:
+                self.profiler.dump(self.context.settings.profile_output)
+
+        if metrics.enabled:
+            logger.info("Metrics of the run:\n" + metrics.summary())
+            metrics.export(self.current_time, settings=self.context.settings)
 
     def stop(self):
         self.running = False
+
+
+def _set_context(auctioneer, context):
+    # Context of an auctioneer, its agents and the concentrators below it with their agents
+    pending = [auctioneer]
+    while pending:
+        auctioneer = pending.pop()
+        auctioneer.context = context
+        for agent in auctioneer.agents:
+            agent.context = context
+            if hasattr(agent, 'agents'):
+                pending.append(agent)
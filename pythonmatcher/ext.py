@@ -1,6 +1,10 @@
 # Shared services go here (dependency injection)
-import settings
-from environment import SimulationEnvironment
-import datetime
+#
+# ext.environment is the environment of the default runtime context (see runtime.py). It is created on first use
+# instead of at import, simulations with their own context don't need it.
 
-environment = SimulationEnvironment(stop_time=datetime.datetime.now() + datetime.timedelta(days=2))
\ No newline at end of file
+def __getattr__(name):
+    if name == 'environment':
+        from runtime import default_context
+        return default_context().environment
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
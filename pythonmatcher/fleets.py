@@ -0,0 +1,246 @@
+# Fleets of homogeneous devices, computed with numpy
+#
+# A fleet represents many devices of one type (e.g. the PV panels of a neighbourhood) by arrays of their parameters and
+# state. Every tick the bids, runlevels and state of all devices are computed in one vectorized step. The fleet takes
+# part in the market as a single agent: its bid is the sum of the bids of its devices on the price steps of a market
+# basis (the one of the auctioneer, or its own with price_steps). The runlevel of every device follows its own bid.
+
+from agents import next_sunrise, sun_factor
+from marketbasis import ArrayBid, MarketBasis
+from powermatcher import BaseAgent, Bid
+from profiles import open_profile
+import logging
+import numpy as np
+import settings
+
+logger = logging.getLogger(settings.app_name + '.' + __name__)
+
+class Fleet(BaseAgent):
+    """ Base class of fleets, subclasses implement calculate_quantities """
+
+    # Devices follow their own bids, not the aggregated bid of the fleet
+    price_subscriber = True
+
+    def __init__(self, auctioneer, size, id=None, price_steps=100):
+        self.size = size
+        self.powers = np.zeros(size) # Current power of every device, in watt
+
+        if auctioneer.market_basis:
+            self.market_basis = auctioneer.market_basis
+        else:
+            n = auctioneer.numeric
+            self.market_basis = MarketBasis(n.price_to_decimal(auctioneer.min_price), n.price_to_decimal(auctioneer.max_price), price_steps,
+                                            numeric_backend=n)
+
+        super(Fleet, self).__init__(auctioneer, id=id)
+
+        # Generator for the noise of all devices, seeded from the agent's own generator
+        self.rng = np.random.default_rng(self.random.getrandbits(64))
+
+    def _open_profile(self, profile, sites):
+        # Reader of a profile file and the columns of the devices (all sites of the profile by default)
+        self.profile = open_profile(profile)
+        if sites is None:
+            sites = self.profile.profile.sites
+        self.site_indices = np.array([self.profile.profile.index(site) for site in sites], dtype=np.intp)
+
+    def profile_values(self):
+        # Measured values of the devices at the current tick
+        environment = self.context.environment
+        return self.profile.row(environment.current_time, environment.simulation_interval)[self.site_indices]
+
+    def calculate_quantities(self, prices):
+        # Quantity of every device (rows) at every price (columns), in watt. prices is a float array
+        raise NotImplementedError
+
+    def calculate_bid(self):
+        demand = self.calculate_quantities(self.market_basis.price_array).sum(axis=0)
+        return ArrayBid(self.market_basis, self.market_basis.watts_to_units(demand)).to_bid(self.auctioneer)
+
+    def do_runlevel_update(self):
+        # Every device follows its own bid at the current price
+        price = self.numeric.price_to_float(self.auctioneer.price)
+        self.powers = self.calculate_quantities(np.array([price]))[:, 0]
+        self.current_power = self.numeric.quantity_from_float(self.powers.sum())
+
+    def get_state(self):
+        state = super(Fleet, self).get_state()
+        state['powers'] = self.powers.copy()
+        state['rng'] = self.rng.bit_generator.state
+        return state
+
+    def set_state(self, state):
+        super(Fleet, self).set_state(state)
+        self.powers = state['powers'].copy()
+        self.rng.bit_generator.state = state['rng']
+
+
+class FlatFleet(Fleet):
+    """ Fleet of devices with a power independent of the price (flat bids) """
+
+    def __init__(self, auctioneer, size, id=None, price_steps=100):
+        self.state_powers = np.zeros(size)
+        super(FlatFleet, self).__init__(auctioneer, size, id=id, price_steps=price_steps)
+
+    def calculate_quantities(self, prices):
+        return np.broadcast_to(self.state_powers[:, None], (self.size, len(prices)))
+
+    def calculate_bid(self):
+        # Sum of flat bids is flat, no need to go over the price steps
+        return Bid(self.auctioneer, self.numeric.quantity_from_float(self.state_powers.sum()))
+
+    def handle_state_update(self):
+        self.state_powers = self.calculate_state_powers()
+        self.do_bid_update(self.calculate_bid())
+        self.do_runlevel_update()
+
+    def get_state(self):
+        state = super(FlatFleet, self).get_state()
+        state['state_powers'] = self.state_powers.copy()
+        return state
+
+    def set_state(self, state):
+        super(FlatFleet, self).set_state(state)
+        self.state_powers = state['state_powers'].copy()
+
+
+class LoadFleet(FlatFleet):
+    """ Vectorized LoadAgent: loads (watt) with a random noise of up to noise_factors """
+
+    def __init__(self, auctioneer, loads=None, id=None, noise_factors=0.1, profile=None, sites=None):
+        # With a profile file, the loads of sites (all by default) follow the measured values
+        self.profile = None
+        if profile:
+            self._open_profile(profile, sites)
+            loads = np.zeros(len(self.site_indices))
+        self.loads = np.asarray(loads, dtype=float)
+        self.noise_factors = np.broadcast_to(np.asarray(noise_factors, dtype=float), self.loads.shape)
+
+        super(LoadFleet, self).__init__(auctioneer, len(self.loads), id=id)
+
+    def calculate_state_powers(self):
+        if self.profile:
+            self.loads = self.profile_values()
+        return self.loads * (1 + self.noise_factors * self.rng.random(self.size))
+
+
+class PVFleet(FlatFleet):
+    """ Vectorized PVAgent: production following the sun up to peak_powers (watt), with noise """
+
+    def __init__(self, auctioneer, peak_powers=None, id=None, noise_factors=0.1, profile=None, sites=None):
+        # With a profile file, the production of sites (all by default) follows the measured values
+        self.profile = None
+        if profile:
+            self._open_profile(profile, sites)
+            peak_powers = np.zeros(len(self.site_indices))
+        self.peak_powers = np.asarray(peak_powers, dtype=float)
+        self.noise_factors = np.broadcast_to(np.asarray(noise_factors, dtype=float), self.peak_powers.shape)
+
+        super(PVFleet, self).__init__(auctioneer, len(self.peak_powers), id=id)
+
+    def calculate_state_powers(self):
+        if self.profile:
+            return - self.profile_values() * (1 + self.noise_factors * self.rng.random(self.size))
+
+        factor = sun_factor(self.context.environment.current_time)
+        if factor == 0:
+            return np.zeros(self.size)
+        return - self.peak_powers * factor * (1 + self.noise_factors * self.rng.random(self.size))
+
+    def next_update_time(self):
+        # No production at night, nothing changes until sunrise. Measured production may change every tick
+        time = self.context.environment.current_time
+        if self.profile or sun_factor(time) > 0:
+            return super(PVFleet, self).next_update_time()
+        return next_sunrise(time)
+
+
+class BatteryFleet(Fleet):
+    """ Vectorized BatteryAgent, with the same bidding ladder per battery """
+
+    # Bid at an empty or full battery depends on the price
+    price_responsive = True
+
+    # Idle batteries keep their state of charge until a price change sets them to work
+    wake_on_price_change = True
+
+    def __init__(self, auctioneer, capacities, id=None, socs=0.5, max_charge_powers=4000, max_discharge_powers=3000,
+                 bidding_ladder_steps=10, price_steps=100):
+        self.capacities = np.asarray(capacities, dtype=float) # in kWh
+        shape = self.capacities.shape
+        self.socs = np.array(np.broadcast_to(np.asarray(socs, dtype=float), shape))
+        self.max_charge_powers = np.broadcast_to(np.asarray(max_charge_powers, dtype=float), shape)
+        self.max_discharge_powers = np.broadcast_to(np.asarray(max_discharge_powers, dtype=float), shape)
+        self.bidding_ladder_steps = bidding_ladder_steps
+
+        super(BatteryFleet, self).__init__(auctioneer, len(self.capacities), id=id, price_steps=price_steps)
+
+    def _ladders(self):
+        # Lowest price, price step and quantity step of the bidding ladder of every battery (as BatteryAgent.calculate_bid)
+        min_price = self.numeric.price_to_float(self.auctioneer.min_price)
+        max_price = self.numeric.price_to_float(self.auctioneer.max_price)
+        steps = self.bidding_ladder_steps
+
+        ladder_min = np.where(self.socs <= 0.5, max_price - (max_price - min_price) * self.socs / .5, min_price)
+        ladder_max = np.where(self.socs <= 0.5, max_price, min_price + (max_price - min_price) * 2 * (1 - self.socs))
+        return ladder_min, (ladder_max - ladder_min) / (steps + 1), (self.max_charge_powers + self.max_discharge_powers) / (steps + 1)
+
+    def _flat_quantities(self):
+        # Empty batteries charge unless the price is maximal, full batteries discharge unless the price is minimal
+        empty = 0 if self.auctioneer.price == self.auctioneer.max_price else self.max_charge_powers
+        full = 0 if self.auctioneer.price == self.auctioneer.min_price else -self.max_discharge_powers
+        return np.where(self.socs <= 0, empty, np.where(self.socs >= 1, full, 0))
+
+    def calculate_quantities(self, prices):
+        ladder_min, price_step, charge_step = self._ladders()
+        flat = (self.socs <= 0) | (self.socs >= 1)
+
+        # Number of ladder prices (min + n * price_step, n = 1..steps) at or below the price gives the quantity
+        with np.errstate(divide='ignore', invalid='ignore'):
+            passed = np.clip(np.floor((prices[None, :] - ladder_min[:, None]) / price_step[:, None]), 0, self.bidding_ladder_steps)
+        quantities = self.max_charge_powers[:, None] - passed * charge_step[:, None]
+
+        return np.where(flat[:, None], self._flat_quantities()[:, None], quantities)
+
+    def calculate_bid(self):
+        # Sum of all ladders on the price steps of the market basis: every ladder price lowers the demand from the first
+        # price step at or above it. Linear in the number of ladder prices instead of batteries times price steps
+        ladder_min, price_step, charge_step = self._ladders()
+        active = (self.socs > 0) & (self.socs < 1)
+        price_steps = self.market_basis.price_steps
+
+        ladder_prices = ladder_min[active, None] + np.arange(1, self.bidding_ladder_steps + 1) * price_step[active, None]
+        first_steps = np.searchsorted(self.market_basis.price_array, ladder_prices.ravel())
+        drops = np.bincount(first_steps, weights=np.repeat(charge_step[active], self.bidding_ladder_steps), minlength=price_steps + 1)
+
+        demand = self.max_charge_powers[active].sum() + self._flat_quantities().sum() - np.cumsum(drops[:price_steps])
+        return ArrayBid(self.market_basis, self.market_basis.watts_to_units(demand)).to_bid(self.auctioneer)
+
+    def handle_state_update(self):
+        # Update state of charge depending on what happened
+        capacities_in_joules = self.capacities * 3600 * 1000
+        interval = self.context.environment.simulation_interval
+        self.socs = np.clip(self.socs + self.powers * interval.total_seconds() / capacities_in_joules, 0, 1)
+
+        self.context.write_point("deviceagent_soc", {"agent_id": self.id, "auctioneer_id": self.auctioneer.id},
+                                 {'power': float(self.socs.mean())})
+
+        self.do_bid_update(self.calculate_bid())
+        self.do_runlevel_update()
+
+    def handle_rebid(self):
+        self.do_bid_update(self.calculate_bid())
+
+    def next_update_time(self):
+        if not self.powers.any():
+            return None
+        return super(BatteryFleet, self).next_update_time()
+
+    def get_state(self):
+        state = super(BatteryFleet, self).get_state()
+        state['socs'] = self.socs.copy()
+        return state
+
+    def set_state(self, state):
+        super(BatteryFleet, self).set_state(state)
+        self.socs = state['socs'].copy()
@@ -1,27 +1,363 @@
 import logging
-from concurrent.futures import ThreadPoolExecutor
 
-import settings
+import metrics
+import settings as default_settings
+import atexit
+import calendar
+import collections
+import math
+import threading
+import time
 import traceback
-from influxdb import InfluxDBClient
+import urllib.parse
 
-logger = logging.getLogger(settings.app_name + '.' + __name__)
+logger = logging.getLogger(default_settings.app_name + '.' + __name__)
 # logger.setLevel(logging.DEBUG)
 
 # Create variable that holds all the connections to influxdb
 influxClients = {}
 
-# Threadpool for async writing to database
-executor = ThreadPoolExecutor(max_workers=2)
+# Batch writers per database, used when settings.influxdb_batch_writes is enabled. Functions writing points take the
+# settings of the runtime context they write for, default the settings module
+batchWriters = {}
 
-def write_points(points, database):
+# Sink receiving all points instead of InfluxDB when set, e.g. a recorder.ColumnarRecorder (see set_sink)
+sink = None
+
+# Deadbands and rollups applied by write_point before points go to the sink or InfluxDB (see reduction.py)
+reduction = None
+
+# Threadpool for async writing to database, started on the first async write (see get_executor)
+executor = None
+
+# The InfluxDB client, urllib.request and the threadpool are only loaded when points are written to InfluxDB, so
+# importing this module (and every module writing telemetry) stays fast for workers that don't
+
+
+def _escape(value, special):
+    value = str(value)
+    for character in special:
+        value = value.replace(character, '\\' + character)
+    return value
+
+
+def _encode_field_value(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, int):
+        return '{}i'.format(value)
+    if isinstance(value, float):
+        return repr(value)
+    return '"{}"'.format(_escape(value, '\\"'))
+
+
+def to_nanoseconds(timestamp):
+    # Nanoseconds since epoch. Naive datetimes are taken as UTC, like the influxdb client does
+    return (calendar.timegm(timestamp.utctimetuple()) * 1000000 + timestamp.microsecond) * 1000
+
+
+def encode_line(measurement, tags, fields, timestamp):
+    # Encode a single point in the InfluxDB line protocol. InfluxDB rejects NaN and infinite floats (and with them the
+    # whole batch), those fields are left out. Returns None when no field is left
+    fields = [(key, value) for key, value in fields.items() if not (isinstance(value, float) and not math.isfinite(value))]
+    if not fields:
+        return None
+
+    line = _escape(measurement, '\\, ')
+    for key in sorted(tags):
+        line += ',{}={}'.format(_escape(key, '\\,= '), _escape(tags[key], '\\,= '))
+    line += ' ' + ','.join('{}={}'.format(_escape(key, '\\,= '), _encode_field_value(value)) for key, value in fields)
+    if timestamp is not None:
+        line += ' {}'.format(to_nanoseconds(timestamp))
+    return line
+
+
+class TelemetrySink(object):
+    """ Interface for destinations of telemetry points, see set_sink. The base class discards all points """
+
+    def write(self, measurement, tags, fields, timestamp):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+
+class BatchWriter(TelemetrySink):
+    """ Buffers points as line protocol and writes them to InfluxDB in batches from a background thread """
+
+    # A batch is sent when batch_size points are buffered, or when flush_interval seconds have passed. When the buffer
+    # holds max_queue_size points (InfluxDB can't keep up), write either blocks until there is room or drops the point.
+
+    def __init__(self, database, host=None, port=None, batch_size=None, flush_interval=None, max_queue_size=None,
+                 drop_on_overflow=None, timeout=10, settings=None):
+        settings = settings or default_settings
+        self.database = database
+        self.host = host if host is not None else settings.influxdb_host
+        self.port = port if port is not None else settings.influxdb_port
+        self.batch_size = batch_size if batch_size is not None else settings.influxdb_batch_size
+        self.flush_interval = flush_interval if flush_interval is not None else settings.influxdb_flush_interval
+        self.max_queue_size = max_queue_size if max_queue_size is not None else settings.influxdb_max_queue_size
+        self.drop_on_overflow = drop_on_overflow if drop_on_overflow is not None else settings.influxdb_drop_on_overflow
+        self.timeout = timeout
+
+        self.url = 'http://{}:{}/write?{}'.format(self.host, self.port, urllib.parse.urlencode({'db': database, 'precision': 'ns'}))
+
+        self.written_points = 0
+        self.dropped_points = 0
+
+        self._lines = collections.deque()
+        self._in_flight = 0
+        self._flush_requested = False
+        self._closed = False
+        self._condition = threading.Condition()
+
+        self._thread = threading.Thread(target=self._run, name='influx-writer-{}'.format(database), daemon=True)
+        self._thread.start()
+
+    def write(self, measurement, tags, fields, timestamp):
+        line = encode_line(measurement, tags, fields, timestamp)
+
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("Writing to closed BatchWriter")
+
+            if line is None:
+                # Only non-finite fields
+                self.dropped_points += 1
+                return
+
+            if len(self._lines) >= self.max_queue_size:
+                if self.drop_on_overflow:
+                    self.dropped_points += 1
+                    return
+                # Backpressure: wait until the background thread made room
+                while len(self._lines) >= self.max_queue_size:
+                    self._condition.wait()
+
+            self._lines.append(line)
+            if len(self._lines) >= self.batch_size:
+                self._condition.notify_all()
+
+    def queue_size(self):
+        return len(self._lines)
+
+    def flush(self):
+        # Block until all buffered points are sent
+        with self._condition:
+            self._flush_requested = True
+            self._condition.notify_all()
+            while self._lines or self._in_flight:
+                self._condition.wait()
+            self._flush_requested = False
+
+    def close(self):
+        # Flush remaining points and stop the background thread
+        if self._closed:
+            return
+        self.flush()
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                deadline = time.monotonic() + self.flush_interval
+                while len(self._lines) < self.batch_size and not (self._closed or self._flush_requested):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+
+                if self._closed and not self._lines:
+                    return
+
+                batch = [self._lines.popleft() for _ in range(min(self.batch_size, len(self._lines)))]
+                self._in_flight = len(batch)
+                self._condition.notify_all() # Wake up writers waiting for room
+
+            if batch:
+                self._post(batch)
+
+            with self._condition:
+                self._in_flight = 0
+                self._condition.notify_all()
+
+    def _post(self, batch):
+        import urllib.request
+        request = urllib.request.Request(self.url, data='\n'.join(batch).encode('utf-8'), method='POST')
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout):
+                pass
+            self.written_points += len(batch)
+        except Exception:
+            # Raising is of no use in the background thread, log and drop the batch
+            self.dropped_points += len(batch)
+            logger.error("Error while writing {} points to {}".format(len(batch), self.url))
+            traceback.print_exc()
+
+
+def query(q, host=None, port=None):
+    # Run a query (e.g. CREATE DATABASE) over the HTTP API
+    host = host if host is not None else default_settings.influxdb_host
+    port = port if port is not None else default_settings.influxdb_port
+    url = 'http://{}:{}/query'.format(host, port)
+    import urllib.request
+    request = urllib.request.Request(url, data=urllib.parse.urlencode({'q': q}).encode('utf-8'), method='POST')
+    with urllib.request.urlopen(request, timeout=10):
+        pass
+
+
+def get_batch_writer(database, settings=None):
+    # Create batch writer for specified database if it doesn't exist yet
+    if database not in batchWriters:
+        settings = settings or default_settings
+        # Empty database in case it isn't empty (setting)
+        if settings.influxdb_empty:
+            query('DROP DATABASE "{}"'.format(database), settings.influxdb_host, settings.influxdb_port)
+
+        query('CREATE DATABASE "{}"'.format(database), settings.influxdb_host, settings.influxdb_port)
+        batchWriters[database] = BatchWriter(database, settings=settings)
+        _update_close_hook()
+
+    return batchWriters[database]
+
+
+def set_sink(new_sink):
+    # Send all points to new_sink (a TelemetrySink) instead of InfluxDB. None restores writing to InfluxDB
+    global sink
+    sink = new_sink
+    _update_close_hook()
+
+
+def get_sink():
+    # Sink set through set_sink, or created from settings.telemetry_sink
+    if sink is None and default_settings.telemetry_sink == 'recorder':
+        from recorder import ColumnarRecorder
+        set_sink(ColumnarRecorder(default_settings.storage_dir))
+    return sink
+
+
+def set_reduction(new_reduction):
+    # Reduce the points of write_point with new_reduction (a reduction.Reduction), None writes them as they come
+    global reduction
+    reduction = new_reduction
+    _update_close_hook()
+
+
+def get_reduction():
+    # Reduction set through set_reduction, or created from settings.telemetry_reduction
+    if reduction is None and default_settings.telemetry_reduction:
+        from reduction import create_reduction
+        set_reduction(create_reduction(_write_point))
+    return reduction
+
+
+def flush_reduction():
+    # Write the open rollup windows and the points held back by deadbands, at the end of a run
+    if reduction is not None:
+        reduction.flush()
+
+
+def get_executor():
+    # Threadpool for async writing, created on first use
+    global executor
+    if executor is None:
+        from concurrent.futures import ThreadPoolExecutor
+        executor = ThreadPoolExecutor(max_workers=2)
+    return executor
+
+
+def after_fork():
+    # Connections and writer threads of the parent can't be used in a forked child process. Points of an in-process sink
+    # would end up in a copy that is never read, so those are discarded
+    global executor
+    influxClients.clear()
+    batchWriters.clear()
+    executor = None
+
+    if sink is not None:
+        set_sink(TelemetrySink())
+    # Windows and held points of the parent are written by the parent, the child starts its own reduction
+    set_reduction(None)
+
+
+def flush():
+    # Write all buffered points
+    flush_reduction()
+    if sink is not None:
+        sink.flush()
+    for writer in list(batchWriters.values()):
+        writer.flush()
+
+
+def close():
+    # Flush and stop all batch writers and the sink, called on shutdown while any of them is set
+    flush_reduction()
+    if sink is not None:
+        sink.close()
+    while batchWriters:
+        batchWriters.popitem()[1].close()
+    atexit.unregister(close)
+
+
+def _update_close_hook():
+    # Importing this module registers nothing, close is registered to run on shutdown while there is something to close
+    atexit.unregister(close)
+    if sink is not None or reduction is not None or batchWriters:
+        atexit.register(close)
+
+
+def queue_size():
+    # Number of points waiting in batch writers
+    return sum(writer.queue_size() for writer in list(batchWriters.values()))
+
+
+def write_point(measurement, tags, fields, timestamp, database, settings=None):
+    # Write a single point to the sink, buffered in a batch writer or directly through write_points, after reduction
+
+    if metrics.enabled:
+        start = metrics.clock()
+
+    if get_reduction() is not None:
+        reduction.write(measurement, tags, fields, timestamp, database)
+    else:
+        _write_point(measurement, tags, fields, timestamp, database, settings)
+
+    if metrics.enabled:
+        metrics.observe('influx.write.seconds', metrics.clock() - start)
+
+
+def _write_point(measurement, tags, fields, timestamp, database, settings=None):
+    settings = settings or default_settings
+    if get_sink() is not None:
+        sink.write(measurement, tags, fields, timestamp)
+    elif not settings.influxdb_enabled:
+        return
+    elif settings.influxdb_batch_writes:
+        get_batch_writer(database, settings).write(measurement, tags, fields, timestamp)
+    else:
+        write_points([{"measurement": measurement, "tags": tags, "fields": fields, "time": timestamp}], database, settings)
+
+
+def write_points(points, database, settings=None):
     # Write the points to the InfluxDB
+    settings = settings or default_settings
+
+    if get_sink() is not None:
+        for point in points:
+            sink.write(point["measurement"], point.get("tags", {}), point["fields"], point.get("time"))
 
-    if settings.influxdb_enabled:
-        logger.debug('Writing to db: {}'.format(points))
+    elif settings.influxdb_enabled:
+        logger.debug('Writing to db: %s', points)
         try:
             # Create connection to influxdb for specified database if it doesn't exist yet
             if not database in influxClients:
+                from influxdb import InfluxDBClient
                 influxClients[database] = InfluxDBClient(host=settings.influxdb_host, database=database)
 
                 # Empty database in case it isn't empty (setting)
@@ -31,10 +367,10 @@ def write_points(points, database):
                 influxClients[database].create_database(database)
 
             if settings.influxdb_write_async:
-                executor.submit(influxClients[database].write_points, points)
+                get_executor().submit(influxClients[database].write_points, points)
             else:
                 influxClients[database].write_points(points)
         except Exception as e:
             logger.error("Error while writing points to database: {}".format(points))
             traceback.print_exc() # Print stacktrace, since we are using threading this error will not be caught by the main tread
-            raise e
\ No newline at end of file
+            raise e
@@ -0,0 +1,199 @@
+from decimal import Decimal
+from powermatcher import Bid
+import bisect
+import numeric
+import numpy as np
+
+class MarketBasis(object):
+    """ Fixed grid of price steps between min_price and max_price, as used by the reference PowerMatcher """
+
+    # Step 0 is min_price and step price_steps-1 is max_price. Quantities on the grid are stored as integer multiples
+    # of quantity_resolution, so adding and subtracting demand vectors is exact. With the fixed point backend quantities
+    # are integers already and are stored as is.
+
+    def __init__(self, min_price=Decimal(0), max_price=Decimal(1000), price_steps=100, quantity_resolution=Decimal('0.001'),
+                 numeric_backend=None):
+        if price_steps < 2:
+            raise ValueError("A market basis needs at least two price steps")
+
+        self.numeric = numeric.get_backend(numeric_backend)
+        self.min_price = self.numeric.price(min_price)
+        self.max_price = self.numeric.price(max_price)
+        self.price_steps = price_steps
+        self.quantity_resolution = quantity_resolution
+
+        self.prices = tuple(self.min_price + self.numeric.divide(n * (self.max_price - self.min_price), price_steps - 1)
+                            for n in range(price_steps - 1)) + (self.max_price,)
+        self.price_array = np.array([self.numeric.price_to_float(p) for p in self.prices])
+
+        # Quantity units in one watt, for converting float arrays in watt
+        if self.numeric.number_type is int:
+            self._units_per_watt = 1 / self.numeric.quantity_to_float(1)
+        else:
+            self._units_per_watt = 1 / float(quantity_resolution)
+
+    def price(self, index):
+        return self.prices[index]
+
+    def price_index(self, price):
+        # Index of the highest price step not above price
+        return max(bisect.bisect_right(self.prices, price) - 1, 0)
+
+    def to_units(self, quantity):
+        if isinstance(quantity, int):
+            return quantity
+        return int((quantity / self.quantity_resolution).to_integral_value())
+
+    def from_units(self, units):
+        if self.numeric.number_type is int:
+            return int(units)
+        return int(units) * self.quantity_resolution
+
+    def watts_to_units(self, watts):
+        return np.rint(np.asarray(watts) * self._units_per_watt).astype(np.int64)
+
+    def create_aggregate(self, auctioneer):
+        return ArrayBidAggregate(auctioneer, self)
+
+
+class ArrayBid(object):
+    """ Bid as a dense demand vector, holding the quantity at every price step of a market basis """
+
+    def __init__(self, market_basis, demand=None):
+        self.market_basis = market_basis
+
+        if demand is None:
+            demand = np.zeros(market_basis.price_steps, dtype=np.int64)
+        self.demand = demand
+
+    @classmethod
+    def from_bid(cls, market_basis, bid):
+        # The quantity at a price step is the quantity of the bid at that price (same as Bid.find_quantity)
+        quantities = np.fromiter((market_basis.to_units(q) for q in bid.quantities), dtype=np.int64, count=len(bid.quantities))
+        boundaries = [0] + [bisect.bisect_left(market_basis.prices, p) for p in bid.prices] + [market_basis.price_steps]
+
+        return cls(market_basis, np.repeat(quantities, np.diff(boundaries)))
+
+    def to_bid(self, auctioneer):
+        # Breakpoints are at the price steps where the demand changes
+        changes = np.flatnonzero(self.demand[1:] != self.demand[:-1]) + 1
+
+        quantities = (self.market_basis.from_units(self.demand[0]),) + tuple(self.market_basis.from_units(self.demand[i]) for i in changes)
+        prices = tuple(self.market_basis.price(i) for i in changes)
+        return Bid(auctioneer, quantities, prices)
+
+    def __str__(self):
+        # The market basis has the min_price and max_price a Bid needs from its auctioneer
+        return str(self.to_bid(self.market_basis))
+
+    def __eq__(self, other):
+        return self.market_basis is other.market_basis and np.array_equal(self.demand, other.demand)
+
+    def __add__(self, other):
+        return ArrayBid(self.market_basis, self.demand + other.demand)
+
+    def __sub__(self, other):
+        return ArrayBid(self.market_basis, self.demand - other.demand)
+
+    def equilibrium_price(self):
+        # Return price at which production is equal to consumption
+
+        if self.demand[0] < 0:
+            # Production at any price
+            return self.market_basis.min_price
+        elif self.demand[-1] > 0:
+            # Consumption at any price
+            return self.market_basis.max_price
+        else:
+            # First price step at which the demand crosses zero
+            return self.market_basis.price(int(np.argmax(self.demand <= 0)))
+
+    def find_quantity(self, price):
+        return self.market_basis.from_units(self.demand[self.market_basis.price_index(price)])
+
+
+class HorizonBid(object):
+    """ Bids of a horizon of market intervals as a matrix, holding the demand of every interval (rows) at every price step """
+
+    def __init__(self, market_basis, demand):
+        self.market_basis = market_basis
+        self.demand = demand
+
+    @classmethod
+    def from_bids(cls, market_basis, bids):
+        # One Bid per interval, as ArrayBid.from_bid for every interval but with a single repeat for all of them
+        units = []
+        lengths = [] # Number of price steps with each quantity
+        for bid in bids:
+            units.extend(market_basis.to_units(q) for q in bid.quantities)
+            boundary = 0
+            for p in bid.prices:
+                next_boundary = bisect.bisect_left(market_basis.prices, p)
+                lengths.append(next_boundary - boundary)
+                boundary = next_boundary
+            lengths.append(market_basis.price_steps - boundary)
+
+        demand = np.repeat(np.array(units, dtype=np.int64), lengths)
+        return cls(market_basis, demand.reshape(-1, market_basis.price_steps))
+
+    @classmethod
+    def from_watts(cls, market_basis, watts):
+        # Float array in watt, intervals x price steps
+        return cls(market_basis, market_basis.watts_to_units(watts))
+
+    def __len__(self):
+        return len(self.demand)
+
+    def __add__(self, other):
+        return HorizonBid(self.market_basis, self.demand + other.demand)
+
+    def bid(self, interval):
+        return ArrayBid(self.market_basis, self.demand[interval])
+
+    def equilibrium_indices(self):
+        # Price step of the equilibrium of every interval at once, as ArrayBid.equilibrium_price
+        crossing = np.argmax(self.demand <= 0, axis=1)
+        return np.where(self.demand[:, 0] < 0, 0, np.where(self.demand[:, -1] > 0, self.market_basis.price_steps - 1, crossing))
+
+    def equilibrium_prices(self):
+        return tuple(self.market_basis.price(i) for i in self.equilibrium_indices())
+
+    def find_quantities(self, price_indices):
+        # Quantity of every interval at its price step (e.g. equilibrium_indices), as ArrayBid.find_quantity
+        return tuple(self.market_basis.from_units(units) for units in self.demand[np.arange(len(self.demand)), price_indices])
+
+
+class ArrayBidAggregate(object):
+    """ Running sum of bids on a market basis, same interface as powermatcher.BidAggregate """
+
+    def __init__(self, auctioneer, market_basis, bids=()):
+        self.auctioneer = auctioneer
+        self.market_basis = market_basis
+        self.reset(bids)
+
+    def reset(self, bids=()):
+        self.demand = np.zeros(self.market_basis.price_steps, dtype=np.int64)
+
+        for bid in bids:
+            self.add(bid)
+
+    def add(self, bid):
+        self.demand += ArrayBid.from_bid(self.market_basis, bid).demand
+
+    def remove(self, bid):
+        self.demand -= ArrayBid.from_bid(self.market_basis, bid).demand
+
+    def replace(self, old_bid, new_bid):
+        self.demand += ArrayBid.from_bid(self.market_basis, new_bid).demand - ArrayBid.from_bid(self.market_basis, old_bid).demand
+
+    def recompute(self, bids):
+        bid_sum = ArrayBid(self.market_basis)
+        for b in bids:
+            bid_sum += ArrayBid.from_bid(self.market_basis, b)
+        return bid_sum
+
+    def equilibrium_price(self):
+        return ArrayBid(self.market_basis, self.demand).equilibrium_price()
+
+    def bidding_ladder(self):
+        return ArrayBid(self.market_basis, self.demand.copy())
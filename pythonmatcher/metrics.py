@@ -0,0 +1,124 @@
+# Instrumentation of the hot paths: counters, distributions and phase timers
+#
+# Switched off by default (METRICS_ENABLED, read at import; a run of an environment whose context has it set switches
+# metrics on for the process). Instrumented code checks metrics.enabled before it measures anything, so a
+# disabled layer costs one attribute lookup per call site. Counters only add up, distributions (observe) keep the count,
+# total and maximum of the observed values. Timers are distributions of durations, named '<phase>.seconds'.
+#
+# At the end of a run the environment logs a summary and exports all metrics to the telemetry sink as measurement
+# 'metrics'. A Profiler runs cProfile on a sample of the ticks (PROFILE_SAMPLE_INTERVAL).
+
+import time
+import settings as default_settings
+
+enabled = default_settings.metrics_enabled
+clock = time.perf_counter
+
+counters = {}
+stats = {} # name -> [count, total, max]
+
+_clearings = 0 # Number of clearings at the end of the previous tick
+_state_update_names = {} # Agent type -> name of its timer
+
+def enable(on=True):
+    global enabled
+    enabled = on
+
+def reset():
+    global _clearings
+    counters.clear()
+    stats.clear()
+    _clearings = 0
+
+def count(name, value=1):
+    counters[name] = counters.get(name, 0) + value
+
+def observe(name, value):
+    stat = stats.get(name)
+    if stat is None:
+        stats[name] = [1, value, value]
+    else:
+        stat[0] += 1
+        stat[1] += value
+        if value > stat[2]:
+            stat[2] = value
+
+def timed_state_updates(agents):
+    # handle_state_update of the agents, timed per agent type
+    for agent in agents:
+        agent_type = type(agent)
+        name = _state_update_names.get(agent_type)
+        if name is None:
+            name = _state_update_names[agent_type] = 'agent.{}.handle_state_update.seconds'.format(agent_type.__name__)
+
+        start = clock()
+        agent.handle_state_update()
+        observe(name, clock() - start)
+
+def end_tick(queue_depth):
+    # Called by the environment after every tick, with the number of points waiting to be written
+    global _clearings
+    clearings = counters.get('auctioneer.clearings', 0)
+    observe('environment.clearings_per_tick', clearings - _clearings)
+    _clearings = clearings
+
+    observe('influx.queue_depth', queue_depth)
+    count('environment.ticks')
+
+def summary():
+    lines = ["{:<60} {:>12}".format('counter', 'value')]
+    lines += ["{:<60} {:>12}".format(name, value) for name, value in sorted(counters.items())]
+    lines.append("{:<60} {:>12} {:>12} {:>12} {:>12}".format('distribution', 'count', 'mean', 'max', 'total'))
+    lines += ["{:<60} {:>12} {:>12.6g} {:>12.6g} {:>12.6g}".format(name, n, total / n, maximum, total)
+              for name, (n, total, maximum) in sorted(stats.items())]
+    return '\n'.join(lines)
+
+def export(timestamp, database=None, settings=None):
+    # Write all metrics to the telemetry sink (or InfluxDB), with settings of a runtime context (default the module)
+    import influx # Imported here, influx is instrumented itself
+    settings = settings or default_settings
+    database = database or settings.influxdb_database
+
+    for name, value in sorted(counters.items()):
+        influx.write_point("metrics", {"metric": name}, {'value': value}, timestamp, database, settings)
+    for name, (n, total, maximum) in sorted(stats.items()):
+        influx.write_point("metrics", {"metric": name}, {'count': n, 'mean': total / n, 'max': maximum, 'total': total},
+                           timestamp, database, settings)
+
+
+class Profiler(object):
+    """ cProfile of every sample_interval-th tick of a run """
+
+    def __init__(self, sample_interval=1):
+        import cProfile # Imported here, like pstats, only needed when profiling
+        self.sample_interval = sample_interval
+        self.profile = cProfile.Profile()
+        self.ticks = 0
+        self.sampled_ticks = 0
+        self._sampling = False
+
+    def start_tick(self):
+        self._sampling = self.ticks % self.sample_interval == 0
+        if self._sampling:
+            self.profile.enable()
+
+    def end_tick(self):
+        if self._sampling:
+            self.profile.disable()
+            self.sampled_ticks += 1
+        self.ticks += 1
+
+    def summary(self, limit=25):
+        if not self.sampled_ticks:
+            return "No ticks sampled"
+
+        import io
+        import pstats
+        stream = io.StringIO()
+        stream.write("Profile of {} out of {} ticks\n".format(self.sampled_ticks, self.ticks))
+        pstats.Stats(self.profile, stream=stream).sort_stats('cumulative').print_stats(limit)
+        return stream.getvalue()
+
+    def dump(self, path):
+        # Stats for analysis with pstats or a viewer (e.g. snakeviz)
+        self.profile.dump_stats(path)
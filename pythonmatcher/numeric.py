@@ -0,0 +1,114 @@
+# Numeric backends for prices and quantities in bids
+#
+# An auctioneer has one backend, used by its bids and agents. The decimal backend represents prices and quantities as
+# Decimal (exact, for audits). The fixed point backend uses plain ints: quantities in units of quantity_resolution watt
+# (default mW) and prices in ticks of price_resolution, which is several times faster in aggregation and clearing.
+#
+# The conversion functions take values in watt and currency, of any number type (an int price of 1000 is 1000, not
+# 1000 ticks). A price of the backend is passed on to another constructor taking currency (e.g. the min_price of a parent
+# auctioneer) with price_to_decimal, which converts it back exactly.
+
+from decimal import Decimal
+import decimal
+import settings as default_settings
+
+class DecimalBackend(object):
+    """ Prices and quantities as Decimal """
+
+    name = 'decimal'
+    number_type = Decimal
+    zero = Decimal(0)
+
+    def quantity(self, value):
+        return value if isinstance(value, Decimal) else Decimal(value)
+
+    def price(self, value):
+        return value if isinstance(value, Decimal) else Decimal(value)
+
+    def ratio(self, value):
+        # Dimensionless factor that can be passed to scale
+        return Decimal(value)
+
+    def scale(self, value, ratio):
+        return value * ratio
+
+    def divide(self, value, divisor):
+        return value / divisor
+
+    def ceiling_divide(self, value, divisor):
+        # Division rounded up instead of to nearest
+        context = decimal.getcontext().copy()
+        context.rounding = decimal.ROUND_CEILING
+        return context.divide(value, divisor)
+
+    def quantity_from_float(self, value):
+        return Decimal(float(value))
+
+    def quantity_to_float(self, quantity):
+        return float(quantity)
+
+    def price_to_float(self, price):
+        return float(price)
+
+    def price_to_decimal(self, price):
+        # Price in currency, price(price_to_decimal(p)) == p
+        return price
+
+
+class FixedPointBackend(object):
+    """ Quantities as int multiples of quantity_resolution watt, prices as int multiples of price_resolution """
+
+    name = 'fixed'
+    number_type = int
+    zero = 0
+
+    def __init__(self, quantity_resolution=Decimal('0.001'), price_resolution=Decimal('0.01')):
+        self.quantity_resolution = quantity_resolution
+        self.price_resolution = price_resolution
+
+        self._quantity_resolution = float(quantity_resolution)
+        self._price_resolution = float(price_resolution)
+
+    def quantity(self, value):
+        return int((Decimal(value) / self.quantity_resolution).to_integral_value())
+
+    def price(self, value):
+        return int((Decimal(value) / self.price_resolution).to_integral_value())
+
+    def ratio(self, value):
+        return float(value)
+
+    def scale(self, value, ratio):
+        return int(round(value * ratio))
+
+    def divide(self, value, divisor):
+        return value // divisor
+
+    def ceiling_divide(self, value, divisor):
+        return -(-value // divisor)
+
+    def quantity_from_float(self, value):
+        return int(round(value / self._quantity_resolution))
+
+    def quantity_to_float(self, quantity):
+        return quantity * self._quantity_resolution
+
+    def price_to_float(self, price):
+        return price * self._price_resolution
+
+    def price_to_decimal(self, price):
+        # Price in currency, exact so that price(price_to_decimal(p)) == p
+        return price * self.price_resolution
+
+
+backends = {
+    DecimalBackend.name: DecimalBackend(),
+    FixedPointBackend.name: FixedPointBackend()
+}
+
+def get_backend(backend=None, settings=None):
+    # Backend by name (or a backend instance itself), defaults to the numeric_backend of settings (a runtime context's
+    # settings, default the settings module)
+    if backend is None or isinstance(backend, str):
+        return backends[backend or (settings or default_settings).numeric_backend]
+    return backend
@@ -1,20 +1,50 @@
 from decimal import Decimal
-from ext import environment
+import bisect
+import collections
+import decimal
+import heapq
+import numbers
+import random
 import uuid
 import logging
-import influx
+import bidtrace
+import metrics
+import numeric
+import runtime
 import settings
 
 logger = logging.getLogger(settings.app_name + '.' + __name__)
 
+# Bids are aggregated in a context wide enough to make addition and subtraction exact. With the default 28 digits the
+# rounding of a sum depends on the order of the terms, so an incrementally updated aggregate could drift from a sum
+# computed from scratch.
+aggregation_context = decimal.Context(prec=100)
+
 class InvalidBidException(Exception):
     pass
 
+class AggregateMismatchException(Exception):
+    pass
+
+_set = object.__setattr__ # Sets attributes of immutable objects while constructing them
+
 class Bid(object):
+    """ Immutable bidding ladder. Bids with a single quantity are created as FlatBid """
 
     # Positive quantities indicate amount of production
     # quantity[0] is production at min_price
 
+    # Without a __dict__ per bid. The hash and equilibrium price are computed once, when first needed (e.g. by a
+    # BidCache), until then _hash and _equilibrium are not set
+    __slots__ = ('auctioneer', 'quantities', 'prices', '_hash', '_equilibrium')
+
+    def __new__(cls, auctioneer=None, quantities=(), prices=()):
+        if prices or cls is not Bid:
+            return object.__new__(cls)
+        if not quantities or isinstance(quantities, numbers.Number) or len(quantities) == 1:
+            return object.__new__(FlatBid)
+        return object.__new__(cls)
+
     def __init__(self, auctioneer, quantities=(), prices=()):
         """Creates a bid curve based on supplied quantities and prices"""
 
@@ -23,54 +53,80 @@ class Bid(object):
         # - Following price/quantity pairs give new points on the ladder. The quantity extends until the next price
         # - Positive quantities indicate consumption
         # - prices and quantities are a tuple
-        #  - if quantity is a Decimal instead of tuple, it is assumed to be the consumption at min_price
+        #  - if quantity is a number instead of tuple, it is assumed to be the consumption at min_price
+        # - prices and quantities are of the number type of the numeric backend of the auctioneer (see numeric.py)
 
-        self.auctioneer = auctioneer
+        quantities = tuple(quantities)
+        prices = tuple(prices)
+        Bid._validate(auctioneer, quantities, prices)
 
-        # Construct an empty bid (0 consumption) in case of no parameters
-        if not (prices or quantities):
-            quantities = (Decimal(0),)
+        _set(self, 'auctioneer', auctioneer)
+        _set(self, 'quantities', quantities)
+        _set(self, 'prices', prices)
 
-        # Convert quantities to a tuple in case there is one number. e.g. Bid(Decimal(2000)) represents a load of 2kW
-        if isinstance(quantities, Decimal):
-            quantities = (quantities,)
+    @staticmethod
+    def _validate(auctioneer, quantities, prices):
+        # Raises InvalidBidException when the tuples are not a valid bidding ladder of the auctioneer
+        number_type = auctioneer.numeric.number_type
 
         # Needs one more quantity than price, to determine the consumption at minimal price
-        if len(quantities) == len(prices) + 1:
-            self.quantities = tuple(quantities)
-            self.prices = tuple(prices)
-        else:
+        if len(quantities) != len(prices) + 1:
             raise InvalidBidException("Invalid number of prices / quantities")
 
         # Sanity checks
-        if any(price <= auctioneer.min_price or price > auctioneer.max_price for price in self.prices):
-            raise InvalidBidException("Invalid prices, should be between min_price and max_price")
+        if any(p > next_p for p, next_p in zip(prices, prices[1:])):
+            raise InvalidBidException("Prices should be increasing")
 
-        for p_i in range(len(prices)-1):
-            if self.prices[p_i] > self.prices[p_i+1]:
-                raise InvalidBidException("Prices should be increasing")
+        # Increasing prices are within the range when the first and last are
+        if prices and (prices[0] <= auctioneer.min_price or prices[-1] > auctioneer.max_price):
+            raise InvalidBidException("Invalid prices, should be between min_price and max_price")
 
-        if any(self.quantities[q_i] < self.quantities[q_i+1] for q_i in range(len(self.quantities)-1)):
+        if any(q < next_q for q, next_q in zip(quantities, quantities[1:])):
             raise InvalidBidException("Quantities should be strictly decreasing")
 
-        if not all(isinstance(price, Decimal) for price in self.prices):
-            raise InvalidBidException("Not all prices are of type Decimal")
+        if not all(isinstance(price, number_type) for price in prices):
+            raise InvalidBidException("Not all prices are of type {}".format(number_type.__name__))
+
+        if not all(isinstance(quantity, number_type) for quantity in quantities):
+            raise InvalidBidException("Not all quantities are of type {}".format(number_type.__name__))
+
+    @classmethod
+    def _create(cls, auctioneer, quantities, prices):
+        # Bid from tuples that are known to be valid (e.g. the result of adding valid bids), without the checks of __init__
+        bid = object.__new__(Bid if prices else FlatBid)
+        _set(bid, 'auctioneer', auctioneer)
+        _set(bid, 'quantities', quantities)
+        _set(bid, 'prices', prices)
+        return bid
 
-        if not all(isinstance(quantity, Decimal) for quantity in self.quantities):
-            raise InvalidBidException("Not all quantities are of type Decimal")
+    def __setattr__(self, name, value):
+        raise AttributeError("Bids are immutable")
+
+    def __reduce__(self):
+        return Bid._create, (self.auctioneer, self.quantities, self.prices)
 
     def __str__(self):
         # Prints bidding ladder as total quantity_1@min_price quantity_2@price_1 etc
 
-        s = '{:.2f}@{:.2f}'.format(self.quantities[0], self.auctioneer.min_price)
-        s = s + ''.join(' {:.2f}@{:.2f}'.format(q, p) for p, q in zip(self.prices, self.quantities[1:]))
+        n = self.auctioneer.numeric
+        s = '{:.2f}@{:.2f}'.format(n.quantity_to_float(self.quantities[0]), n.price_to_float(self.auctioneer.min_price))
+        s = s + ''.join(' {:.2f}@{:.2f}'.format(n.quantity_to_float(q), n.price_to_float(p)) for p, q in zip(self.prices, self.quantities[1:]))
         return s
 
     def __eq__(self, other):
         # Checks if self and other are equals bidding ladders, which is true when prices and quantities are the same
-        return self.prices == other.prices and self.quantities == other.quantities
+        return self is other or (self.quantities == other.quantities and self.prices == other.prices)
+
+    def __hash__(self):
+        try:
+            return self._hash
+        except AttributeError:
+            _set(self, '_hash', hash((self.quantities, self.prices)))
+            return self._hash
 
     def __add__(self, other):
+        if isinstance(other, FlatBid):
+            return other + self
 
         def price_quantity_gen():
             # Generator function that return next price, quantity point from adding the two bidcurves
@@ -114,121 +170,635 @@ class Bid(object):
                     self_i += 1
                     other_i += 1
 
-        new_prices, new_quantities = zip(*price_quantity_gen())
+        with decimal.localcontext(aggregation_context):
+            new_prices, new_quantities = zip(*price_quantity_gen())
         new_prices = new_prices[1:] # Remove first None value
 
-        return Bid(self.auctioneer, new_quantities, new_prices)
+        return Bid._create(self.auctioneer, new_quantities, new_prices)
+
+    @classmethod
+    def sum(cls, bids, auctioneer=None):
+        # Add many bids in one k-way merge over their price points. Equal to adding them one by one, but without
+        # constructing (and validating) an intermediate Bid per addition. Only the result is validated
+
+        bids = list(bids)
+        if auctioneer is None:
+            if not bids:
+                raise ValueError("Bid.sum of no bids needs an auctioneer")
+            auctioneer = bids[0].auctioneer
+
+        def price_drop_gen(bid):
+            # Yields every price point of the bid with the decrease in quantity at that price
+            quantities = bid.quantities
+            for p_i, price in enumerate(bid.prices):
+                yield price, quantities[p_i] - quantities[p_i + 1]
+
+        with decimal.localcontext(aggregation_context):
+            quantity = auctioneer.numeric.zero
+            for bid in bids:
+                quantity += bid.quantities[0]
+
+            quantities = [quantity]
+            prices = []
+            for price, drop in heapq.merge(*(price_drop_gen(bid) for bid in bids)):
+                quantity -= drop
+                if prices and prices[-1] == price:
+                    quantities[-1] = quantity
+                else:
+                    prices.append(price)
+                    quantities.append(quantity)
+
+        quantities, prices = tuple(quantities), tuple(prices)
+        Bid._validate(auctioneer, quantities, prices)
+        return Bid._create(auctioneer, quantities, prices)
+
+    def simplify(self, max_points=None, tolerance=None):
+        # Bid with fewer price points. The price range is divided into buckets of width tolerance (or the width that
+        # gives at most max_points buckets, if that is larger) and the quantity steps of all price points in a bucket
+        # are moved to the highest price point of the bucket. No step moves by the width or more, and the quantities are
+        # a subset of the original ones, so the bid stays decreasing. Its equilibrium price is at or above the one of
+        # this bid, by less than the width.
+
+        n = self.auctioneer.numeric
+        width = tolerance or n.zero
+        if max_points and len(self.prices) > max_points:
+            width = max(width, n.ceiling_divide(self.auctioneer.max_price - self.auctioneer.min_price, max_points))
+        if not width:
+            return self
+
+        kept = [] # Index of the last price point of every bucket
+        previous_bucket = None
+        for p_i, price in enumerate(self.prices):
+            # Buckets include their upper bound, like bids cover (min_price, max_price]
+            bucket, remainder = divmod(price - self.auctioneer.min_price, width)
+            if not remainder:
+                bucket -= 1
+
+            if bucket == previous_bucket:
+                kept[-1] = p_i
+            else:
+                kept.append(p_i)
+                previous_bucket = bucket
+
+        if len(kept) == len(self.prices):
+            return self
+
+        return Bid._create(self.auctioneer, (self.quantities[0],) + tuple(self.quantities[p_i + 1] for p_i in kept),
+                           tuple(self.prices[p_i] for p_i in kept))
 
     def equilibrium_price(self):
         # Return price at which production is equal to consumption
+        try:
+            return self._equilibrium
+        except AttributeError:
+            pass
 
-        if len(self.quantities) == 1:
-            # Flat bidcurve
-            if self.quantities[0] < 0:
-                # Production at any price
-                return self.auctioneer.min_price
-            elif self.quantities[0] > 0:
-                # Consumption at any price
-                return self.auctioneer.max_price
-
-        if self.quantities[0] < 0:
-            # Production at any price
-            return self.auctioneer.min_price
+        if self.quantities[0] <= 0:
+            # Production at any price, or nothing at min_price already (as FlatBid and ArrayBid)
+            price = self.auctioneer.min_price
         elif self.quantities[-1] > 0:
             # Consumption at any price
-            return self.auctioneer.max_price
+            price = self.auctioneer.max_price
+        else:
+            # Price at which the quantity crosses through zero, found by binary search on the decreasing quantities
+            low, high = 0, len(self.quantities) - 1 # quantities[low] > 0 and quantities[high] <= 0
+            while high - low > 1:
+                middle = (low + high) // 2
+                if self.quantities[middle] > 0:
+                    low = middle
+                else:
+                    high = middle
+            price = self.prices[high - 1]
+
+        _set(self, '_equilibrium', price)
+        return price
+
+    def find_quantity(self, price):
+        # Find which consumption agrees with specified price: the quantity after the last price point at or below price
+        return self.quantities[bisect.bisect_right(self.prices, price)]
+
+    def find_quantities(self, prices):
+        # find_quantity for many prices (e.g. for a price-duration curve), as a list
+        quantities = self.quantities
+        ladder_prices = self.prices
+        return [quantities[bisect.bisect_right(ladder_prices, price)] for price in prices]
+
+class FlatBid(Bid):
+    """ Bid with the same quantity at every price, with constant time equilibrium, lookup and addition of flat bids """
+
+    __slots__ = ()
+
+    def __init__(self, auctioneer, quantities=(), prices=()):
+        # Bid(auctioneer) is the empty bid (0 consumption). Bid(auctioneer, Decimal(2000)) represents a load of 2kW
+        number_type = auctioneer.numeric.number_type
+        if isinstance(quantities, numbers.Number):
+            quantity = quantities
+        elif quantities:
+            quantity = quantities[0]
         else:
-            # Return price at which crossing through zero quantity occurred
+            quantity = auctioneer.numeric.zero
 
-            q_i = next(q_i for q_i, quantity in enumerate(self.quantities) if quantity <= 0)
+        if not isinstance(quantity, number_type):
+            raise InvalidBidException("Not all quantities are of type {}".format(number_type.__name__))
 
-            return self.prices[q_i-1]
+        _set(self, 'auctioneer', auctioneer)
+        _set(self, 'quantities', (quantity,))
+        _set(self, 'prices', ())
 
-            # prices_with_boundaries = (self.auctioneer.min_price,) + self.prices + (self.auctioneer.max_price,)
-            # for q_i, quantity in enumerate(self.quantities[1:]):
-            #     if quantity < 0:
-            #         # This is the point where shift from + to - occured, return midpoint
-            #         return (prices_with_boundaries[q_i+1] + prices_with_boundaries[q_i])/2
+    def __add__(self, other):
+        # Adding a flat bid shifts the quantities of the other bid, its price points stay the same
+        with decimal.localcontext(aggregation_context):
+            if isinstance(other, FlatBid):
+                return Bid._create(self.auctioneer, (self.quantities[0] + other.quantities[0],), ())
+            quantity = self.quantities[0]
+            return Bid._create(self.auctioneer, tuple(quantity + q for q in other.quantities), other.prices)
 
+    def equilibrium_price(self):
+        # At zero quantity every price is an equilibrium, the lowest is taken (as ArrayBid.equilibrium_price)
+        if self.quantities[0] > 0:
+            return self.auctioneer.max_price
+        return self.auctioneer.min_price
 
     def find_quantity(self, price):
-        # Find which consumption agrees with specified price
+        return self.quantities[0]
+
+    def find_quantities(self, prices):
+        return [self.quantities[0]] * len(prices)
+
+
+class BidCache(object):
+    """ Bounded cache of bids, giving equal bids one shared instance. Evicts the least recently used bid """
+
+    def __init__(self, size):
+        self.size = size
+        self.bids = collections.OrderedDict()
+
+    def intern(self, bid):
+        cached = self.bids.get(bid)
+        if cached is not None:
+            self.bids.move_to_end(bid)
+            return cached
+
+        self.bids[bid] = bid
+        if len(self.bids) > self.size:
+            self.bids.popitem(last=False)
+        return bid
 
-        for p_i, p in enumerate(self.prices):
-            if price < p:
-                # First price which is smaller than p, return previous quantity (equals p_i since q_i is 1 longer)
-                return self.quantities[p_i]
 
-        # Didn't find one smaller, so it must be the last quantity
-        return self.quantities[-1]
+class BidAggregate(object):
+    """ Running sum of a set of bids, updated with the difference whenever a single bid changes """
+
+    # The aggregate is stored as the quantity at min_price and, for every price point, the drop in quantity at that
+    # price. Adding or removing a bid then only touches the price points of that bid. For every price point the number of
+    # bids having a breakpoint there is counted, so a price point disappears exactly when the last bid using it is gone
+    # (the result is the same bidding ladder as adding all bids one by one).
+
+    def __init__(self, auctioneer, bids=()):
+        self.auctioneer = auctioneer
+        self.reset(bids)
+
+    def reset(self, bids=()):
+        # Rebuild the aggregate in a single pass over all bids (cold start or resync)
+        self.base_quantity = self.auctioneer.numeric.zero
+        self.steps = {} # price -> [quantity drop at price, number of bids with breakpoint at price]
+        self._bidding_ladder = None
+
+        with decimal.localcontext(aggregation_context):
+            for bid in bids:
+                self.base_quantity += bid.quantities[0]
+                for p_i, price in enumerate(bid.prices):
+                    step = self.steps.setdefault(price, [self.auctioneer.numeric.zero, 0])
+                    step[0] += bid.quantities[p_i] - bid.quantities[p_i + 1]
+                    step[1] += 1
+
+        self.prices = sorted(self.steps) # Sorted prices of self.steps
+
+    def add(self, bid):
+        self._apply(bid, 1)
+
+    def remove(self, bid):
+        self._apply(bid, -1)
+
+    def replace(self, old_bid, new_bid):
+        self._apply(old_bid, -1)
+        self._apply(new_bid, 1)
+
+    def _apply(self, bid, sign):
+        with decimal.localcontext(aggregation_context):
+            if sign > 0:
+                self.base_quantity += bid.quantities[0]
+            else:
+                self.base_quantity -= bid.quantities[0]
+
+            for p_i, price in enumerate(bid.prices):
+                drop = bid.quantities[p_i] - bid.quantities[p_i + 1]
+                step = self.steps.get(price)
+
+                if step is None:
+                    if sign < 0:
+                        raise AggregateMismatchException("Removing bid with price {} not in aggregate".format(price))
+                    self.steps[price] = [drop, 1]
+                    bisect.insort(self.prices, price)
+                elif sign > 0:
+                    step[0] += drop
+                    step[1] += 1
+                else:
+                    step[0] -= drop
+                    step[1] -= 1
+                    if step[1] == 0:
+                        del self.steps[price]
+                        del self.prices[bisect.bisect_left(self.prices, price)]
+
+        self._bidding_ladder = None
+
+    def recompute(self, bids):
+        # Sum of bids computed from scratch, used to verify the running aggregate
+        return Bid.sum(bids, self.auctioneer)
+
+    def equilibrium_price(self):
+        return self.bidding_ladder().equilibrium_price()
+
+    def bidding_ladder(self):
+        # Construct the (cached) Bid of the aggregate
+        if self._bidding_ladder is None:
+            quantities = [self.base_quantity]
+            with decimal.localcontext(aggregation_context):
+                for price in self.prices:
+                    quantities.append(quantities[-1] - self.steps[price][0])
+
+            self._bidding_ladder = Bid._create(self.auctioneer, tuple(quantities), tuple(self.prices))
+
+        return self._bidding_ladder
+
+
+class BreakpointIndex(object):
+    """ Agents indexed by the prices of the breakpoints of their bids """
+
+    # The runlevel of an agent following its bid (see Bid.find_quantity) only changes when the price passes one of the
+    # breakpoints of the bid. Like BidAggregate, the index keeps a dict with the agents for every price and a sorted list
+    # of the prices, so the agents with a breakpoint in a price range are found in time proportional to their number.
+
+    def __init__(self, bids=None):
+        self.reset(bids or {})
+
+    def reset(self, bids):
+        # Rebuild from a dict agent -> bid
+        self.agents = {} # price -> set of agents with a breakpoint at price
+        for agent, bid in bids.items():
+            for price in bid.prices:
+                self.agents.setdefault(price, set()).add(agent)
+        self.prices = sorted(self.agents)
+
+    def add(self, agent, bid):
+        for price in bid.prices:
+            agents = self.agents.get(price)
+            if agents is None:
+                self.agents[price] = {agent}
+                bisect.insort(self.prices, price)
+            else:
+                agents.add(agent)
+
+    def remove(self, agent, bid):
+        for price in bid.prices:
+            agents = self.agents.get(price)
+            if agents is not None:
+                agents.discard(agent)
+                if not agents:
+                    del self.agents[price]
+                    del self.prices[bisect.bisect_left(self.prices, price)]
+
+    def replace(self, agent, old_bid, new_bid):
+        if old_bid.prices != new_bid.prices:
+            self.remove(agent, old_bid)
+            self.add(agent, new_bid)
+
+    def agents_between(self, price, other_price):
+        # Agents with a breakpoint in (lowest price, highest price], whose runlevel may differ between the prices
+        low, high = min(price, other_price), max(price, other_price)
+        agents = set()
+        for p_i in range(bisect.bisect_right(self.prices, low), bisect.bisect_right(self.prices, high)):
+            agents.update(self.agents[self.prices[p_i]])
+        return agents
+
 
 class Auctioneer(object):
 
-    def __init__(self, id=None, min_price=Decimal(0), max_price=Decimal(1000)):
+    def __init__(self, id=None, min_price=Decimal(0), max_price=Decimal(1000), verify_aggregate=None, price_steps=None,
+                 batch_clearing=None, max_rebid_rounds=None, numeric_backend=None, max_ladder_points=None, price_tolerance=None,
+                 bid_cache_size=None, context=None):
         self.agents = []
         self.bids = {}
-        self.price = (max_price + min_price) / 2
 
         if not id:
             id = uuid.uuid4()
         self.id = id
 
-        self.min_price = min_price
-        self.max_price = max_price
+        # Environment, telemetry and settings of the simulation (see runtime.py), shared with the agents. Defaults of
+        # the arguments below are taken from its settings
+        self.context = context or runtime.default_context()
+        settings = self.context.settings
+
+        # Representation of prices and quantities in bids, see numeric.py
+        self.numeric = numeric.get_backend(numeric_backend, settings)
+
+        self.min_price = self.numeric.price(min_price)
+        self.max_price = self.numeric.price(max_price)
+        self.price = self.numeric.divide(self.max_price + self.min_price, 2)
+
+        # Verification mode checks the running aggregate against a full recompute on every bid update (slow)
+        if verify_aggregate is None:
+            verify_aggregate = settings.auctioneer_verify_aggregate
+        self.verify_aggregate = verify_aggregate
+
+        # Batched clearing mode collects the bids of a tick and clears once at the end of the tick (see end_tick)
+        if batch_clearing is None:
+            batch_clearing = settings.auctioneer_batch_clearing
+        if max_rebid_rounds is None:
+            max_rebid_rounds = settings.auctioneer_max_rebid_rounds
+        self.batch_clearing = batch_clearing
+        self.max_rebid_rounds = max_rebid_rounds
+        self.bids_changed = False
+
+        # Aggregated bids sent upstream (by concentrators and shards) are simplified to at most max_ladder_points price
+        # points and/or within price_tolerance (see Bid.simplify), 0 is off. Clearing is done on the exact aggregate
+        if max_ladder_points is None:
+            max_ladder_points = settings.auctioneer_max_ladder_points
+        if price_tolerance is None:
+            price_tolerance = settings.auctioneer_price_tolerance
+        self.max_ladder_points = max_ladder_points
+        self.price_tolerance = self.numeric.price(price_tolerance)
+
+        # Bids of the agents are interned in a BidCache of bid_cache_size bids, 0 is off. Agents repeating the same bid
+        # (idle or full batteries, fixed ladders) then share one instance, which is compared by identity
+        if bid_cache_size is None:
+            bid_cache_size = settings.auctioneer_bid_cache_size
+        self.bid_cache = BidCache(bid_cache_size) if bid_cache_size else None
+
+        # On a price change only agents with a breakpoint between the old and new price are notified, and the agents
+        # that subscribe to every price change (see BaseAgent.price_subscriber). Notifications go in order of registration
+        self.price_index = BreakpointIndex()
+        self.price_subscribers = set()
+        self._agent_order = {}
+        self._registrations = 0
+
+        if price_steps:
+            # Market basis mode: bids are aggregated as demand vectors on a fixed price grid (requires numpy)
+            from marketbasis import MarketBasis
+            self.market_basis = MarketBasis(self.numeric.price_to_decimal(self.min_price), self.numeric.price_to_decimal(self.max_price),
+                                            price_steps, numeric_backend=self.numeric)
+            self.aggregate = self.market_basis.create_aggregate(self)
+        else:
+            self.market_basis = None
+            self.aggregate = BidAggregate(self)
+
+    def clear_horizon(self, bids, price_steps=100):
+        # Clears a horizon of market intervals (e.g. the quarter-hours of a day ahead) in one vectorized pass. bids maps
+        # agents to their bids for every interval, as a marketbasis.HorizonBid or a sequence of Bids. Returns the
+        # equilibrium price of every interval and, per agent, its quantity in every interval. Bids are put on the market
+        # basis of the auctioneer (or one with price_steps), so the result equals clearing the intervals one by one in
+        # market basis mode. The current bids and price of the auctioneer are not changed
+        from marketbasis import HorizonBid, MarketBasis
+        market_basis = self.market_basis or MarketBasis(self.numeric.price_to_decimal(self.min_price),
+                                                        self.numeric.price_to_decimal(self.max_price), price_steps,
+                                                        numeric_backend=self.numeric)
+
+        if not bids:
+            raise ValueError("No bids to clear")
+
+        horizon_bids = {}
+        for agent, bid in bids.items():
+            if not isinstance(bid, HorizonBid):
+                bid = HorizonBid.from_bids(market_basis, bid)
+            elif bid.market_basis is not market_basis:
+                raise ValueError("Horizon bid of agent {} is on another market basis".format(agent.id))
+            horizon_bids[agent] = bid
+
+        if len({len(bid) for bid in horizon_bids.values()}) > 1:
+            raise ValueError("Horizon bids have different numbers of intervals")
+
+        total = sum(bid.demand for bid in horizon_bids.values())
+        indices = HorizonBid(market_basis, total).equilibrium_indices()
+
+        prices = tuple(market_basis.price(i) for i in indices)
+        return prices, {agent: bid.find_quantities(indices) for agent, bid in horizon_bids.items()}
 
     def register_agent(self, agent):
         self.agents.append(agent)
         self.bids[agent] = agent._lastbid
+        self.aggregate.add(agent._lastbid)
+        self.bids_changed = True
+
+        self._agent_order[agent] = self._registrations
+        self._registrations += 1
+        if agent.price_subscriber or not _follows_bid(agent):
+            self.price_subscribers.add(agent)
+        else:
+            self.price_index.add(agent, agent._lastbid)
+
+        if bidtrace.recorder is not None:
+            bidtrace.recorder.register(self, agent)
 
         agent.handle_price_update() # Provide agent with initial price
 
     def unregister_agent(self, agent):
         self.agents.remove(agent)
-        self.bids.pop(agent)
+        bid = self.bids.pop(agent)
+        self.aggregate.remove(bid)
+        self.bids_changed = True
+
+        del self._agent_order[agent]
+        if agent in self.price_subscribers:
+            self.price_subscribers.remove(agent)
+        else:
+            self.price_index.remove(agent, bid)
+
+        if bidtrace.recorder is not None:
+            bidtrace.recorder.unregister(self, agent)
 
     def handle_bid_update(self, agent, bid):
-        logger.debug("Got new bid from {} with bid {}".format(type(agent).__name__, bid))
+        # Bid is only formatted when debug logging is on
+        logger.debug("Got new bid from %s with bid %s", type(agent).__name__, bid)
+
+        if bidtrace.recorder is not None:
+            bidtrace.recorder.bid(self, agent, bid)
+
+        if metrics.enabled:
+            start = metrics.clock()
+
+        self.aggregate.replace(self.bids[agent], bid)
+        if agent not in self.price_subscribers:
+            self.price_index.replace(agent, self.bids[agent], bid)
         self.bids[agent] = bid
 
-        bidding_ladder = self.get_bidding_ladder()
-        logger.debug("Total bidding ladder is now {}".format(bidding_ladder))
-        new_price = bidding_ladder.equilibrium_price()
-
-        if new_price != self.price:
-            self.price = new_price
-
-            logging.debug("New auctioneer price: {}".format(self.price))
-
-            points = [
-                {
-                    "measurement": "auctioneer_prices",
-                    "tags": {
-                        "auctioneer_id": self.id
-                    },
-                    "fields": {
-                        'price': float(self.price)
-                    },
-                    "time": environment.current_time
-                }
-            ]
-            influx.write_points(points, settings.influxdb_database)
-
-            for agent in self.agents:
-                agent.handle_price_update() # Trigger an update in state due to new available price
+        if metrics.enabled:
+            metrics.observe('auctioneer.aggregate.seconds', metrics.clock() - start)
+        self.bids_changed = True
 
-            pass
+        if not self.batch_clearing:
+            # Clear the market immediately on every bid
+            self.clear()
+
+    def end_tick(self):
+        # Called by the environment after all agents handled their state update
+        if not self.batch_clearing:
+            return
+
+        # Clear once for all bids of this tick. A price change may lead price responsive agents to bid again, which
+        # is cleared in a next round, up to max_rebid_rounds. Bids left after the last round are cleared next tick.
+        for rebid_round in range(self.max_rebid_rounds + 1):
+            if not self.clear():
+                break
+
+            if rebid_round < self.max_rebid_rounds:
+                for agent in self.agents:
+                    if agent.price_responsive:
+                        agent.handle_rebid()
+
+    def clear(self):
+        # Determine the price from the aggregated bids and notify all agents when it changed. Returns True when the
+        # price changed
+        if not self.bids_changed:
+            return False
+        self.bids_changed = False
+
+        if metrics.enabled:
+            start = metrics.clock()
+
+        bidding_ladder = self.get_bidding_ladder()
+        if self.verify_aggregate:
+            self.verify_bidding_ladder()
+
+        logger.debug("Total bidding ladder is now %s", bidding_ladder)
+        new_price = self.aggregate.equilibrium_price()
+
+        if metrics.enabled:
+            metrics.observe('auctioneer.equilibrium.seconds', metrics.clock() - start)
+            # Breakpoints of a Bid, price steps of the ArrayBid of a market basis
+            ladder = bidding_ladder.demand if self.market_basis is not None else bidding_ladder.quantities
+            metrics.observe('auctioneer.ladder_length', len(ladder))
+            metrics.count('auctioneer.clearings')
+
+        if bidtrace.recorder is not None:
+            bidtrace.recorder.clearing(self, new_price)
+
+        if new_price == self.price:
+            return False
+
+        old_price, self.price = self.price, new_price
+
+        logger.debug("New auctioneer price: %s", self.price)
+
+        self.context.write_point("auctioneer_prices", {"auctioneer_id": self.id}, {'price': self.numeric.price_to_float(self.price)})
+
+        self.notify_price_change(old_price)
+        return True
+
+    def notify_price_change(self, old_price):
+        # Trigger an update in state due to the new price, for the agents whose runlevel may change
+        if metrics.enabled:
+            start = metrics.clock()
+
+        agents = self.price_index.agents_between(old_price, self.price)
+        agents.update(self.price_subscribers)
+        agents = sorted(agents, key=self._agent_order.__getitem__)
+
+        # Runlevels of the agents following their bid are found in one sweep, the others handle the price themselves
+        follows = [_follows_bid(agent) for agent in agents]
+        runlevels = iter(self.find_runlevels([agent for agent, f in zip(agents, follows) if f]))
+        for agent, f in zip(agents, follows):
+            if f:
+                agent.current_power = next(runlevels)
+            else:
+                agent.handle_price_update()
+
+        if metrics.enabled:
+            metrics.observe('auctioneer.fanout', len(agents))
+            metrics.observe('auctioneer.fanout.seconds', metrics.clock() - start)
+
+    def find_runlevels(self, agents=None, price=None):
+        # Quantities of the bids of agents (default all) at price (default the current price) as a list, which is the
+        # runlevel of agents following their bid. Agents sharing a bid instance (see BidCache) are evaluated once
+        if agents is None:
+            agents = self.agents
+        if price is None:
+            price = self.price
+
+        found = {} # id of bid -> quantity, the bids stay referenced by the agents
+        quantities = []
+        for agent in agents:
+            bid = agent._lastbid
+            quantity = found.get(id(bid))
+            if quantity is None:
+                quantity = found[id(bid)] = bid.find_quantity(price)
+            quantities.append(quantity)
+        return quantities
 
     def get_bidding_ladder(self):
-        bid_sum = Bid(self)
-        for b in self.bids.values():
-            bid_sum += b
-        return bid_sum
+        # Total bidding ladder of all agents, kept up to date incrementally
+        return self.aggregate.bidding_ladder()
+
+    def get_simplified_bidding_ladder(self):
+        # Total bidding ladder simplified with max_ladder_points and price_tolerance
+        return self.get_bidding_ladder().simplify(self.max_ladder_points, self.price_tolerance)
+
+    def recompute_bidding_ladder(self):
+        # Total bidding ladder computed from scratch by adding all bids
+        return self.aggregate.recompute(self.bids.values())
+
+    def resync_bidding_ladder(self):
+        # Rebuild the running aggregate (and the index of breakpoints) from all current bids
+        self.aggregate.reset(self.bids.values())
+        self.price_index.reset({agent: bid for agent, bid in self.bids.items() if agent not in self.price_subscribers})
+
+    def get_market_state(self):
+        # Price and the state of all agents, as plain picklable values (see BaseAgent.get_state)
+        return {
+            'price': self.price,
+            'bids_changed': self.bids_changed,
+            'agents': [agent.get_state() for agent in self.agents]
+        }
+
+    def set_market_state(self, state):
+        # Restore a state from get_market_state, into the same registered agents
+        self.price = state['price']
+        for agent, agent_state in zip(self.agents, state['agents']):
+            agent.set_state(agent_state)
+            self.bids[agent] = agent._lastbid
+
+        self.bids_changed = state['bids_changed']
+        self.resync_bidding_ladder()
+
+    def verify_bidding_ladder(self):
+        # Check the running aggregate against a full recompute
+        expected = self.recompute_bidding_ladder()
+        actual = self.get_bidding_ladder()
+
+        if actual != expected:
+            # Restore a correct aggregate before signalling the error
+            self.resync_bidding_ladder()
+            raise AggregateMismatchException("Aggregated bidding ladder {} differs from recomputed ladder {}".format(actual, expected))
 
 
 class BaseAgent(object):
 
-    def __init__(self, auctioneer, initial_bid = None, id = None, current_power = Decimal(0)):
+    # Agents whose bid depends on the price. In batched clearing mode they are asked to bid again after a price change
+    price_responsive = False
+
+    # Agents notified of every price change. Others are only notified when the price passes a breakpoint of their bid,
+    # which is enough when the runlevel follows the bid (see do_runlevel_update). Agents that override
+    # handle_price_update or do_runlevel_update are notified of every price change anyway
+    price_subscriber = False
+
+    # Sleeping agents (next_update_time returned None) that want a state update after a price change of their auctioneer
+    wake_on_price_change = False
 
+    def __init__(self, auctioneer, initial_bid = None, id = None, current_power = None):
+
+        self.numeric = auctioneer.numeric
+        self.context = auctioneer.context
+
+        if current_power is None:
+            current_power = self.numeric.zero
         self._current_power = current_power
         self.auctioneer = auctioneer
 
@@ -239,6 +809,10 @@ class BaseAgent(object):
         if not initial_bid:
             initial_bid = Bid(auctioneer) # Create empty bid if not provided
 
+        # Own random generator (seeded from the global one), so results don't depend on the order in which agents are
+        # updated or on the process they run in
+        self.random = random.Random(random.getrandbits(64))
+
         self._lastbid = initial_bid
         auctioneer.register_agent(self)
 
@@ -251,23 +825,29 @@ class BaseAgent(object):
         if current_power != self._current_power:
             self._current_power = current_power
 
-            points = [
-                {
-                    "measurement": "deviceagent_power",
-                    "tags": {
-                        "deviceagent_id": self.id,
-                        "auctioneer_id": self.auctioneer.id
-                    },
-                    "fields": {
-                        'power': float(self.current_power)
-                    },
-                    "time": environment.current_time
-                }
-            ]
-            influx.write_points(points, settings.influxdb_database)
+            self.context.write_point("deviceagent_power", {"deviceagent_id": self.id, "auctioneer_id": self.auctioneer.id},
+                                     {'power': self.numeric.quantity_to_float(self.current_power)})
+
+    def get_state(self):
+        # State of the agent that changes during a simulation, as plain picklable values
+        return {
+            'bid': (self._lastbid.quantities, self._lastbid.prices),
+            'current_power': self._current_power,
+            'random': self.random.getstate()
+        }
+
+    def set_state(self, state):
+        # Restore a state from get_state. When the agent is registered, its auctioneer has to take over the restored
+        # bid (as Auctioneer.set_market_state does)
+        self._lastbid = Bid(self.auctioneer, *state['bid'])
+        self._current_power = state['current_power']
+        self.random.setstate(state['random'])
 
     def do_bid_update(self, bid):
-        if bid != self._lastbid:
+        if self.auctioneer.bid_cache is not None:
+            bid = self.auctioneer.bid_cache.intern(bid)
+
+        if bid is not self._lastbid and bid != self._lastbid:
             self._lastbid = bid
             self.do_runlevel_update()
             self.auctioneer.handle_bid_update(self, bid)
@@ -286,10 +866,126 @@ class BaseAgent(object):
         # In Powermatcher handle_price_update is used. Since the effect of a price update is a potential runlevel update, call the do_runlevel_update
         self.do_runlevel_update()
 
+    def handle_rebid(self):
+        # Called by an auctioneer in batched clearing mode after a price change, for price responsive agents only
+        pass
+
+    def next_update_time(self):
+        # Time at which the agent needs its next handle_state_update when the environment is event driven (see
+        # scheduler.py), or None to sleep. Asked after every state update, the default is the next tick
+        environment = self.context.environment
+        return environment.current_time + environment.simulation_interval
+
     def handle_state_update(self):
         # Called from the environment, whenever a variable is changed. E.g. updated solar forecast or new timestamp
         # Step it should handle:
         # - Calculate new bidding ladder if necessary
         # - Call self.do_bid_update with new bidding ladder
         # - Call self.do_runlevel_update to adjust runlevel to updated bidcurve
-        logger.warning('Agent not overriding handle_state_update function')
\ No newline at end of file
+        logger.warning('Agent not overriding handle_state_update function')
+
+_bid_followers = {} # Agent type -> whether it uses the price handling of BaseAgent
+
+def _follows_bid(agent):
+    # Agents with the default handle_price_update and do_runlevel_update (also not replaced on the agent itself) set
+    # their runlevel to their bid at the price
+    agent_type = type(agent)
+    follows = _bid_followers.get(agent_type)
+    if follows is None:
+        follows = _bid_followers[agent_type] = (agent_type.handle_price_update is BaseAgent.handle_price_update and
+                                                agent_type.do_runlevel_update is BaseAgent.do_runlevel_update)
+    return follows and 'handle_price_update' not in agent.__dict__ and 'do_runlevel_update' not in agent.__dict__
+
+
+class Concentrator(BaseAgent, Auctioneer):
+    """ Aggregates the bids of its children into one bid for a parent auctioneer, and relays prices down """
+
+    # Towards the parent the concentrator is an agent, towards its children an auctioneer. A bid change of a child only
+    # updates the aggregates on the path to the root, so concentrators can be stacked into trees of any size.
+    # With price_steps the aggregated bid is simplified to the price steps of a market basis before it is sent up, and
+    # with max_ladder_points or price_tolerance (default those of the parent) by Bid.simplify.
+
+    # Relays every price to its children
+    price_subscriber = True
+
+    def __init__(self, parent, id=None, verify_aggregate=None, price_steps=None, batch_clearing=None, max_rebid_rounds=None,
+                 max_ladder_points=None, price_tolerance=None, bid_cache_size=None):
+        if batch_clearing is None:
+            batch_clearing = parent.batch_clearing
+        if bid_cache_size is None:
+            bid_cache_size = parent.bid_cache.size if parent.bid_cache else 0
+        if max_ladder_points is None:
+            max_ladder_points = parent.max_ladder_points
+        if price_tolerance is None:
+            price_tolerance = parent.numeric.price_to_decimal(parent.price_tolerance)
+
+        Auctioneer.__init__(self, id=id, min_price=parent.numeric.price_to_decimal(parent.min_price),
+                            max_price=parent.numeric.price_to_decimal(parent.max_price),
+                            verify_aggregate=verify_aggregate, price_steps=price_steps, batch_clearing=batch_clearing,
+                            max_rebid_rounds=max_rebid_rounds, numeric_backend=parent.numeric,
+                            max_ladder_points=max_ladder_points, price_tolerance=price_tolerance, bid_cache_size=bid_cache_size,
+                            context=parent.context)
+        self.price = parent.price
+
+        BaseAgent.__init__(self, parent, id=id)
+
+    @property
+    def price_responsive(self):
+        return any(agent.price_responsive for agent in self.agents)
+
+    def register_agent(self, agent):
+        super(Concentrator, self).register_agent(agent)
+        if not self.batch_clearing:
+            # The aggregate changed without a bid update of a child, send it to the parent as handle_bid_update does
+            self.clear()
+
+    def unregister_agent(self, agent):
+        super(Concentrator, self).unregister_agent(agent)
+        if not self.batch_clearing:
+            self.clear()
+
+    def get_state(self):
+        state = super(Concentrator, self).get_state()
+        state['market'] = self.get_market_state()
+        return state
+
+    def set_state(self, state):
+        super(Concentrator, self).set_state(state)
+        self.set_market_state(state['market'])
+
+    def clear(self):
+        # Instead of determining a price, send the aggregated bid to the parent
+        if not self.bids_changed:
+            return False
+        self.bids_changed = False
+
+        if self.verify_aggregate:
+            self.verify_bidding_ladder()
+
+        bid = self.get_bidding_ladder()
+        if self.market_basis:
+            bid = bid.to_bid(self.auctioneer)
+
+        self.do_bid_update(bid.simplify(self.max_ladder_points, self.price_tolerance))
+        return False
+
+    def handle_price_update(self):
+        # Relay a new price of the parent to the children
+        if self.price != self.auctioneer.price:
+            old_price, self.price = self.price, self.auctioneer.price
+            self.notify_price_change(old_price)
+
+        self.do_runlevel_update()
+
+    def handle_rebid(self):
+        for agent in self.agents:
+            if agent.price_responsive:
+                agent.handle_rebid()
+        self.clear()
+
+    def handle_state_update(self):
+        for agent in self.agents:
+            agent.handle_state_update()
+        self.end_tick()
+
+        self.do_runlevel_update()
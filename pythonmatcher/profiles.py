@@ -0,0 +1,135 @@
+# Measured input profiles (consumption, generation) of many sites, streamed from memory-mapped files
+#
+# A profile is an .npy file with a row per time step and a column per site (power in watt), next to a JSON file with
+# its start time, time step and site names. Rows are stored contiguously, so reading a profile in time order goes through
+# the file sequentially: it is memory-mapped, so only the rows around the current simulation time are paged in,
+# and years of per-minute data for thousands of sites never have to fit in memory. Pages of rows before the current time
+# are released again as the simulation moves on.
+#
+# Agents read the value of their site through a ProfileReader, which resamples the profile to the simulation interval:
+# the mean of the samples starting within a tick when the profile is finer, the sample covering the tick when it is
+# coarser. The reader computes the resampled row of all sites once per tick and shares it between the agents reading
+# the same file, so an agent only does an index lookup.
+
+import datetime
+import json
+import logging
+import mmap
+import numpy as np
+import os
+import settings
+
+logger = logging.getLogger(settings.app_name + '.' + __name__)
+
+def _metadata_path(path):
+    return os.path.splitext(path)[0] + '.json'
+
+def save_profile(path, values, start_time, interval, sites=None):
+    # Write values (time steps x sites, or a single site) to the .npy file path, as a profile starting at start_time
+    # with steps of interval
+    values = np.asarray(values, dtype=np.float32)
+    if values.ndim == 1:
+        values = values[:, None]
+    if sites is None:
+        sites = list(range(values.shape[1]))
+    if len(sites) != values.shape[1]:
+        raise ValueError("Profile has {} columns for {} sites".format(values.shape[1], len(sites)))
+
+    np.save(path, values)
+    with open(_metadata_path(path), 'w') as f:
+        json.dump({'start_time': start_time.isoformat(), 'interval': interval.total_seconds(), 'sites': sites}, f)
+
+
+class Profile(object):
+    """ Memory-mapped profile file, see save_profile """
+
+    release_size = 16 * 1024 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        with open(_metadata_path(path)) as f:
+            metadata = json.load(f)
+        self.start_time = datetime.datetime.fromisoformat(metadata['start_time'])
+        self.interval = datetime.timedelta(seconds=metadata['interval'])
+        self.sites = metadata['sites']
+        self._site_indices = {site: s_i for s_i, site in enumerate(self.sites)}
+
+        # Mapped by the profile itself instead of np.load(mmap_mode=...), so it owns the mmap it releases pages of
+        with open(path, 'rb') as f:
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            if fortran_order or len(shape) != 2:
+                raise ValueError("Profile {} is not a C-ordered array of time steps x sites".format(path))
+            self._offset = f.tell() # Start of the rows in the file
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        self.values = np.frombuffer(self._mmap, dtype=dtype, count=shape[0] * shape[1], offset=self._offset).reshape(shape)
+        self._released = 0 # Bytes at the start of the file released from memory
+
+    def __len__(self):
+        return len(self.values)
+
+    @property
+    def stop_time(self):
+        return self.start_time + len(self) * self.interval
+
+    def index(self, site):
+        # Column of a site, by name or by column number
+        if site in self._site_indices:
+            return self._site_indices[site]
+        if isinstance(site, int) and 0 <= site < len(self.sites):
+            return site
+        raise KeyError("No site {} in profile {}".format(site, self.path))
+
+    def resample(self, time, interval):
+        # Value of all sites in the interval starting at time, as float64 array
+        first = (time - self.start_time) // self.interval
+        stop = max(first + 1, -((self.start_time - time - interval) // self.interval))
+        if first < 0 or stop > len(self):
+            raise ValueError("Time {} is outside profile {} ({} - {})".format(time, self.path, self.start_time, self.stop_time))
+        row = self.values[first:stop].mean(axis=0, dtype=np.float64)
+        self._release(first)
+        return row
+
+    def _release(self, row):
+        # Drop the pages before a row from memory, in steps of at least release_size, when the platform supports it
+        end = self._offset + row * self.values.strides[0]
+        end -= end % mmap.PAGESIZE
+        if end - self._released >= self.release_size and hasattr(mmap, 'MADV_DONTNEED'):
+            self._mmap.madvise(mmap.MADV_DONTNEED, 0, end)
+            self._released = end
+
+
+class ProfileReader(object):
+    """ Resampled values of a profile at the current simulation time, one row of all sites per tick """
+
+    def __init__(self, path):
+        self.profile = Profile(path)
+        self._key = None
+        self._row = None
+
+    def row(self, time, interval):
+        if self._key != (time, interval):
+            self._row = self.profile.resample(time, interval)
+            self._key = (time, interval)
+        return self._row
+
+    def value(self, site_index, time, interval):
+        return float(self.row(time, interval)[site_index])
+
+    def __reduce__(self):
+        # Pickled as its file, checkpoints of agents must not contain the profile data
+        return open_profile, (self.profile.path,)
+
+
+_readers = {}
+
+def open_profile(path):
+    # Shared reader of a profile file, agents of the same file resample each tick only once
+    if path not in _readers:
+        _readers[path] = ProfileReader(path)
+        logger.info("Opened profile %s with %d sites", path, len(_readers[path].profile.sites))
+    return _readers[path]
@@ -0,0 +1,290 @@
+# Real-time market on an asyncio event loop
+#
+# Agents take part through sessions instead of direct method calls: in-process agents use a LocalSession, remote agents
+# connect over WebSocket (autobahn). Bids are submitted at any time; the first bid after a clearing starts a window of
+# clearing_window seconds in which all further bids are collected, after which the market is cleared once and the new
+# price is pushed to all sessions.
+#
+# Pushing a price never waits for a client. A session holds at most the latest price not yet sent: when its client is
+# slow (the transport buffer of a WebSocket is full, or a local client didn't receive its previous message), newer
+# prices replace the pending one and it is sent once the client has caught up.
+#
+# Messages are JSON objects with a type. Prices and quantities are strings with the numbers of the numeric backend of
+# the auctioneer (e.g. "12.5" for decimal, "1250" in price ticks for fixed):
+#   market: {"type": "market", "id": ..., "numeric": ..., "min_price": ..., "max_price": ...}, first message of a session
+#   price:  {"type": "price", "price": ...}
+#   bid:    {"type": "bid", "quantities": [...], "prices": [...]}, sent by agents
+#   error:  {"type": "error", "message": ...}, reply to an invalid message
+
+from autobahn.asyncio.websocket import WebSocketClientFactory, WebSocketClientProtocol, WebSocketServerFactory, WebSocketServerProtocol
+from powermatcher import BaseAgent, Bid, InvalidBidException
+import asyncio
+import collections
+import datetime
+import json
+import logging
+import time
+import uuid
+import settings
+
+logger = logging.getLogger(settings.app_name + '.' + __name__)
+
+class SessionAgent(BaseAgent):
+    """ Stands in for the agent of a session at the auctioneer """
+
+    # Every price is pushed to the session
+    price_subscriber = True
+
+    def __init__(self, auctioneer, session, id=None):
+        self.session = session
+        super(SessionAgent, self).__init__(auctioneer, id=id)
+
+    def handle_price_update(self):
+        # The runlevel is up to the agent at the other end of the session
+        self.session.push_price(self.auctioneer.price)
+
+    def handle_state_update(self):
+        pass
+
+
+class Session(object):
+    """ Connection of one agent with a RealtimeAuctioneer, subclasses implement send """
+
+    def __init__(self, market):
+        self.market = market
+        self.agent = None
+        self.paused = False # Set while the client can't take more messages
+        self._pending_price = None
+
+    def send(self, message):
+        raise NotImplementedError
+
+    def push_price(self, price):
+        self._pending_price = price
+        if not self.paused:
+            self.flush()
+
+    def flush(self):
+        # Send the pending price, if any
+        if self._pending_price is not None:
+            price, self._pending_price = self._pending_price, None
+            self.market.messages_sent += 1
+            self.send({'type': 'price', 'price': str(price)})
+
+
+class LocalSession(Session):
+    """ Session of an in-process agent, which receives its messages with receive """
+
+    def __init__(self, market):
+        super(LocalSession, self).__init__(market)
+        self._messages = collections.deque()
+        self._received = asyncio.Event()
+
+    def send(self, message):
+        # Further prices wait until the agent received this message
+        self._messages.append(message)
+        self.paused = True
+        self._received.set()
+
+    async def receive(self):
+        while not self._messages:
+            self._received.clear()
+            await self._received.wait()
+
+        message = self._messages.popleft()
+        if not self._messages:
+            self.paused = False
+            self.flush()
+        return message
+
+    def submit_bid(self, quantities, prices=()):
+        # Bid with numbers of the numeric backend, raises InvalidBidException
+        self.market.handle_bid(self, quantities, prices)
+
+    def close(self):
+        self.market.close_session(self)
+
+
+class WebSocketSession(Session):
+    """ Session of a remote agent, on a server protocol """
+
+    def __init__(self, market, protocol):
+        super(WebSocketSession, self).__init__(market)
+        self.protocol = protocol
+
+    def send(self, message):
+        self.protocol.sendMessage(json.dumps(message).encode('utf8'))
+
+
+class AgentServerProtocol(WebSocketServerProtocol):
+    """ Server side of the WebSocket of a remote agent """
+
+    session = None
+
+    def onOpen(self):
+        self.session = WebSocketSession(self.factory.market, self)
+        self.factory.market.open_session(self.session)
+
+    def onMessage(self, payload, isBinary):
+        self.factory.market.handle_message(self.session, payload.decode('utf8'))
+
+    def onClose(self, wasClean, code, reason):
+        if self.session is not None:
+            self.factory.market.close_session(self.session)
+            self.session = None
+
+    def pause_writing(self):
+        # Transport buffer is full, keep the latest price until it drained
+        if self.session is not None:
+            self.session.paused = True
+
+    def resume_writing(self):
+        if self.session is not None:
+            self.session.paused = False
+            self.session.flush()
+
+
+class RealtimeAuctioneer(object):
+    """ Runs an Auctioneer for agents connected through sessions, clearing once per window of bids """
+
+    def __init__(self, auctioneer, clearing_window=None):
+        if clearing_window is None:
+            clearing_window = auctioneer.context.settings.realtime_clearing_window
+
+        self.auctioneer = auctioneer
+        self.clearing_window = clearing_window
+        self.sessions = set()
+
+        # Bids are only cleared by the window
+        auctioneer.batch_clearing = True
+        self._clearing = None
+        self._window_start = None
+
+        # Statistics for load testing: latency from the first bid of a window until its price was pushed, and the
+        # duration of the clearing itself (both in seconds)
+        self.clearing_latencies = collections.deque(maxlen=100000)
+        self.clearing_durations = collections.deque(maxlen=100000)
+        self.messages_received = 0
+        self.messages_sent = 0
+
+    def open_session(self, session, id=None):
+        if not id:
+            id = "Session-{}".format(uuid.uuid4())
+
+        self.messages_sent += 1
+        session.send({'type': 'market', 'id': id, 'numeric': self.auctioneer.numeric.name,
+                      'min_price': str(self.auctioneer.min_price), 'max_price': str(self.auctioneer.max_price)})
+
+        # Registering pushes the current price
+        session.agent = SessionAgent(self.auctioneer, session, id=id)
+        self.sessions.add(session)
+        logger.debug("Opened session {}".format(id))
+
+    def close_session(self, session):
+        if session in self.sessions:
+            self.sessions.remove(session)
+            self.auctioneer.unregister_agent(session.agent)
+            self._schedule_clearing()
+            logger.debug("Closed session {}".format(session.agent.id))
+
+    def handle_bid(self, session, quantities, prices=()):
+        self.messages_received += 1
+
+        bid = Bid(self.auctioneer, quantities, prices)
+        agent = session.agent
+        if bid != agent._lastbid:
+            agent._lastbid = bid
+            self.auctioneer.handle_bid_update(agent, bid)
+            self._schedule_clearing()
+
+    def handle_message(self, session, text):
+        # Message of a remote agent, invalid messages are answered with an error
+        try:
+            message = json.loads(text)
+            if message['type'] != 'bid':
+                raise ValueError("Unknown message type {}".format(message['type']))
+
+            number_type = self.auctioneer.numeric.number_type
+            self.handle_bid(session, tuple(number_type(q) for q in message['quantities']),
+                            tuple(number_type(p) for p in message.get('prices', ())))
+        except (InvalidBidException, ArithmeticError, KeyError, TypeError, ValueError) as e:
+            logger.warning("Invalid message from {}: {}".format(session.agent.id, e))
+            self.messages_sent += 1
+            session.send({'type': 'error', 'message': str(e)})
+
+    def _schedule_clearing(self):
+        if self._clearing is None:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                # Outside the event loop (e.g. sessions closed at teardown) the change is cleared in the next window
+                return
+            self._window_start = time.perf_counter()
+            self._clearing = loop.call_later(self.clearing_window, self._clear)
+
+    def _clear(self):
+        self._clearing = None
+        start = time.perf_counter()
+
+        # Telemetry of the auctioneer is written at wall clock time
+        self.auctioneer.context.environment.current_time = datetime.datetime.now()
+        self.auctioneer.clear()
+
+        end = time.perf_counter()
+        self.clearing_durations.append(end - start)
+        self.clearing_latencies.append(end - self._window_start)
+
+    def connect(self, id=None):
+        # New session for an in-process agent
+        session = LocalSession(self)
+        self.open_session(session, id=id)
+        return session
+
+    async def serve(self, host='0.0.0.0', port=None):
+        # Accept remote agents over WebSocket, returns the asyncio server
+        if port is None:
+            port = self.auctioneer.context.settings.realtime_port
+
+        factory = WebSocketServerFactory("ws://{}:{}".format(host, port))
+        factory.protocol = AgentServerProtocol
+        factory.market = self
+
+        server = await asyncio.get_running_loop().create_server(factory, host, port)
+        logger.info("Accepting agents on ws://{}:{}".format(host, port))
+        return server
+
+
+class AgentClientProtocol(WebSocketClientProtocol):
+    """ Client side of the WebSocket of a remote agent, override handle_market and handle_price """
+
+    def onMessage(self, payload, isBinary):
+        message = json.loads(payload.decode('utf8'))
+
+        if message['type'] == 'market':
+            self.handle_market(message)
+        elif message['type'] == 'price':
+            self.handle_price(message['price'])
+        elif message['type'] == 'error':
+            logger.warning("Error from auctioneer: {}".format(message['message']))
+
+    def handle_market(self, message):
+        pass
+
+    def handle_price(self, price):
+        pass
+
+    def submit_bid(self, quantities, prices=()):
+        self.sendMessage(json.dumps({'type': 'bid', 'quantities': [str(q) for q in quantities],
+                                     'prices': [str(p) for p in prices]}).encode('utf8'))
+
+
+async def connect(protocol, host, port=None):
+    # Connect a remote agent with the given AgentClientProtocol subclass, returns the protocol instance
+    if port is None:
+        port = settings.realtime_port
+
+    factory = WebSocketClientFactory("ws://{}:{}".format(host, port))
+    factory.protocol = protocol
+
+    _, instance = await asyncio.get_running_loop().create_connection(factory, host, port)
+    return instance
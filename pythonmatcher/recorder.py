@@ -0,0 +1,136 @@
+from influx import TelemetrySink, to_nanoseconds
+import json
+import logging
+import os
+import numpy as np
+import settings
+
+logger = logging.getLogger(settings.app_name + '.' + __name__)
+
+class Series(object):
+    """ Columns of one series (measurement and tags) in preallocated arrays: time in ns and a float64 column per field """
+
+    def __init__(self, id, measurement, tags, fields, chunk_size):
+        self.id = id
+        self.measurement = measurement
+        self.tags = tags
+        self.fields = tuple(fields)
+        self.chunk_size = chunk_size
+        self.chunks = [] # Files of spilled chunks
+
+        self._new_chunk()
+
+    def _new_chunk(self):
+        # Start small, many series (one per agent) may only get a few points
+        capacity = min(self.chunk_size, 1024)
+        self.times = np.empty(capacity, dtype=np.int64)
+        self.values = np.empty((len(self.fields), capacity), dtype=np.float64)
+        self.size = 0
+
+    def append(self, time, fields):
+        new_fields = [field for field in fields if field not in self.fields]
+        if new_fields:
+            # Widen the schema, earlier points (also those in spilled chunks) have NaN for the new fields
+            self.fields += tuple(sorted(new_fields))
+            values = np.full((len(self.fields), len(self.times)), np.nan)
+            values[:len(self.values)] = self.values
+            self.values = values
+
+        if self.size == len(self.times):
+            # Double the arrays. A chunk only grows beyond chunk_size when it isn't spilled to disk
+            capacity = 2 * len(self.times)
+            times = np.empty(capacity, dtype=np.int64)
+            times[:self.size] = self.times
+            values = np.empty((len(self.fields), capacity), dtype=np.float64)
+            values[:, :self.size] = self.values
+            self.times, self.values = times, values
+
+        self.times[self.size] = time
+        for f_i, field in enumerate(self.fields):
+            self.values[f_i, self.size] = fields.get(field, np.nan)
+        self.size += 1
+
+    def spill(self, directory):
+        # Write the in-memory chunk to an NPZ file and start a new chunk
+        if not self.size:
+            return
+
+        path = os.path.join(directory, '{}-{}.npz'.format(self.id, len(self.chunks)))
+        np.savez(path, time=self.times[:self.size], **{field: self.values[f_i, :self.size] for f_i, field in enumerate(self.fields)})
+        self.chunks.append(os.path.basename(path))
+        self._new_chunk()
+
+    def to_arrays(self, directory):
+        # All recorded points as {'time': array, field: array}, including spilled chunks
+        parts = [np.load(os.path.join(directory, chunk)) for chunk in self.chunks]
+
+        arrays = {'time': np.concatenate([part['time'] for part in parts] + [self.times[:self.size]])}
+        for f_i, field in enumerate(self.fields):
+            arrays[field] = np.concatenate([part[field] if field in part else np.full(len(part['time']), np.nan)
+                                            for part in parts] + [self.values[f_i, :self.size]])
+        return arrays
+
+
+class ColumnarRecorder(TelemetrySink):
+    """ Telemetry sink keeping all series in memory as typed arrays, spilling full chunks to NPZ files in directory """
+
+    # Without a directory everything is kept in memory. One year of one minute points takes 16 bytes per point, about 8MB
+    # per series.
+
+    def __init__(self, directory=None, chunk_size=2**16):
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.series = {} # (measurement, sorted tag items) -> Series
+
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def write(self, measurement, tags, fields, timestamp):
+        key = (measurement, tuple(sorted((k, str(v)) for k, v in tags.items())))
+        series = self.series.get(key)
+
+        if series is None:
+            series = Series(len(self.series), measurement, dict(key[1]), sorted(fields), self.chunk_size)
+            self.series[key] = series
+        elif self.directory and series.size == self.chunk_size:
+            series.spill(self.directory)
+
+        series.append(to_nanoseconds(timestamp), fields)
+
+    def get(self, measurement, **tags):
+        # Arrays of the series with the given measurement and tags
+        key = (measurement, tuple(sorted((k, str(v)) for k, v in tags.items())))
+        return self.series[key].to_arrays(self.directory)
+
+    def find(self, measurement, **tags):
+        # Tags of all series of the measurement which match the given tags
+        return [series.tags for series in self.series.values()
+                if series.measurement == measurement and all(series.tags.get(k) == str(v) for k, v in tags.items())]
+
+    def flush(self):
+        # Spill all in-memory data and write an index, so the recording can be opened with ColumnarRecorder.open
+        if not self.directory:
+            return
+
+        for series in self.series.values():
+            series.spill(self.directory)
+
+        index = [{'id': series.id, 'measurement': series.measurement, 'tags': series.tags, 'fields': series.fields,
+                  'chunks': series.chunks} for series in self.series.values()]
+        with open(os.path.join(self.directory, 'index.json'), 'w') as f:
+            json.dump(index, f)
+
+        logger.info("Recorded {} series to {}".format(len(index), self.directory))
+
+    @classmethod
+    def open(cls, directory):
+        # Open a recording written by flush
+        recorder = cls(directory)
+
+        with open(os.path.join(directory, 'index.json')) as f:
+            for entry in json.load(f):
+                series = Series(entry['id'], entry['measurement'], entry['tags'], entry['fields'], recorder.chunk_size)
+                series.chunks = entry['chunks']
+                recorder.series[(series.measurement, tuple(sorted(series.tags.items())))] = series
+
+        return recorder
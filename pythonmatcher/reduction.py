@@ -0,0 +1,176 @@
+# Reduction of telemetry before it is written: deadbands and time-window rollups per measurement
+#
+# Rules map a measurement to any of:
+# - absolute, relative: deadband. A point of a series (measurement and tags) is dropped while none of its numeric
+#   fields differs from the last written point by more than max(absolute, relative * |last written value|)
+# - window: rollup over windows of this many minutes. Instead of every point, one point per series and window is
+#   written at the start of the window. It holds the time-weighted mean of every numeric field under the field's own
+#   name (points are written on changes, so a value holds until the next point), and the minimum, maximum and last
+#   value as <field>_min, <field>_max and <field>_last. Dashboards taking the mean of a field keep working. Windows
+#   without any point are skipped, the last written window holds through them like a value holds between points
+# With both, the deadband applies to the means of the rollups. Measurements without a rule are written as they come.
+#
+# A window is written when the first point after it arrives. flush writes the open windows (their mean is taken up to
+# the last point) and the last values that were held back by a deadband, so the final state of every series is written.
+#
+# A field missing from a point keeps its last value. A field first seen in a later point is averaged from that point.
+
+import datetime
+import influx
+import logging
+import numbers
+import settings
+
+logger = logging.getLogger(settings.app_name + '.' + __name__)
+
+def _is_number(value):
+    return isinstance(value, numbers.Real) and not isinstance(value, bool)
+
+
+class Rollup(object):
+    """ Open window of one series: time-weighted sums and the extremes of its numeric fields """
+
+    def __init__(self, start, time, fields):
+        self.start = start # Start of the window, in ns
+        self.first = time # Time from which the window is covered
+        self.time = time # Time of the last point
+        self.last = {}
+        self.sums = {}
+        self.since = {} # Time from which a field is covered, later than first for fields of later points
+        self.minimum = {}
+        self.maximum = {}
+        self._update(fields)
+
+    def add(self, time, fields):
+        self.advance(time)
+        self._update(fields)
+
+    def _update(self, fields):
+        for name, value in fields.items():
+            if not _is_number(value):
+                continue
+            if name not in self.sums:
+                self.sums[name] = 0.0
+                self.since[name] = self.time
+                self.minimum[name] = self.maximum[name] = value
+            elif value < self.minimum[name]:
+                self.minimum[name] = value
+            elif value > self.maximum[name]:
+                self.maximum[name] = value
+        self.last = dict(self.last, **fields)
+
+    def advance(self, time):
+        # The last value held until time
+        duration = time - self.time
+        for name in self.sums:
+            self.sums[name] += self.last[name] * duration
+        self.time = time
+
+    def fields(self):
+        fields = dict(self.last)
+        for name, total in self.sums.items():
+            duration = self.time - self.since[name]
+            fields[name] = total / duration if duration else float(self.last[name])
+            fields[name + '_min'] = self.minimum[name]
+            fields[name + '_max'] = self.maximum[name]
+            fields[name + '_last'] = self.last[name]
+        return fields
+
+
+class Reduction(object):
+    """ Telemetry reduction stage, passes the reduced points on to write(measurement, tags, fields, timestamp, database) """
+
+    def __init__(self, rules, write):
+        self.rules = rules
+        self.write_reduced = write
+        self.received_points = 0
+        self.written_points = 0
+
+        self._windows = {name: int(rule['window'] * 60e9) for name, rule in rules.items() if rule.get('window')}
+        self._rollups = {} # series -> (Rollup, database)
+        self._written = {} # series -> fields of the last written point, for deadbands
+        self._held = {} # series -> point held back by a deadband, written by flush
+
+    def write(self, measurement, tags, fields, timestamp, database):
+        rule = self.rules.get(measurement)
+        if rule is None:
+            self.write_reduced(measurement, tags, fields, timestamp, database)
+            return
+
+        self.received_points += 1
+        series = (measurement, tuple(sorted(tags.items())))
+        window = self._windows.get(measurement)
+        if window is None:
+            self._deadband(rule, series, fields, timestamp, database)
+            return
+
+        time = influx.to_nanoseconds(timestamp)
+        entry = self._rollups.get(series)
+        if entry is not None and time < entry[0].start + window:
+            entry[0].add(time, fields)
+            return
+
+        if entry is not None:
+            # Close the window, the last value holds until its end and continues in the window of this point
+            rollup = entry[0]
+            rollup.advance(rollup.start + window)
+            self._close(rule, series, rollup, database)
+            start = time - time % window
+            carried = Rollup(start, start, rollup.last)
+            carried.add(time, fields)
+            self._rollups[series] = (carried, database)
+        else:
+            self._rollups[series] = (Rollup(time - time % window, time, fields), database)
+
+    def _close(self, rule, series, rollup, database):
+        # Timestamps are naive UTC, as influx.to_nanoseconds takes them
+        timestamp = datetime.datetime(1970, 1, 1) + datetime.timedelta(microseconds=rollup.start // 1000)
+        self._deadband(rule, series, rollup.fields(), timestamp, database, rollup.last)
+
+    def _deadband(self, rule, series, fields, timestamp, database, compared=None):
+        # Compares the fields named in compared (default all), for rollups the means and not the extremes
+        written = self._written.get(series)
+        if written is not None:
+            absolute = rule.get('absolute', 0)
+            relative = rule.get('relative', 0)
+            for name in (compared or fields):
+                value = fields.get(name)
+                last = written.get(name)
+                if _is_number(value) and _is_number(last):
+                    if abs(value - last) > max(absolute, relative * abs(last)):
+                        break
+                elif value != last:
+                    break
+            else:
+                # Within the deadband
+                self._held[series] = (fields, timestamp, database)
+                return
+
+        self._held.pop(series, None)
+        self._write(series, fields, timestamp, database)
+
+    def _write(self, series, fields, timestamp, database):
+        self._written[series] = fields
+        self.written_points += 1
+        self.write_reduced(series[0], dict(series[1]), fields, timestamp, database)
+
+    def flush(self):
+        # Write the open windows and the points held back by deadbands
+        for series, (rollup, database) in self._rollups.items():
+            self._close(self.rules[series[0]], series, rollup, database)
+        self._rollups.clear()
+
+        held, self._held = self._held, {}
+        for series, (fields, timestamp, database) in held.items():
+            self._write(series, fields, timestamp, database)
+
+        if self.received_points:
+            logger.info("Telemetry reduction wrote %d of %d points", self.written_points, self.received_points)
+
+
+def create_reduction(write, rules=None):
+    # Reduction with the rules from settings.telemetry_reduction, None when there are none
+    rules = settings.telemetry_reduction if rules is None else rules
+    if not rules:
+        return None
+    return Reduction(rules, write)
@@ -0,0 +1,180 @@
+# Replay of bid traces (see bidtrace.py) against the clearing engine, at maximum speed
+#
+# Every market of the trace is a bare Auctioneer with the recorded settings, its agents are stubs holding their recorded
+# bids and telemetry is discarded by the sink of the context of the replay. Bid updates go through handle_bid_update and the market is cleared where the
+# recording cleared, so only aggregation, clearing and the notification of agents are timed. The price of every
+# clearing is compared with the recorded one. Giving price_steps replays the trace with another aggregation (market
+# basis, or 0 for exact ladders), its prices are then reported but not expected to match.
+#
+# Usage: python replay.py record trace.bin --agents 1000 --hours 24
+#        python replay.py replay trace.bin [--price-steps 100]
+
+from decimal import Decimal
+from powermatcher import Auctioneer, BaseAgent, Bid
+import argparse
+import bidtrace
+import influx
+import logging
+import numeric
+import runtime
+import settings
+import sys
+import time
+
+logger = logging.getLogger(settings.app_name + '.' + __name__)
+
+class TraceAgent(BaseAgent):
+    """ Stand-in for a recorded agent, its runlevel follows the recorded bids """
+
+    def __init__(self, auctioneer, id, bid, price_subscriber):
+        # Set before the auctioneer registers the agent, which subscribes it to price changes
+        self.price_subscriber = price_subscriber
+        super(TraceAgent, self).__init__(auctioneer, initial_bid=bid, id=id)
+
+    def calculate_bid(self):
+        # The last recorded bid, new bids come from the trace
+        return self._lastbid
+
+    def handle_state_update(self):
+        # The trace holds the bid updates of the agent
+        pass
+
+
+def create_market(description, price_steps=None, context=None):
+    # Bare auctioneer with the settings of a recorded market, price_steps (when not None) replaces the recorded ones.
+    # Prices are recorded in the number type of the backend, ticks for the fixed point backend
+    backend = description['numeric']
+    if backend == 'fixed':
+        backend = numeric.FixedPointBackend(Decimal(description['quantity_resolution']), Decimal(description['price_resolution']))
+    backend = numeric.get_backend(backend)
+    number_type = backend.number_type
+    if price_steps is None:
+        price_steps = description['price_steps']
+
+    auctioneer = Auctioneer(id=description['id'], min_price=backend.price_to_decimal(number_type(description['min_price'])),
+                            max_price=backend.price_to_decimal(number_type(description['max_price'])), verify_aggregate=False,
+                            price_steps=price_steps, batch_clearing=True, numeric_backend=backend, context=context)
+    auctioneer.price = number_type(description['price'])
+    return auctioneer
+
+
+class ReplayResult(object):
+    """ Counts and timing of a replay """
+
+    def __init__(self):
+        self.markets = 0
+        self.bids = 0
+        self.clearings = 0
+        self.mismatches = 0 # Clearings with another price than recorded
+        self.seconds = 0.0 # In the auctioneers, without reading the trace
+        self.total_seconds = 0.0
+
+    def __str__(self):
+        return ("{} bid updates and {} clearings of {} markets in {:.2f}s ({:.2f}s in the auctioneers): {:.0f} clearings/s, "
+                "{:.0f} bid updates/s, {} prices differ from the recording").format(
+                    self.bids, self.clearings, self.markets, self.total_seconds, self.seconds,
+                    self.clearings / self.seconds if self.seconds else 0, self.bids / self.seconds if self.seconds else 0,
+                    self.mismatches)
+
+
+def replay(path, price_steps=None):
+    # Streams the trace at path through bare auctioneers, returns a ReplayResult
+    result = ReplayResult()
+    markets = []
+    agents = {} # recorded index -> TraceAgent
+    clock = time.perf_counter
+    context = runtime.Context(sink=influx.TelemetrySink())
+
+    start = clock()
+    try:
+        for record in bidtrace.read_trace(path):
+            kind = record[0]
+
+            if kind == 'B':
+                _, _, market, agent, (quantities, prices) = record
+                auctioneer = markets[market]
+                agent = agents[agent]
+                bid = Bid._create(auctioneer, quantities, prices)
+                if auctioneer.bid_cache is not None:
+                    bid = auctioneer.bid_cache.intern(bid)
+
+                started = clock()
+                agent._lastbid = bid
+                auctioneer.handle_bid_update(agent, bid)
+                result.seconds += clock() - started
+                result.bids += 1
+
+            elif kind == 'C':
+                _, _, market, price = record
+                auctioneer = markets[market]
+
+                started = clock()
+                auctioneer.bids_changed = True
+                auctioneer.clear()
+                result.seconds += clock() - started
+                result.clearings += 1
+
+                if auctioneer.price != price:
+                    if not result.mismatches:
+                        logger.info("First price differing from the recording: %s instead of %s in market %s at %s",
+                                    auctioneer.price, price, auctioneer.id, record[1])
+                    result.mismatches += 1
+
+            elif kind == 'A':
+                _, market, agent, price_subscriber, id, (quantities, prices) = record
+                auctioneer = markets[market]
+                agents[agent] = TraceAgent(auctioneer, id, Bid._create(auctioneer, quantities, prices), price_subscriber)
+
+            elif kind == 'R':
+                _, market, agent = record
+                markets[market].unregister_agent(agents.pop(agent))
+
+            elif kind == 'M':
+                markets.append(create_market(record[2], price_steps, context))
+                result.markets += 1
+    finally:
+        result.total_seconds = clock() - start
+
+    return result
+
+
+def record(path, agents, hours, seed=0):
+    # Trace of a benchmark scenario (see benchmark.create_scenario), returns the number of events
+    import benchmark # Imported here, replaying doesn't need the scenarios
+    environment, auctioneer = benchmark.create_scenario(agents, seed=seed, hours=hours)
+    influx.set_sink(influx.TelemetrySink())
+    bidtrace.set_recorder(bidtrace.TraceRecorder(path))
+    try:
+        environment.start()
+        return bidtrace.recorder.events
+    finally:
+        bidtrace.set_recorder(None)
+        influx.set_sink(None)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Records and replays traces of bid events")
+    subparsers = parser.add_subparsers(dest='command')
+
+    record_parser = subparsers.add_parser('record', help="Record a trace of a benchmark scenario")
+    record_parser.add_argument('trace')
+    record_parser.add_argument('--agents', type=int, default=1000)
+    record_parser.add_argument('--hours', type=float, default=24)
+    record_parser.add_argument('--seed', type=int, default=0)
+
+    replay_parser = subparsers.add_parser('replay', help="Replay a trace, fails when prices differ from the recording")
+    replay_parser.add_argument('trace')
+    replay_parser.add_argument('--price-steps', type=int, default=None,
+                               help="Aggregate on a market basis of this many steps instead of as recorded, 0 for exact ladders")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=settings.log_level)
+    if args.command == 'record':
+        print("Recorded {} bid events".format(record(args.trace, args.agents, args.hours, seed=args.seed)))
+    elif args.command == 'replay':
+        result = replay(args.trace, args.price_steps)
+        print(result)
+        if result.mismatches and args.price_steps is None:
+            sys.exit(1)
+    else:
+        parser.print_help()
@@ -1,4 +1,5 @@
 import ext # import dependencies first
+import influx
 import logging
 from powermatcher import Auctioneer
 from agents import PVAgent, BatteryAgent, LoadAgent, ImbalanceAgent
@@ -23,4 +24,5 @@ if __name__ == '__main__':
                                  capacity=50)
 
     ext.environment.register_auctioneer(auctioneer)
-    ext.environment.start() # Blocks until finished
\ No newline at end of file
+    ext.environment.start() # Blocks until finished
+    influx.close() # Write remaining buffered points
@@ -0,0 +1,84 @@
+# Runtime context of a simulation: its environment, telemetry sink and settings
+#
+# Auctioneers take a context (the default context when none is given), their agents and concentrators share it. An
+# auctioneer registered with an environment takes over the context of that environment (see register_auctioneer). The
+# simulation only uses the time of the environment of its context, writes its telemetry through the context and takes
+# its defaults from the settings of the context. Independent simulations can therefore run in one interpreter, each
+# with its own context, e.g. in threads or interleaved on an event loop.
+#
+# The default context is created on first use, with the settings of the settings module and the telemetry of influx.py
+# (its sink, reduction and InfluxDB); ext.environment is its environment. A context with its own sink also reduces its
+# own telemetry (settings.telemetry_reduction). Metrics (metrics.py) and bid traces (bidtrace.py) stay per process.
+#
+# In checkpoints the context is not stored: a loaded checkpoint runs in the context of the environment it is loaded
+# into (see checkpoint.py).
+
+from environment import SimulationEnvironment
+import copyreg
+import datetime
+import influx
+import settings as default_settings
+
+class Context(object):
+    """ Environment, telemetry sink and settings of one simulation """
+
+    def __init__(self, environment=None, sink=None, settings=None):
+        self.settings = settings if settings is not None else default_settings
+
+        # Telemetry goes to sink (an influx.TelemetrySink) when set, else through influx.write_point
+        self.sink = sink
+        self.reduction = None
+        if sink is not None and self.settings.telemetry_reduction:
+            from reduction import Reduction
+            self.reduction = Reduction(self.settings.telemetry_reduction, self._write_sink)
+
+        if environment is None:
+            environment = SimulationEnvironment(stop_time=datetime.datetime.now() + datetime.timedelta(days=2),
+                                                processes=self.settings.simulation_processes,
+                                                event_driven=self.settings.simulation_event_driven, context=self)
+        environment.context = self
+        self.environment = environment
+
+    def __reduce__(self):
+        # The default context is the default one of the process it is loaded in, others are copied without their sink
+        if self is _default:
+            return default_context, ()
+        state = dict(self.__dict__, sink=None, reduction=None)
+        if self.settings is default_settings:
+            state['settings'] = None
+        return copyreg.__newobj__, (Context,), state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.settings is None:
+            self.settings = default_settings
+
+    def write_point(self, measurement, tags, fields):
+        # Telemetry point at the current time of the environment
+        if self.sink is None:
+            influx.write_point(measurement, tags, fields, self.environment.current_time, self.settings.influxdb_database,
+                               self.settings)
+        elif self.reduction is not None:
+            self.reduction.write(measurement, tags, fields, self.environment.current_time, self.settings.influxdb_database)
+        else:
+            self.sink.write(measurement, tags, fields, self.environment.current_time)
+
+    def _write_sink(self, measurement, tags, fields, timestamp, database):
+        self.sink.write(measurement, tags, fields, timestamp)
+
+    def flush_reduction(self):
+        # Write the open rollup windows and held back points of the telemetry of this context, at the end of a run
+        if self.sink is None:
+            influx.flush_reduction()
+        elif self.reduction is not None:
+            self.reduction.flush()
+
+
+_default = None
+
+def default_context():
+    # Context of everything created without one, created on first use
+    global _default
+    if _default is None:
+        _default = Context()
+    return _default
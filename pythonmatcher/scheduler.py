@@ -0,0 +1,108 @@
+# Event-driven execution of a SimulationEnvironment
+#
+# Instead of updating every agent every simulation_interval, the scheduler keeps a priority queue with the tick at which
+# every agent needs its next handle_state_update, as declared by BaseAgent.next_update_time after each update. An agent
+# returning None sleeps until a price change of its auctioneer when it sets wake_on_price_change, or else for the rest
+# of the simulation (it still receives every price update). Ticks without any wake-up are skipped, so time advances from
+# one event to the next in steps of varying size.
+#
+# Due agents are updated in the same order as SimulationEnvironment.start does. As long as agents only sleep while an
+# update would not change their state, the result equals a run updating every agent every tick.
+#
+# The per-tick hooks of the environment (profiler, metrics, checkpointer) still run on every tick boundary, skipped
+# ticks included, so periodic snapshots and per-tick metrics are the same as in a run updating every tick.
+
+import heapq
+import logging
+import settings
+
+logger = logging.getLogger(settings.app_name + '.' + __name__)
+
+def run_event_driven(environment):
+    # Runs the environment like SimulationEnvironment.start, returns the number of agent updates
+    interval = environment.simulation_interval
+    start_time = environment.current_time
+    last_tick = (environment.stop_time - start_time) // interval
+
+    agents = []
+    auctioneer_indices = []
+    subscribers = [] # Per auctioneer, indices of agents to wake on a price change
+    for a_i, auctioneer in enumerate(environment.auctioneers):
+        subscribers.append([])
+        for agent in auctioneer.agents:
+            if agent.wake_on_price_change:
+                subscribers[-1].append(len(agents))
+            agents.append(agent)
+            auctioneer_indices.append(a_i)
+
+    queue = [(0, n) for n in range(len(agents))] # (tick, agent index), ordered like the agents already
+    scheduled = [0] * len(agents) # Tick of the valid queue entry of every agent, None when sleeping
+
+    def schedule(n, tick):
+        # Earlier wake-ups replace later ones, the entry of the later one is skipped when it comes up
+        if tick <= last_tick and (scheduled[n] is None or tick < scheduled[n]):
+            scheduled[n] = tick
+            heapq.heappush(queue, (tick, n))
+
+    def skip_ticks(until):
+        # Per-tick hooks of the ticks without any wake-up, up to (not including) tick until
+        for skipped in range(next_tick, until):
+            environment.current_time = start_time + skipped * interval
+            environment.start_tick()
+            environment.end_tick()
+            if not environment.running:
+                return
+
+    updates = 0
+    next_tick = 0
+    environment.running = True
+
+    while environment.running and queue:
+        tick = queue[0][0]
+        skip_ticks(tick)
+        if not environment.running:
+            break
+        environment.current_time = start_time + tick * interval
+
+        due = []
+        while queue and queue[0][0] == tick:
+            _, n = heapq.heappop(queue)
+            if scheduled[n] == tick:
+                scheduled[n] = None
+                due.append(n)
+
+        prices = [auctioneer.price for auctioneer in environment.auctioneers]
+        environment.start_tick()
+
+        d_i = 0
+        for a_i, auctioneer in enumerate(environment.auctioneers):
+            due_agents = []
+            while d_i < len(due) and auctioneer_indices[due[d_i]] == a_i:
+                due_agents.append(agents[due[d_i]])
+                d_i += 1
+            environment.update_agents(due_agents)
+            auctioneer.end_tick()
+
+        environment.end_tick()
+        updates += len(due)
+        next_tick = tick + 1
+
+        # Next wake-ups, at the first tick at or after the time the agent asks for (at least the next tick)
+        for n in due:
+            next_time = agents[n].next_update_time()
+            if next_time is not None:
+                schedule(n, max(tick + 1, -((start_time - next_time) // interval)))
+
+        for a_i, auctioneer in enumerate(environment.auctioneers):
+            if auctioneer.price != prices[a_i]:
+                for n in subscribers[a_i]:
+                    schedule(n, tick + 1)
+
+    if environment.running:
+        skip_ticks(last_tick + 1)
+    if environment.running:
+        environment.current_time = start_time + (last_tick + 1) * interval
+        environment.running = False
+
+    logger.info("Simulated {} ticks with {} agent updates ({} agents)".format(last_tick + 1, updates, len(agents)))
+    return updates
@@ -1,16 +1,93 @@
-from os import environ
+from decimal import Decimal
+import json
+import os
 
-# Used for logging name
-app_name = "pythonmatcher"
+class Settings(object):
+    """ Settings read from environment variables when created, the values of this module are read at import """
 
-# Default values are defined here
-# Overrides may be injected in the environment
-influxdb_host = environ.get("INFLUXDB_HOST", "influxdb")
-influxdb_database = environ.get("INFLUXDB_DATABASE", "exe-dqn-agent")
-influxdb_enabled = environ.get("INFLUXDB_ENABLED", "True").lower() == 'true'
-influxdb_empty = environ.get("INFLUXDB_EMPTY", "False").lower() == 'true'
-influxdb_write_async = environ.get("INFLUXDB_WRITE_ASYNC", "False").lower() == 'true'
+    # A runtime.Context can be given its own Settings, e.g. read later or from another mapping than os.environ. Names
+    # given as keyword arguments override the values read
 
-log_level = environ.get("LOG_LEVEL", "INFO")
+    def __init__(self, environ=None, **overrides):
+        if environ is None:
+            environ = os.environ
 
-storage_dir = "temp"
\ No newline at end of file
+        # Used for logging name
+        self.app_name = "pythonmatcher"
+
+        # Default values are defined here
+        # Overrides may be injected in the environment
+        self.influxdb_host = environ.get("INFLUXDB_HOST", "influxdb")
+        self.influxdb_database = environ.get("INFLUXDB_DATABASE", "exe-dqn-agent")
+        self.influxdb_enabled = environ.get("INFLUXDB_ENABLED", "True").lower() == 'true'
+        self.influxdb_empty = environ.get("INFLUXDB_EMPTY", "False").lower() == 'true'
+        self.influxdb_write_async = environ.get("INFLUXDB_WRITE_ASYNC", "False").lower() == 'true'
+        self.influxdb_port = int(environ.get("INFLUXDB_PORT", "8086"))
+
+        # Buffered writing in batches from a background thread (see influx.BatchWriter)
+        self.influxdb_batch_writes = environ.get("INFLUXDB_BATCH_WRITES", "True").lower() == 'true'
+        self.influxdb_batch_size = int(environ.get("INFLUXDB_BATCH_SIZE", "5000"))
+        self.influxdb_flush_interval = float(environ.get("INFLUXDB_FLUSH_INTERVAL", "1.0")) # in seconds
+        self.influxdb_max_queue_size = int(environ.get("INFLUXDB_MAX_QUEUE_SIZE", "100000"))
+        self.influxdb_drop_on_overflow = environ.get("INFLUXDB_DROP_ON_OVERFLOW", "False").lower() == 'true'
+
+        # Numeric backend for prices and quantities, 'decimal' (exact) or 'fixed' (scaled integers), see numeric.py
+        self.numeric_backend = environ.get("NUMERIC_BACKEND", "decimal")
+
+        self.auctioneer_verify_aggregate = environ.get("AUCTIONEER_VERIFY_AGGREGATE", "False").lower() == 'true'
+        self.auctioneer_batch_clearing = environ.get("AUCTIONEER_BATCH_CLEARING", "False").lower() == 'true'
+        self.auctioneer_max_rebid_rounds = int(environ.get("AUCTIONEER_MAX_REBID_ROUNDS", "3"))
+
+        # Simplification of aggregated bids sent upstream (see Bid.simplify), 0 is off. The tolerance is a price difference
+        self.auctioneer_max_ladder_points = int(environ.get("AUCTIONEER_MAX_LADDER_POINTS", "0"))
+        self.auctioneer_price_tolerance = Decimal(environ.get("AUCTIONEER_PRICE_TOLERANCE", "0"))
+
+        # Number of distinct bids an auctioneer keeps for sharing between agents (see powermatcher.BidCache), 0 is off
+        self.auctioneer_bid_cache_size = int(environ.get("AUCTIONEER_BID_CACHE_SIZE", "0"))
+
+        # Number of worker processes to shard the simulation over, 0 runs in a single process
+        self.simulation_processes = int(environ.get("SIMULATION_PROCESSES", "0"))
+
+        # Only update agents at the times they need it (see scheduler.py) instead of every simulation interval
+        self.simulation_event_driven = environ.get("SIMULATION_EVENT_DRIVEN", "False").lower() == 'true'
+
+        # Real-time market (see realtime.py): bids are collected for this window (in seconds) before clearing
+        self.realtime_clearing_window = float(environ.get("REALTIME_CLEARING_WINDOW", "0.1"))
+        self.realtime_port = int(environ.get("REALTIME_PORT", "9000"))
+
+        # Destination of telemetry: 'influxdb', or 'recorder' to keep all series in a recorder.ColumnarRecorder spilling to storage_dir
+        self.telemetry_sink = environ.get("TELEMETRY_SINK", "influxdb")
+
+        # Deadbands and rollups of telemetry per measurement (see reduction.py), as JSON. E.g.
+        # {"deviceagent_power": {"absolute": 10, "relative": 0.01, "window": 15}, "deviceagent_soc": {"absolute": 0.001}}
+        self.telemetry_reduction = json.loads(environ.get("TELEMETRY_REDUCTION", "{}"))
+
+        # Record the bid events of all markets during runs of the environment to this file (see bidtrace.py), empty is off
+        self.bid_trace_path = environ.get("BID_TRACE_PATH", "")
+
+        # Instrumentation of the hot paths (see metrics.py), summarized and exported at the end of a run
+        self.metrics_enabled = environ.get("METRICS_ENABLED", "False").lower() == 'true'
+
+        # Profile every n-th tick of a run with cProfile (0 is off), the stats are also written to profile_output if set
+        self.profile_sample_interval = int(environ.get("PROFILE_SAMPLE_INTERVAL", "0"))
+        self.profile_output = environ.get("PROFILE_OUTPUT", "")
+
+        self.log_level = environ.get("LOG_LEVEL", "INFO")
+
+        self.storage_dir = "temp"
+
+        # Snapshot of the simulation every interval of simulated time (in minutes, 0 is off) into checkpoint_dir, see checkpoint.py
+        self.checkpoint_interval = int(environ.get("CHECKPOINT_INTERVAL", "0"))
+        self.checkpoint_dir = environ.get("CHECKPOINT_DIR", self.storage_dir + "/checkpoints")
+
+        for name, value in overrides.items():
+            if not hasattr(self, name):
+                raise TypeError("Unknown setting {}".format(name))
+            setattr(self, name, value)
+
+
+def reload(environ=None):
+    # Read the values of this module again (default from os.environ), e.g. after changing environment variables
+    globals().update(vars(Settings(environ)))
+
+reload()
@@ -0,0 +1,197 @@
+# Sharded execution of a SimulationEnvironment over multiple processes
+#
+# The agents of every auctioneer are divided over worker processes. Each tick, a worker runs handle_state_update for
+# the agents in its shard and returns the aggregated bid of the shard. The coordinating process clears the market on
+# the shard bids and sends the price back, after which price responsive agents may bid again (same as end_tick of the
+# Auctioneer). The auctioneers always use batched clearing, with that the result equals a single process run in
+# batched clearing mode (unless the shard bids are simplified, see Auctioneer.max_ladder_points).
+#
+# Workers are forked (Linux), so the agents don't need to be pickled. Agents write their telemetry from the worker
+# processes; an in-process sink (e.g. a recorder) only receives the auctioneer prices.
+
+from powermatcher import Auctioneer, BaseAgent, Bid
+import influx
+import logging
+import multiprocessing
+import settings
+
+logger = logging.getLogger(settings.app_name + '.' + __name__)
+
+class ShardAgent(BaseAgent):
+    """ Stands in for all agents of one shard at the coordinating auctioneer, its bid is the aggregated bid of the shard """
+
+    def __init__(self, auctioneer, shard, index):
+        super(ShardAgent, self).__init__(auctioneer, initial_bid=shard.get_simplified_bidding_ladder(), id='Shard-{}-{}'.format(auctioneer.id, index))
+
+    def handle_price_update(self):
+        # The price is sent to the worker process by run_sharded
+        pass
+
+    def handle_state_update(self):
+        pass
+
+
+def _shard_bid(shard):
+    # Aggregated bid of the shard if it changed, as tuples for sending to the coordinator
+    if not shard.bids_changed:
+        return None
+    shard.bids_changed = False
+
+    bid = shard.get_simplified_bidding_ladder()
+    return bid.quantities, bid.prices
+
+
+def _run_worker(environment, shards, connection):
+    influx.after_fork()
+
+    while True:
+        command = connection.recv()
+
+        if command[0] == 'state':
+            environment.current_time = command[1]
+            for shard in shards:
+                for agent in shard.agents:
+                    agent.handle_state_update()
+            connection.send([_shard_bid(shard) for shard in shards])
+
+        elif command[0] == 'price':
+            _, a_i, price, rebid = command
+            shard = shards[a_i]
+            old_price, shard.price = shard.price, price
+            shard.notify_price_change(old_price)
+
+            if rebid:
+                for agent in shard.agents:
+                    if agent.price_responsive:
+                        agent.handle_rebid()
+            connection.send(_shard_bid(shard))
+
+        elif command[0] == 'stop':
+            connection.send([[agent.get_state() for agent in shard.agents] for shard in shards])
+            influx.close()
+            return
+
+
+def _receive(connection, worker):
+    # Reply of a worker. A worker that died (e.g. an agent raised an exception) closed its end of the pipe
+    try:
+        return connection.recv()
+    except EOFError:
+        worker.join()
+        raise RuntimeError("Worker process {} exited with code {}".format(worker.name, worker.exitcode))
+
+
+def _handle_shard_bid(auctioneer, shard_agent, bid):
+    if bid is not None:
+        bid = Bid(auctioneer, *bid)
+        shard_agent._lastbid = bid
+        auctioneer.handle_bid_update(shard_agent, bid)
+
+
+def run_sharded(environment, processes):
+    # Runs the environment like SimulationEnvironment.start, with the agents divided over processes workers
+
+    context = multiprocessing.get_context('fork')
+
+    # The agents live in the workers, snapshots of the coordinator would only hold the shard agents
+    if environment.checkpointer is not None:
+        logger.warning("Snapshots are not supported in sharded runs")
+        environment.checkpointer = None
+
+    # Move the agents of every auctioneer into shards, one per worker
+    agents = []
+    shards = [[] for _ in range(processes)]
+    batch_clearing = []
+    for auctioneer in environment.auctioneers:
+        agents.append(list(auctioneer.agents))
+        batch_clearing.append(auctioneer.batch_clearing)
+        auctioneer.batch_clearing = True
+
+        for agent in agents[-1]:
+            auctioneer.unregister_agent(agent)
+
+        for w_i in range(processes):
+            n = auctioneer.numeric
+            shard = Auctioneer(id=auctioneer.id, min_price=n.price_to_decimal(auctioneer.min_price),
+                               max_price=n.price_to_decimal(auctioneer.max_price),
+                               batch_clearing=True, numeric_backend=n, max_ladder_points=auctioneer.max_ladder_points,
+                               price_tolerance=n.price_to_decimal(auctioneer.price_tolerance),
+                               bid_cache_size=auctioneer.bid_cache.size if auctioneer.bid_cache else 0, context=auctioneer.context)
+            shard.price = auctioneer.price
+
+            for agent in agents[-1][w_i::processes]:
+                agent.auctioneer = shard
+                shard.register_agent(agent)
+            shard.bids_changed = False
+            shards[w_i].append(shard)
+
+    connections = []
+    workers = []
+    for w_i in range(processes):
+        connection, worker_connection = context.Pipe()
+        worker = context.Process(target=_run_worker, args=(environment, shards[w_i], worker_connection), daemon=True)
+        worker.start()
+        worker_connection.close() # Only the worker holds its end, so the pipe is closed when the worker dies
+        connections.append(connection)
+        workers.append(worker)
+
+    # Shard agents take the place of the agents at the auctioneers
+    shard_agents = [[ShardAgent(auctioneer, shards[w_i][a_i], w_i) for w_i in range(processes)]
+                    for a_i, auctioneer in enumerate(environment.auctioneers)]
+
+    logger.info("Started {} worker processes".format(processes))
+
+    try:
+        environment.running = True
+
+        while environment.running:
+            # Only the coordinating process is profiled and measured
+            environment.start_tick()
+            for connection in connections:
+                connection.send(('state', environment.current_time))
+            for w_i, connection in enumerate(connections):
+                for a_i, bid in enumerate(_receive(connection, workers[w_i])):
+                    _handle_shard_bid(environment.auctioneers[a_i], shard_agents[a_i][w_i], bid)
+
+            for a_i, auctioneer in enumerate(environment.auctioneers):
+                for rebid_round in range(auctioneer.max_rebid_rounds + 1):
+                    if not auctioneer.clear():
+                        break
+
+                    rebid = rebid_round < auctioneer.max_rebid_rounds
+                    for connection in connections:
+                        connection.send(('price', a_i, auctioneer.price, rebid))
+                    for w_i, connection in enumerate(connections):
+                        _handle_shard_bid(auctioneer, shard_agents[a_i][w_i], _receive(connection, workers[w_i]))
+            environment.end_tick()
+
+            environment.current_time += environment.simulation_interval
+            if environment.current_time > environment.stop_time:
+                environment.running = False
+
+        # Get the final state of the agents from the workers
+        states = []
+        for connection in connections:
+            connection.send(('stop',))
+        for w_i, connection in enumerate(connections):
+            states.append(_receive(connection, workers[w_i]))
+    except:
+        # Don't leave workers behind waiting for a command
+        for worker in workers:
+            worker.terminate()
+        raise
+    finally:
+        for worker in workers:
+            worker.join()
+
+    # Put the agents back at their auctioneers, with the state they ended with in the workers
+    for a_i, auctioneer in enumerate(environment.auctioneers):
+        for w_i in range(processes):
+            auctioneer.unregister_agent(shard_agents[a_i][w_i])
+            for agent, state in zip(agents[a_i][w_i::processes], states[w_i][a_i]):
+                agent.auctioneer = auctioneer
+                agent.set_state(state)
+
+        for agent in agents[a_i]:
+            auctioneer.register_agent(agent)
+        auctioneer.batch_clearing = batch_clearing[a_i]
@@ -0,0 +1,196 @@
+# Parameter sweeps: many variants of a scenario run in parallel, with a summary of every variant in one results table
+#
+# A grid maps scenario parameters (see default_parameters) to a list of values, or to a single value for all variants.
+# Every combination of values is a variant, identified by a hash of its parameters. Adding seeds to the grid makes it a
+# Monte Carlo run.
+#
+# Every variant runs on its own runtime context and environment, with an in-memory ColumnarRecorder as the telemetry
+# sink of that context, from which the summary is computed. Variants also run in their own forked process (a pool with
+# one task per child), so the random generators, metrics and bid traces are isolated from the other variants. The
+# results file has one row per variant and is rewritten as soon as a variant finishes. Running a sweep again with the
+# same results file skips the variants that finished and replaces the rows of the failed ones when they are retried.
+
+from agents import BatteryAgent, ImbalanceAgent, LoadAgent, PVAgent
+from decimal import Decimal
+from environment import SimulationEnvironment
+from powermatcher import Auctioneer
+from recorder import ColumnarRecorder
+import argparse
+import csv
+import datetime
+import hashlib
+import influx
+import itertools
+import json
+import logging
+import multiprocessing
+import numpy as np
+import os
+import random
+import runtime
+import settings
+import time
+import traceback
+
+logger = logging.getLogger(settings.app_name + '.' + __name__)
+
+default_parameters = {
+    'seed': 0,
+    'start_time': '2017-06-01T00:00:00',
+    'days': 1,
+    'min_price': 0,
+    'max_price': 1000,
+    'batch_clearing': False,
+    'load_agents': 1,
+    'pv_agents': 1,
+    'battery_agents': 1,
+    'imbalance_agents': 1,
+    'noise_factor': 0.1,
+    'battery_capacity': 10, # in kWh
+}
+
+statistics = ['mean_price', 'energy_traded', 'soc_mean', 'soc_p10', 'soc_p50', 'soc_p90']
+
+def expand_grid(grid):
+    # All variants of a grid, as complete parameter dicts
+    unknown = set(grid) - set(default_parameters)
+    if unknown:
+        raise ValueError("Unknown sweep parameters: {}".format(', '.join(sorted(unknown))))
+
+    names = sorted(grid)
+    axes = [grid[name] if isinstance(grid[name], list) else [grid[name]] for name in names]
+    variants = []
+    for values in itertools.product(*axes):
+        parameters = dict(default_parameters)
+        parameters.update(zip(names, values))
+        variants.append(parameters)
+    return variants
+
+def variant_id(parameters):
+    return hashlib.sha1(json.dumps(parameters, sort_keys=True).encode()).hexdigest()[:12]
+
+def create_scenario(parameters, sink=None):
+    # Auctioneer with the agents of a variant, on a new environment with its own context writing telemetry to sink
+    random.seed(parameters['seed'])
+
+    start_time = datetime.datetime.fromisoformat(parameters['start_time'])
+    environment = SimulationEnvironment(start_time, start_time + datetime.timedelta(days=parameters['days']))
+    context = runtime.Context(environment=environment, sink=sink)
+
+    auctioneer = Auctioneer(id='Sweep', min_price=Decimal(parameters['min_price']), max_price=Decimal(parameters['max_price']),
+                            batch_clearing=parameters['batch_clearing'], context=context)
+    noise_factor = Decimal(str(parameters['noise_factor']))
+    for n in range(parameters['load_agents']):
+        LoadAgent(auctioneer, id='Load-{}'.format(n), noise_factor=noise_factor)
+    for n in range(parameters['pv_agents']):
+        PVAgent(auctioneer, id='PV-{}'.format(n), noise_factor=noise_factor)
+    for n in range(parameters['battery_agents']):
+        BatteryAgent(auctioneer, id='Battery-{}'.format(n), capacity=parameters['battery_capacity'])
+    for n in range(parameters['imbalance_agents']):
+        ImbalanceAgent(auctioneer, id='Imbalance-{}'.format(n))
+
+    environment.register_auctioneer(auctioneer)
+    return environment, auctioneer
+
+def _integrate(series, field, stop):
+    # Durations (in seconds) of the values of a field, which hold until the next point or stop (ns), and their products
+    durations = np.diff(np.append(series['time'], stop)) / 1e9
+    return durations, series[field] * durations
+
+def summarize(recorder, environment, auctioneer):
+    # Statistics of a finished run from its telemetry and the final state of the agents
+    stop = influx.to_nanoseconds(environment.current_time)
+
+    durations, weighted = _integrate(recorder.get('auctioneer_prices', auctioneer_id=auctioneer.id), 'price', stop)
+    mean_price = weighted.sum() / durations.sum() if len(durations) else float(auctioneer.price)
+
+    # Energy bought on the market: the consumption of all agents, in kWh
+    energy_traded = 0.0
+    for tags in recorder.find('deviceagent_power', auctioneer_id=auctioneer.id):
+        _, energy = _integrate(recorder.get('deviceagent_power', **tags), 'power', stop)
+        energy_traded += energy[energy > 0].sum() / 3.6e6
+
+    socs = [agent.soc for agent in auctioneer.agents if isinstance(agent, BatteryAgent)]
+    soc_statistics = [np.mean(socs)] + list(np.percentile(socs, [10, 50, 90])) if socs else [''] * 4
+    return dict(zip(statistics, [mean_price, energy_traded] + soc_statistics))
+
+def run_variant(parameters):
+    # Runs one variant, returns its row of the results table. Errors are returned as a failed row
+    row = {'variant': variant_id(parameters), 'status': 'ok', 'error': ''}
+    row.update(parameters)
+    start = time.perf_counter()
+
+    recorder = ColumnarRecorder()
+    try:
+        environment, auctioneer = create_scenario(parameters, recorder)
+        environment.start()
+        row.update(summarize(recorder, environment, auctioneer))
+    except Exception:
+        logger.exception("Variant %s failed", row['variant'])
+        row['status'] = 'failed'
+        row['error'] = traceback.format_exc(limit=3).strip().splitlines()[-1]
+
+    row['duration'] = time.perf_counter() - start
+    return row
+
+def _run_isolated(parameters):
+    # Pool task, in a fresh child process forked for this variant only
+    influx.after_fork()
+    return run_variant(parameters)
+
+def _read_rows(path, columns):
+    # Rows of an earlier run of the sweep with the same results table, by variant
+    if not os.path.exists(path):
+        return {}
+
+    with open(path, newline='') as f:
+        reader = csv.DictReader(f)
+        if reader.fieldnames and reader.fieldnames != columns:
+            raise ValueError("Results table {} has other columns than this sweep".format(path))
+        return {row['variant']: row for row in reader}
+
+def _write_rows(path, columns, rows):
+    # Rewrite the results table with one row per variant, replaced at once so it is never left half written
+    temporary = path + '.tmp'
+    with open(temporary, 'w', newline='') as f:
+        writer = csv.DictWriter(f, columns)
+        writer.writeheader()
+        writer.writerows(rows.values())
+    os.replace(temporary, path)
+
+def run_sweep(grid, path, processes=None):
+    # Runs all variants of the grid that aren't completed in the results table at path, returns the number of failures
+    variants = expand_grid(grid)
+    columns = ['variant', 'status'] + sorted(default_parameters) + statistics + ['duration', 'error']
+
+    rows = _read_rows(path, columns)
+    pending = [parameters for parameters in variants
+               if variant_id(parameters) not in rows or rows[variant_id(parameters)]['status'] != 'ok']
+    logger.info("Sweep of %d variants, %d completed before, running %d", len(variants), len(variants) - len(pending), len(pending))
+
+    failures = 0
+    # Processes are forked (Linux), the parent's state at this point is copied to every variant
+    context = multiprocessing.get_context('fork')
+    with context.Pool(processes, maxtasksperchild=1) as pool:
+        for row in pool.imap_unordered(_run_isolated, pending):
+            # A retried variant replaces its failed row
+            rows[row['variant']] = row
+            _write_rows(path, columns, rows)
+            failures += row['status'] != 'ok'
+            logger.info("Variant %s %s in %.1fs", row['variant'], row['status'], row['duration'])
+
+    return failures
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Runs all variants of a scenario grid in parallel")
+    parser.add_argument('grid', help="JSON file mapping parameters to a list of values")
+    parser.add_argument('results', help="CSV file with a row per variant, completed variants are skipped")
+    parser.add_argument('--processes', type=int, default=None, help="Number of parallel variants (default all cores)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=settings.log_level)
+    with open(args.grid) as f:
+        grid = json.load(f)
+
+    exit(1 if run_sweep(grid, args.results, args.processes) else 0)
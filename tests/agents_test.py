@@ -0,0 +1,17 @@
+from agents import PVAgent, sun_factor
+from decimal import Decimal
+from powermatcher import Auctioneer
+import datetime
+import ext
+
+
+def test_pv_power_is_exact_decimal_product():
+    environment = ext.environment
+    auctioneer = Auctioneer(id='PV')
+    agent = PVAgent(auctioneer, noise_factor=Decimal(0))
+
+    for minute in range(6 * 60, 18 * 60, 7):
+        environment.current_time = datetime.datetime(2017, 6, 1) + datetime.timedelta(minutes=minute)
+        agent.handle_state_update()
+        # Same rounding as the product without the numeric backend
+        assert agent._lastbid.quantities[0] == - agent.peak_power * Decimal(sun_factor(environment.current_time))
@@ -0,0 +1,248 @@
+from powermatcher import Auctioneer, Bid, InvalidBidException
+from agents import BatteryAgent, ImbalanceAgent, LoadAgent
+from decimal import Decimal
+import pytest
+import random
+
+
+def test_incremental_aggregate_matches_recompute():
+    random.seed(0)
+    auctioneer = Auctioneer(verify_aggregate=True)
+    agents = [LoadAgent(auctioneer), ImbalanceAgent(auctioneer)] + [BatteryAgent(auctioneer) for _ in range(5)]
+
+    for _ in range(20):
+        for agent in agents:
+            if isinstance(agent, BatteryAgent):
+                agent.soc = random.random()
+            agent.handle_state_update()
+
+    assert auctioneer.get_bidding_ladder() == auctioneer.recompute_bidding_ladder()
+
+
+def test_aggregate_drops_unused_price_points():
+    auctioneer = Auctioneer()
+    agent = ImbalanceAgent(auctioneer)
+
+    agent.do_bid_update(Bid(auctioneer, Decimal(100)))
+
+    assert auctioneer.get_bidding_ladder().prices == ()
+    assert auctioneer.get_bidding_ladder().quantities == (Decimal(100),)
+
+
+def test_bulk_sum_matches_pairwise_addition():
+    random.seed(1)
+    auctioneer = Auctioneer()
+    agents = [BatteryAgent(auctioneer, soc=random.random()) for _ in range(10)] + [ImbalanceAgent(auctioneer)]
+    bids = [agent.calculate_bid() if isinstance(agent, BatteryAgent) else agent._lastbid for agent in agents]
+
+    pairwise = Bid(auctioneer)
+    for bid in bids:
+        pairwise += bid
+
+    assert Bid.sum(bids) == pairwise
+    assert Bid.sum([], auctioneer) == Bid(auctioneer)
+
+
+def test_bulk_sum_validates_result():
+    auctioneer = Auctioneer()
+    increasing = Bid._create(auctioneer, (Decimal(100), Decimal(500)), (Decimal(400),)) # Bypasses the checks
+    with pytest.raises(InvalidBidException):
+        Bid.sum([increasing, Bid(auctioneer, Decimal(100))])
+
+    with pytest.raises(ValueError):
+        Bid.sum([])
+
+
+def test_batch_clearing_waits_for_end_of_tick():
+    auctioneer = Auctioneer(batch_clearing=True, max_rebid_rounds=2)
+    agent = ImbalanceAgent(auctioneer)
+    load_agent = LoadAgent(auctioneer, load=Decimal(10000), noise_factor=Decimal(0))
+    initial_price = auctioneer.price
+
+    load_agent.handle_state_update()
+    assert auctioneer.price == initial_price
+
+    auctioneer.end_tick()
+    assert auctioneer.price == auctioneer.max_price
+    assert load_agent.current_power == Decimal(10000)
+    assert agent.current_power == -agent.production_power
+
+
+def test_concentrator_tree_matches_flat_auctioneer():
+    from powermatcher import Concentrator
+
+    for batch_clearing in (False, True):
+        flat = Auctioneer(batch_clearing=batch_clearing)
+        root = Auctioneer(batch_clearing=batch_clearing)
+        concentrators = [Concentrator(root, verify_aggregate=True) for _ in range(3)]
+
+        flat_agents = []
+        tree_agents = []
+        for n in range(9):
+            soc = (n + 1) / 10
+            flat_agents.append(BatteryAgent(flat, id=n, soc=soc))
+            tree_agents.append(BatteryAgent(concentrators[n % 3], id=n, soc=soc))
+        flat_agents.append(LoadAgent(flat, noise_factor=Decimal(0)))
+        tree_agents.append(LoadAgent(concentrators[0], noise_factor=Decimal(0)))
+
+        for _ in range(5):
+            for agent in flat_agents:
+                agent.handle_state_update()
+            flat.end_tick()
+            for concentrator in concentrators:
+                concentrator.handle_state_update()
+            root.end_tick()
+
+            assert root.price == flat.price
+            assert root.get_bidding_ladder() == flat.get_bidding_ladder()
+
+
+def test_concentrator_forwards_registrations():
+    from powermatcher import Concentrator
+
+    # The children of the last concentrator don't bid again, it only sends their registration and removal up
+    for batch_clearing in (False, True):
+        flat = Auctioneer(batch_clearing=batch_clearing)
+        root = Auctioneer(batch_clearing=batch_clearing)
+        concentrators = [Concentrator(root) for _ in range(2)]
+
+        flat_agents = [BatteryAgent(flat, id=0, soc=0.3), ImbalanceAgent(flat)]
+        tree_agents = [BatteryAgent(concentrators[0], id=0, soc=0.3), ImbalanceAgent(concentrators[1])]
+        flat_load = LoadAgent(flat, noise_factor=Decimal(0))
+        tree_load = LoadAgent(concentrators[1], noise_factor=Decimal(0))
+
+        for tick in range(4):
+            if tick == 2:
+                flat.unregister_agent(flat_load)
+                concentrators[1].unregister_agent(tree_load)
+                if not batch_clearing:
+                    # The root clears on the bid the concentrator sends up, the flat market waits for the next bid
+                    flat.clear()
+            elif tick < 2:
+                flat_load.handle_state_update()
+                tree_load.handle_state_update()
+
+            for agent in flat_agents:
+                agent.handle_state_update()
+            flat.end_tick()
+            for concentrator in concentrators:
+                concentrator.handle_state_update()
+            root.end_tick()
+
+            assert root.get_bidding_ladder() == flat.get_bidding_ladder()
+            assert root.price == flat.price
+            assert [agent.current_power for agent in tree_agents] == [agent.current_power for agent in flat_agents]
+
+
+def test_fixed_point_backend_runs_on_ints():
+    random.seed(2)
+    auctioneer = Auctioneer(numeric_backend='fixed', verify_aggregate=True)
+    agents = [LoadAgent(auctioneer), ImbalanceAgent(auctioneer)] + [BatteryAgent(auctioneer, soc=n / 4) for n in range(5)]
+
+    for agent in agents:
+        agent.handle_state_update()
+
+    ladder = auctioneer.get_bidding_ladder()
+    assert all(type(q) is int for q in ladder.quantities) and all(type(p) is int for p in ladder.prices)
+    assert type(auctioneer.price) is int
+    assert auctioneer.max_price == 100000 # Ticks of 0.01
+
+
+def test_fixed_point_backend_takes_ints_as_currency():
+    from powermatcher import Concentrator
+
+    auctioneer = Auctioneer(numeric_backend='fixed', max_price=1000, price_tolerance=2)
+    assert auctioneer.max_price == Auctioneer(numeric_backend='fixed').max_price == 100000
+    assert auctioneer.price_tolerance == 200
+
+    # Prices of another auctioneer are passed on as ticks
+    concentrator = Concentrator(auctioneer)
+    assert (concentrator.max_price, concentrator.price_tolerance) == (100000, 200)
+    assert auctioneer.numeric.price(auctioneer.numeric.price_to_decimal(5)) == 5
+    assert ImbalanceAgent(auctioneer).production_price == 90000
+    assert LoadAgent(auctioneer, load=2000).load == LoadAgent(auctioneer, load=Decimal(2000)).load == 2000000
+
+
+def test_price_change_notifies_affected_agents_only():
+    auctioneer = Auctioneer(batch_clearing=True)
+    low = ImbalanceAgent(auctioneer, consumption_price=Decimal(100), production_price=Decimal(200))
+    high = ImbalanceAgent(auctioneer, consumption_price=Decimal(800), production_price=Decimal(900))
+    battery = BatteryAgent(auctioneer)
+    notified = []
+    for agent in (low, high, battery):
+        agent.handle_price_update = lambda agent=agent: notified.append(agent)
+
+    auctioneer.price = Decimal(500)
+    auctioneer.notify_price_change(Decimal(150))
+    assert notified == [low, battery]
+
+    # From 950 down to 500 only passes the breakpoints of the high agent
+    del notified[:]
+    auctioneer.notify_price_change(Decimal(950))
+    assert notified == [high, battery]
+
+
+def test_agents_handling_prices_themselves_are_notified():
+    from powermatcher import BaseAgent
+
+    class PriceLogger(BaseAgent):
+        def __init__(self, auctioneer):
+            self.prices = []
+            super(PriceLogger, self).__init__(auctioneer)
+
+        def handle_price_update(self):
+            self.prices.append(self.auctioneer.price)
+
+    auctioneer = Auctioneer(batch_clearing=True)
+    logger = PriceLogger(auctioneer)
+    ImbalanceAgent(auctioneer, consumption_price=Decimal(100), production_price=Decimal(200))
+
+    # The bid of the logger has no breakpoints, it is notified anyway
+    auctioneer.price = Decimal(500)
+    auctioneer.notify_price_change(Decimal(150))
+    assert logger.prices[-1] == Decimal(500)
+
+
+def test_runlevels_found_in_one_sweep():
+    auctioneer = Auctioneer()
+    agents = [ImbalanceAgent(auctioneer, consumption_price=Decimal(100 * n), production_price=Decimal(100 * n + 50))
+              for n in range(1, 9)]
+    LoadAgent(auctioneer)
+
+    assert auctioneer.find_runlevels() == [agent.current_power for agent in auctioneer.agents]
+    assert auctioneer.find_runlevels(agents, Decimal(420)) == [agent._lastbid.find_quantity(Decimal(420)) for agent in agents]
+
+
+def test_concentrator_sends_simplified_bid():
+    from powermatcher import Concentrator
+
+    root = Auctioneer(batch_clearing=True)
+    concentrator = Concentrator(root, max_ladder_points=5)
+    for n in range(20):
+        BatteryAgent(concentrator, soc=(n + 1) / 22)
+    concentrator.handle_state_update()
+
+    assert len(concentrator.get_bidding_ladder().prices) > 5
+    assert concentrator._lastbid == concentrator.get_bidding_ladder().simplify(max_points=5)
+    assert len(root.get_bidding_ladder().prices) <= 5
+
+
+def test_horizon_clearing_matches_clearing_every_interval():
+    from benchmark import random_bid
+    from powermatcher import BaseAgent
+
+    rng = random.Random(7)
+    auctioneer = Auctioneer(price_steps=100, batch_clearing=True)
+    agents = [BaseAgent(auctioneer) for _ in range(20)]
+    bids = {agent: [random_bid(auctioneer, rng.randint(1, 5), rng) for _ in range(8)] for agent in agents}
+
+    prices, allocations = auctioneer.clear_horizon(bids)
+    assert len(prices) == 8
+
+    for interval in range(8):
+        for agent in agents:
+            agent.do_bid_update(bids[agent][interval])
+        auctioneer.end_tick()
+
+        assert auctioneer.price == prices[interval]
+        assert all(allocations[agent][interval] == agent.current_power for agent in agents)
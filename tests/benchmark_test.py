@@ -0,0 +1,19 @@
+from benchmark import benchmark_suite, find_regressions
+import json
+
+
+def test_find_regressions():
+    baseline = {'bid_add.10.us': 10.0, 'scenario.10.ticks_per_second': 100.0, 'scenario.10.bytes_per_agent': 1000.0}
+    results = {'bid_add.10.us': 13.0, 'scenario.10.ticks_per_second': 70.0, 'scenario.10.bytes_per_agent': 1100.0,
+               'scenario.100.clearing.ms': 5.0}
+
+    assert find_regressions(baseline, results, 0.25) == [('bid_add.10.us', 10.0, 13.0), ('scenario.10.ticks_per_second', 100.0, 70.0)]
+    assert find_regressions(baseline, results, 0.5) == []
+
+
+def test_suite_saves_and_compares_baseline(tmp_path):
+    baseline = str(tmp_path / 'baseline.json')
+    assert benchmark_suite([1], [10], 2, baseline=baseline, save=True)
+    assert 'scenario.10.clearing.ms' in json.load(open(baseline))['results']
+
+    assert benchmark_suite([1], [10], 2, baseline=baseline, threshold=100)
@@ -1,22 +1,116 @@
-from agents import Bid
+from powermatcher import Auctioneer, Bid, BidCache, FlatBid, InvalidBidException
 from decimal import Decimal
+import pickle
+import pytest
+import random
 
 
-quantity_1 = [Decimal(10), Decimal(9), Decimal(5), Decimal(-5)]
-price_1 = [Decimal(1), Decimal(3), Decimal(5)]
-bid_1 = Bid(quantity_1, price_1)
-print(bid_1.equilibrium_price())
+def test_bid_addition():
+    auctioneer = Auctioneer()
 
-quantity_2 = [Decimal(15), Decimal(5), Decimal(-10)]
-price_2 = [Decimal(1), Decimal(2)]
-bid_2 = Bid(quantity_2, price_2)
+    quantity_1 = [Decimal(10), Decimal(9), Decimal(5), Decimal(-5)]
+    price_1 = [Decimal(1), Decimal(3), Decimal(5)]
+    bid_1 = Bid(auctioneer, quantity_1, price_1)
+    assert bid_1.equilibrium_price() == Decimal(5)
 
-bid_add = bid_1 + bid_2
+    quantity_2 = [Decimal(15), Decimal(5), Decimal(-10)]
+    price_2 = [Decimal(1), Decimal(2)]
+    bid_2 = Bid(auctioneer, quantity_2, price_2)
 
-print(bid_add)
+    bid_add = bid_1 + bid_2
 
-print(bid_add.quantities)
-print(bid_add.prices)
+    assert bid_add.quantities == (Decimal(25), Decimal(14), Decimal(-1), Decimal(-5), Decimal(-15))
+    assert bid_add.prices == (Decimal(1), Decimal(2), Decimal(3), Decimal(5))
 
-bid_add.find_quantity(1.5)
-bid_add.find_quantity(0)
+    assert bid_add.find_quantity(Decimal('1.5')) == Decimal(14)
+    assert bid_add.find_quantity(Decimal(0)) == Decimal(25)
+    assert bid_add.equilibrium_price() == Decimal(2)
+
+
+def test_simplify_bounds_points_and_equilibrium():
+    random.seed(0)
+    auctioneer = Auctioneer()
+    bids = []
+    for _ in range(200):
+        prices = sorted(Decimal(random.randint(1, 100000)) / 100 for _ in range(10))
+        quantities = sorted((Decimal(random.randint(-4000, 4000)) for _ in range(11)), reverse=True)
+        bids.append(Bid(auctioneer, quantities, prices))
+    bid = Bid.sum(bids)
+
+    simplified = bid.simplify(max_points=50)
+    assert len(simplified.prices) <= 50
+    assert simplified.quantities[0] == bid.quantities[0] and simplified.quantities[-1] == bid.quantities[-1]
+
+    # Equilibrium moves up by less than the bucket width (price range / max_points)
+    assert bid.equilibrium_price() <= simplified.equilibrium_price() < bid.equilibrium_price() + Decimal(20)
+
+    simplified = bid.simplify(tolerance=Decimal(5))
+    assert bid.equilibrium_price() <= simplified.equilibrium_price() < bid.equilibrium_price() + Decimal(5)
+    assert all(b - a > 0 for a, b in zip(simplified.prices, simplified.prices[1:]))
+
+    # Ladders within the limits stay as they are
+    assert bids[0].simplify(max_points=10) is bids[0]
+
+
+def test_bid_of_other_number_type_is_invalid():
+    auctioneer = Auctioneer(numeric_backend='fixed')
+
+    for quantities in (Decimal(5), 5.0, (Decimal(5),)):
+        with pytest.raises(InvalidBidException):
+            Bid(auctioneer, quantities)
+    assert Bid(auctioneer, 5).quantities == (5,)
+
+
+def test_flat_bids_are_immutable_and_add_like_ladders():
+    auctioneer = Auctioneer()
+    flat = Bid(auctioneer, Decimal(-300))
+    ladder = Bid(auctioneer, (Decimal(500), Decimal(100)), (Decimal(400),))
+    assert isinstance(flat, FlatBid) and isinstance(Bid(auctioneer), FlatBid) and not isinstance(ladder, FlatBid)
+
+    with pytest.raises(AttributeError):
+        flat.quantities = (Decimal(1),)
+    assert not hasattr(flat, '__dict__')
+
+    assert flat + ladder == ladder + flat == Bid(auctioneer, (Decimal(200), Decimal(-200)), (Decimal(400),))
+    assert flat + flat == Bid(auctioneer, Decimal(-600))
+    assert flat.equilibrium_price() == auctioneer.min_price and flat.find_quantity(Decimal(10)) == Decimal(-300)
+
+    assert hash(flat) == hash(Bid(auctioneer, Decimal(-300)))
+    restored = pickle.loads(pickle.dumps(ladder))
+    assert restored == ladder and hash(restored) == hash(ladder)
+
+
+def test_bid_cache_shares_equal_bids():
+    auctioneer = Auctioneer()
+    cache = BidCache(2)
+    first = cache.intern(Bid(auctioneer, Decimal(1)))
+    assert cache.intern(Bid(auctioneer, Decimal(1))) is first
+
+    # Least recently used bid is evicted
+    cache.intern(Bid(auctioneer, Decimal(2)))
+    cache.intern(Bid(auctioneer, Decimal(1)))
+    cache.intern(Bid(auctioneer, Decimal(3)))
+    assert cache.intern(Bid(auctioneer, Decimal(1))) is first
+    assert list(cache.bids) == [Bid(auctioneer, Decimal(3)), Bid(auctioneer, Decimal(1))]
+
+
+def test_indexed_queries_match_linear_scan():
+    rng = random.Random(1)
+    auctioneer = Auctioneer()
+    for _ in range(50):
+        prices = sorted(set(Decimal(rng.randint(1, 1000)) for _ in range(rng.randint(1, 20))))
+        quantities = sorted((Decimal(rng.randint(-1000, 1000)) for _ in range(len(prices) + 1)), reverse=True)
+        bid = Bid(auctioneer, quantities, prices)
+
+        queries = [Decimal(rng.randint(0, 1000)) for _ in range(20)] + prices
+        expected = [next((q for p, q in zip(prices, quantities) if price < p), quantities[-1]) for price in queries]
+        assert bid.find_quantities(queries) == expected == [bid.find_quantity(price) for price in queries]
+
+        crossing = next((p_i for p_i, q in enumerate(quantities) if q <= 0), None)
+        if crossing is None:
+            assert bid.equilibrium_price() == auctioneer.max_price
+        elif crossing == 0:
+            assert bid.equilibrium_price() == auctioneer.min_price
+        else:
+            assert bid.equilibrium_price() == prices[crossing - 1]
+        assert bid.equilibrium_price() is bid.equilibrium_price()
@@ -0,0 +1,93 @@
+from agents import BatteryAgent, ImbalanceAgent, LoadAgent
+from benchmark import create_scenario
+from powermatcher import Auctioneer, Concentrator
+from replay import record, replay
+import bidtrace
+import os
+import random
+
+
+def test_replay_matches_recorded_prices(tmp_path):
+    path = str(tmp_path / 'trace.bin')
+    events = record(path, 12, hours=3)
+
+    result = replay(path)
+    assert (result.markets, result.clearings, result.mismatches) == (1, 181, 0)
+    assert result.bids + 12 == events - result.clearings
+
+    # Another aggregation finds other prices
+    assert replay(path, price_steps=10).mismatches > 0
+
+
+def test_trace_of_concentrators_on_fixed_point(tmp_path):
+    random.seed(3)
+    path = str(tmp_path / 'trace.bin')
+    root = Auctioneer(id='Root', numeric_backend='fixed', batch_clearing=False)
+    concentrator = Concentrator(root, id='Concentrator')
+    agents = [LoadAgent(concentrator), ImbalanceAgent(root)] + [BatteryAgent(concentrator, soc=n / 4) for n in range(4)]
+
+    bidtrace.set_recorder(bidtrace.TraceRecorder(path))
+    try:
+        for agent in agents:
+            agent.handle_state_update()
+        concentrator.end_tick()
+        root.unregister_agent(agents[1])
+        BatteryAgent(root, soc=0.5).handle_state_update()
+        bidtrace.flush()
+
+        # Everything up to the last flush can be read while recording
+        records = list(bidtrace.read_trace(path))
+    finally:
+        bidtrace.set_recorder(None)
+
+    assert [record[2]['id'] for record in records if record[0] == 'M'] == ['Concentrator', 'Root']
+    assert all(type(q) is int for record in records if record[0] == 'B' for q in record[4][0])
+    assert sum(record[0] == 'R' for record in records) == 1
+    assert replay(path).mismatches == 0
+
+
+def test_trace_of_long_aggregated_ladder(tmp_path):
+    from decimal import Decimal
+    from powermatcher import BaseAgent, Bid
+
+    path = str(tmp_path / 'trace.bin')
+    root = Auctioneer(id='Root', batch_clearing=True)
+    concentrator = Concentrator(root, id='Concentrator')
+    agents = [BaseAgent(concentrator) for _ in range(2)]
+
+    bidtrace.set_recorder(bidtrace.TraceRecorder(path))
+    try:
+        # Ladders with alternating prices, their aggregate has more prices than fit in 16 bits
+        for a_i, agent in enumerate(agents):
+            prices = tuple(Decimal(2 * n + a_i + 1) / 100 for n in range(35000))
+            quantities = tuple(Decimal(17500 - n) for n in range(35001))
+            agent.do_bid_update(Bid(concentrator, quantities, prices))
+        concentrator.end_tick()
+        root.end_tick()
+    finally:
+        bidtrace.set_recorder(None)
+
+    bids = [record[4] for record in bidtrace.read_trace(path) if record[0] == 'B']
+    assert len(bids[-1][1]) == len(root.get_bidding_ladder().prices) == 70000
+    assert replay(path).mismatches == 0
+
+
+def test_replay_keeps_global_telemetry(tmp_path):
+    import influx
+    import replay as replay_module
+    import subprocess
+    import sys
+
+    path = str(tmp_path / 'trace.bin')
+    record(path, 4, hours=1)
+
+    writes = []
+    sink = influx.TelemetrySink()
+    sink.write = lambda *point: writes.append(point)
+    influx.set_sink(sink)
+    assert replay(path).mismatches == 0
+    assert influx.sink is sink and writes == []
+
+    # Replaying doesn't load the benchmark scenarios
+    code = "import sys, replay; sys.exit('benchmark' in sys.modules)"
+    assert subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(replay_module.__file__)).returncode == 0
@@ -0,0 +1,73 @@
+from agents import PVAgent, BatteryAgent, LoadAgent, ImbalanceAgent
+from checkpoint import Checkpointer, load, save
+from powermatcher import Auctioneer, Concentrator
+from recorder import ColumnarRecorder
+import datetime
+import ext
+import influx
+import random
+
+
+def create_environment():
+    random.seed(3)
+    environment = ext.environment
+    environment.start_time = datetime.datetime(2017, 6, 1)
+    environment.current_time = environment.start_time
+    environment.stop_time = environment.start_time + datetime.timedelta(hours=12)
+
+    auctioneer = Auctioneer(id='Checkpoint', batch_clearing=True)
+    concentrator = Concentrator(auctioneer, id='Concentrator')
+    for n in range(8):
+        agent_type = (LoadAgent, PVAgent, BatteryAgent, ImbalanceAgent)[n % 4]
+        agent_type(concentrator if n % 2 else auctioneer, id=n)
+    environment.auctioneers = [auctioneer]
+    return environment
+
+
+def run(environment, checkpointer=None):
+    recorder = ColumnarRecorder()
+    influx.set_sink(recorder)
+    environment.checkpointer = checkpointer
+    try:
+        environment.start()
+    finally:
+        environment.checkpointer = None
+        influx.set_sink(None)
+
+    auctioneer = environment.auctioneers[0]
+    return auctioneer.get_market_state(), recorder.get('auctioneer_prices', auctioneer_id='Checkpoint')
+
+
+def test_restored_snapshot_continues_like_the_original_run(tmp_path):
+    environment = create_environment()
+    checkpointer = Checkpointer(str(tmp_path), datetime.timedelta(hours=4))
+    state, prices = run(environment, checkpointer)
+
+    snapshots = checkpointer.snapshots()
+    assert len(snapshots) == 3
+    assert len([name for name in tmp_path.iterdir() if name.name.startswith('structure-')]) == 1
+
+    # Fork from 8:01 twice, the variants are independent copies
+    for _ in range(2):
+        load(snapshots[1])
+        assert environment.current_time == datetime.datetime(2017, 6, 1, 8, 1)
+        restored_state, restored_prices = run(environment)
+
+        assert restored_state == state
+        after = prices['time'] >= restored_prices['time'][0]
+        assert (restored_prices['price'] == prices['price'][after]).all()
+
+
+def test_full_checkpoint_between_runs(tmp_path):
+    environment = create_environment()
+    state, _ = run(environment)
+
+    environment = create_environment()
+    environment.stop_time = datetime.datetime(2017, 6, 1, 6)
+    run(environment)
+    save(str(tmp_path / 'checkpoint.pickle'))
+
+    environment = load(str(tmp_path / 'checkpoint.pickle'))
+    environment.stop_time = datetime.datetime(2017, 6, 1, 12)
+    restored_state, _ = run(environment)
+    assert restored_state == state
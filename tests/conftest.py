@@ -0,0 +1,35 @@
+# Every test runs hermetic: with the default settings whatever the environment variables are, InfluxDB disabled,
+# telemetry discarded, a new default environment and no metrics or bid trace left by another test
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'pythonmatcher'))
+
+import bidtrace
+import influx
+import metrics
+import pytest
+import runtime
+import settings
+
+
+@pytest.fixture(autouse=True)
+def hermetic_runtime():
+    settings.reload(environ={'INFLUXDB_ENABLED': 'false'})
+    influx.set_sink(influx.TelemetrySink())
+    influx.set_reduction(None)
+    runtime._default = None
+    metrics.enable(False)
+    metrics.reset()
+    bidtrace.set_recorder(None)
+
+    yield
+
+    bidtrace.set_recorder(None)
+    metrics.enable(False)
+    metrics.reset()
+    runtime._default = None
+    influx.set_reduction(None)
+    influx.set_sink(None)
+    settings.reload()
@@ -0,0 +1,26 @@
+from agents import BatteryAgent
+from decimal import Decimal
+from fleets import BatteryFleet, Fleet
+from powermatcher import Auctioneer
+import numpy as np
+
+
+def test_battery_fleet_follows_battery_agent_ladders():
+    socs = [0, 0.1, 0.3, 0.5, 0.7, 0.99, 1]
+    auctioneer = Auctioneer()
+    agents = [BatteryAgent(auctioneer, soc=soc) for soc in socs]
+    fleet = BatteryFleet(Auctioneer(), [10] * len(socs), socs=socs)
+
+    for price in (Decimal(0), Decimal(1), Decimal(333), Decimal(500), Decimal(777), Decimal(1000)):
+        auctioneer.price = fleet.auctioneer.price = price
+        fleet.do_runlevel_update()
+
+        expected = [float(agent.calculate_bid().find_quantity(price)) for agent in agents]
+        assert np.allclose(fleet.powers, expected)
+
+
+def test_battery_fleet_bid_matches_dense_evaluation():
+    rng = np.random.default_rng(0)
+    fleet = BatteryFleet(Auctioneer(), rng.uniform(5, 15, 500), socs=rng.uniform(-0.1, 1.1, 500).clip(0, 1))
+
+    assert fleet.calculate_bid() == Fleet.calculate_bid(fleet)
@@ -0,0 +1,62 @@
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from influx import BatchWriter, encode_line
+import datetime
+import threading
+
+
+class StubInfluxHandler(BaseHTTPRequestHandler):
+    """ Accepts writes like InfluxDB and stores the received lines on the server """
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8')
+        self.server.requests.append((self.path, body.split('\n')))
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_server():
+    server = HTTPServer(('127.0.0.1', 0), StubInfluxHandler)
+    server.requests = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def test_encode_line():
+    line = encode_line("deviceagent_power", {"deviceagent_id": "Load Agent", "auctioneer_id": "Sim"}, {'power': 1.5},
+                       datetime.datetime(1970, 1, 1, 0, 0, 1))
+    assert line == 'deviceagent_power,auctioneer_id=Sim,deviceagent_id=Load\\ Agent power=1.5 1000000000'
+
+
+def test_encode_line_escapes_backslashes_and_skips_non_finite_fields():
+    line = encode_line("prices", {"id": "C:\\temp,x"}, {'price': float('nan'), 'power': 2.0, 'load': float('inf')}, None)
+    assert line == 'prices,id=C:\\\\temp\\,x power=2.0'
+    assert encode_line("prices", {}, {'price': float('-inf')}, None) is None
+
+
+def test_batch_writer_sends_batches_and_flushes_on_close():
+    server = start_stub_server()
+    writer = BatchWriter('test', host='127.0.0.1', port=server.server_address[1], batch_size=10, flush_interval=60)
+
+    for n in range(25):
+        writer.write("auctioneer_prices", {"auctioneer_id": "Sim"}, {'price': float(n)}, datetime.datetime(2017, 1, 1))
+    writer.write("auctioneer_prices", {"auctioneer_id": "Sim"}, {'price': float('nan')}, datetime.datetime(2017, 1, 1))
+    writer.close()
+    server.shutdown()
+
+    assert [len(lines) for path, lines in server.requests] == [10, 10, 5]
+    assert all(path.startswith('/write?db=test') for path, lines in server.requests)
+    assert writer.written_points == 25 and writer.dropped_points == 1
+
+
+def test_batch_writer_drops_points_when_full():
+    writer = BatchWriter('test', host='127.0.0.1', port=1, batch_size=10, flush_interval=60, max_queue_size=5,
+                         drop_on_overflow=True, timeout=1)
+
+    for n in range(8):
+        writer.write("auctioneer_prices", {"auctioneer_id": "Sim"}, {'price': float(n)}, None)
+
+    assert writer.queue_size() == 5
+    assert writer.dropped_points == 3
@@ -0,0 +1,45 @@
+from benchmark import random_bid
+from decimal import Decimal
+from marketbasis import ArrayBid, MarketBasis
+from powermatcher import Auctioneer, Bid
+import random
+
+
+def test_array_bid_round_trip():
+    auctioneer = Auctioneer()
+    market_basis = MarketBasis(price_steps=11) # Steps of 100
+    bid = Bid(auctioneer, (Decimal(3000), Decimal('1500.5'), Decimal(0), Decimal(-2000)), (Decimal(200), Decimal(500), Decimal(900)))
+
+    array_bid = ArrayBid.from_bid(market_basis, bid)
+    assert [array_bid.find_quantity(p) for p in market_basis.prices] == [bid.find_quantity(p) for p in market_basis.prices]
+    assert array_bid.to_bid(auctioneer) == bid
+    assert ArrayBid.from_bid(market_basis, array_bid.to_bid(auctioneer)) == array_bid
+
+
+def test_array_bid_sum_matches_exact_sum():
+    rng = random.Random(3)
+    auctioneer = Auctioneer()
+    market_basis = MarketBasis(price_steps=100)
+    bids = [random_bid(auctioneer, rng.randint(1, 10), rng) for _ in range(30)]
+
+    array_sum = ArrayBid(market_basis)
+    for bid in bids:
+        array_sum += ArrayBid.from_bid(market_basis, bid)
+
+    assert array_sum == ArrayBid.from_bid(market_basis, Bid.sum(bids))
+
+
+def test_array_bid_equilibrium_at_edges():
+    auctioneer = Auctioneer()
+    market_basis = MarketBasis(price_steps=11)
+
+    demand = Bid(auctioneer, (Decimal(2000), Decimal(1000)), (Decimal(500),))
+    assert ArrayBid.from_bid(market_basis, demand).equilibrium_price() == market_basis.max_price
+
+    supply = Bid(auctioneer, (Decimal(-1000), Decimal(-2000)), (Decimal(500),))
+    assert ArrayBid.from_bid(market_basis, supply).equilibrium_price() == market_basis.min_price
+
+    # Crossing zero at 250 lies between the steps at 200 and 300, the first step without demand is taken
+    crossing = Bid(auctioneer, (Decimal(1000), Decimal(-1000)), (Decimal(250),))
+    assert crossing.equilibrium_price() == Decimal(250)
+    assert ArrayBid.from_bid(market_basis, crossing).equilibrium_price() == Decimal(300)
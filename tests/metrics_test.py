@@ -0,0 +1,58 @@
+from agents import BatteryAgent, LoadAgent, PVAgent
+from powermatcher import Auctioneer
+from recorder import ColumnarRecorder
+import datetime
+import ext
+import influx
+import metrics
+import settings
+
+
+def test_metrics_and_profile_of_run(monkeypatch):
+    environment = ext.environment
+    environment.auctioneers = []
+    environment.start_time = datetime.datetime(2017, 6, 1, 12)
+    environment.current_time = environment.start_time
+    environment.stop_time = environment.start_time + datetime.timedelta(minutes=9)
+
+    auctioneer = Auctioneer(id='Metrics', batch_clearing=True)
+    LoadAgent(auctioneer)
+    PVAgent(auctioneer)
+    BatteryAgent(auctioneer)
+    environment.register_auctioneer(auctioneer)
+
+    recorder = ColumnarRecorder()
+    influx.set_sink(recorder)
+    monkeypatch.setattr(settings, 'profile_sample_interval', 3)
+    metrics.reset()
+    metrics.enable()
+    try:
+        environment.start()
+    finally:
+        metrics.enable(False)
+        influx.set_sink(None)
+
+    assert metrics.counters['environment.ticks'] == 10
+    assert metrics.stats['agent.BatteryAgent.handle_state_update.seconds'][0] == 10
+    assert metrics.stats['environment.clearings_per_tick'][1] == metrics.counters['auctioneer.clearings']
+    assert environment.profiler.sampled_ticks == 4
+
+    exported = recorder.get('metrics', metric='auctioneer.ladder_length')
+    assert exported['count'][0] == metrics.stats['auctioneer.ladder_length'][0]
+    metrics.reset()
+
+
+def test_metrics_of_market_basis_clearing():
+    auctioneer = Auctioneer(id='Basis', price_steps=100, batch_clearing=True)
+    agents = [LoadAgent(auctioneer), BatteryAgent(auctioneer, soc=0.5)]
+
+    metrics.enable()
+    try:
+        for agent in agents:
+            agent.handle_state_update()
+        auctioneer.end_tick()
+    finally:
+        metrics.enable(False)
+
+    assert metrics.counters['auctioneer.clearings'] == 1
+    assert metrics.stats['auctioneer.ladder_length'][2] == 100
@@ -0,0 +1,50 @@
+from agents import LoadAgent, PVAgent
+from fleets import LoadFleet
+from powermatcher import Auctioneer
+from profiles import open_profile, save_profile
+import datetime
+import ext
+import numpy as np
+import pickle
+
+
+def test_resampling_of_profile(tmp_path):
+    start = datetime.datetime(2017, 6, 1)
+    path = str(tmp_path / 'loads.npy')
+    values = np.arange(120, dtype=float)[:, None] * [1, 10] # Per minute, two sites
+    save_profile(path, values, start, datetime.timedelta(minutes=1), sites=['a', 'b'])
+
+    reader = open_profile(path)
+    assert reader.profile.values.base is not None and not reader.profile.values.flags.writeable # A view of the mmap
+    assert reader.profile.values.shape == (120, 2)
+    assert reader.profile.index('b') == 1
+
+    # Mean of finer samples, the covering sample of coarser ones
+    assert list(reader.row(start + datetime.timedelta(minutes=15), datetime.timedelta(minutes=15))) == [22, 220]
+    assert reader.value(1, start + datetime.timedelta(seconds=90), datetime.timedelta(seconds=30)) == 10
+
+    # Readers are shared and pickled without their data
+    assert len(pickle.dumps(reader)) < 200
+    assert pickle.loads(pickle.dumps(reader)) is reader
+
+
+def test_agents_follow_profile(tmp_path):
+    start = datetime.datetime(2017, 6, 1)
+    path = str(tmp_path / 'sites.npy')
+    save_profile(path, np.tile([[1000, 2000, 3000]], (60, 1)), start, datetime.timedelta(minutes=5))
+
+    environment = ext.environment
+    environment.start_time = start
+    environment.current_time = start
+    environment.stop_time = start + datetime.timedelta(hours=2)
+
+    auctioneer = Auctioneer(id='Profiles', batch_clearing=True)
+    load = LoadAgent(auctioneer, noise_factor=0, profile=path, site=1)
+    pv = PVAgent(auctioneer, noise_factor=0, profile=path, site=0)
+    fleet = LoadFleet(auctioneer, noise_factors=0, profile=path, sites=[2, 0])
+    environment.auctioneers = [auctioneer]
+    environment.start()
+
+    assert auctioneer.numeric.quantity_to_float(load.current_power) == 2000
+    assert auctioneer.numeric.quantity_to_float(pv.current_power) == -1000
+    assert list(fleet.powers) == [3000, 1000]
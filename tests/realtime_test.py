@@ -0,0 +1,89 @@
+from decimal import Decimal
+from powermatcher import Auctioneer
+from realtime import AgentClientProtocol, RealtimeAuctioneer, connect
+import asyncio
+import socket
+
+
+def test_bids_in_window_are_cleared_once():
+    async def run():
+        market = RealtimeAuctioneer(Auctioneer(id='Realtime'), clearing_window=0.05)
+        load = market.connect(id='Load')
+        pv = market.connect(id='PV')
+
+        assert (await load.receive())['type'] == 'market'
+        assert (await load.receive()) == {'type': 'price', 'price': '500'}
+
+        load.submit_bid(Decimal(1000))
+        pv.submit_bid((Decimal(500), Decimal(-2000)), (Decimal(100),))
+        await asyncio.sleep(0.1)
+
+        assert len(market.clearing_latencies) == 1
+        assert (await load.receive()) == {'type': 'price', 'price': '100'}
+
+    asyncio.run(run())
+
+
+def test_session_closed_outside_event_loop():
+    auctioneer = Auctioneer(id='Realtime')
+    market = RealtimeAuctioneer(auctioneer)
+    session = market.connect()
+
+    session.close()
+    assert not market.sessions and not auctioneer.agents
+
+
+def test_slow_client_gets_latest_price():
+    async def run():
+        market = RealtimeAuctioneer(Auctioneer(id='Realtime'), clearing_window=0.01)
+        slow = market.connect()
+        load = market.connect()
+        await load.receive()
+        await load.receive()
+
+        # The slow session didn't receive its first message yet, prices in between are replaced
+        for quantity in (1000, -1000, 1000):
+            load.submit_bid(Decimal(quantity))
+            await asyncio.sleep(0.05)
+            assert (await load.receive())['type'] == 'price'
+
+        assert (await slow.receive())['type'] == 'market'
+        assert (await slow.receive()) == {'type': 'price', 'price': '1000'}
+        assert not slow._messages
+
+    asyncio.run(run())
+
+
+def test_remote_agent_over_websocket():
+    class RemoteAgent(AgentClientProtocol):
+        def __init__(self):
+            super(RemoteAgent, self).__init__()
+            self.prices = asyncio.Queue()
+
+        def handle_market(self, message):
+            self.submit_bid([Decimal(-500)])
+
+        def handle_price(self, price):
+            self.prices.put_nowait(price)
+
+    async def run():
+        market = RealtimeAuctioneer(Auctioneer(id='Realtime'), clearing_window=0.01)
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+
+        server = await market.serve('127.0.0.1', port)
+        agent = await connect(RemoteAgent, '127.0.0.1', port)
+
+        assert (await asyncio.wait_for(agent.prices.get(), 5)) == '500'
+        assert (await asyncio.wait_for(agent.prices.get(), 5)) == '0'
+
+        agent.submit_bid(['invalid'])
+        agent.sendClose()
+        await asyncio.sleep(0.1)
+        assert not market.sessions
+
+        server.close()
+        await server.wait_closed()
+
+    asyncio.run(run())
@@ -0,0 +1,32 @@
+from recorder import ColumnarRecorder
+import datetime
+import numpy as np
+
+
+def test_recorder_spills_and_reopens(tmp_path):
+    recorder = ColumnarRecorder(str(tmp_path), chunk_size=4)
+    start = datetime.datetime(2017, 1, 1)
+
+    for n in range(10):
+        recorder.write("deviceagent_soc", {"agent_id": "Battery", "auctioneer_id": "Sim"}, {'power': n / 10},
+                       start + datetime.timedelta(minutes=n))
+    recorder.close()
+
+    arrays = ColumnarRecorder.open(str(tmp_path)).get("deviceagent_soc", agent_id="Battery", auctioneer_id="Sim")
+    assert list(arrays['power']) == [n / 10 for n in range(10)]
+    assert arrays['time'][1] - arrays['time'][0] == 60 * 10**9
+
+
+def test_recorder_widens_schema_for_new_fields(tmp_path):
+    recorder = ColumnarRecorder(str(tmp_path), chunk_size=4)
+    start = datetime.datetime(2017, 1, 1)
+
+    for n in range(6):
+        fields = {'power': float(n), 'soc': n / 10} if n >= 5 else {'power': float(n)}
+        recorder.write("battery", {"agent_id": "Battery"}, fields, start + datetime.timedelta(minutes=n))
+    recorder.write("battery", {"agent_id": "Battery"}, {'soc': 0.6}, start + datetime.timedelta(minutes=6))
+    recorder.close()
+
+    arrays = ColumnarRecorder.open(str(tmp_path)).get("battery", agent_id="Battery")
+    assert list(arrays['power'][:6]) == [float(n) for n in range(6)] and np.isnan(arrays['power'][6])
+    assert np.isnan(arrays['soc'][:5]).all() and list(arrays['soc'][5:]) == [0.5, 0.6]
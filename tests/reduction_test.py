@@ -0,0 +1,75 @@
+from benchmark import create_scenario
+from recorder import ColumnarRecorder
+from reduction import Reduction
+import datetime
+import influx
+
+
+def test_deadband_and_rollup():
+    points = []
+    start = datetime.datetime(2017, 6, 1)
+    minute = datetime.timedelta(minutes=1)
+    reduction = Reduction({'soc': {'absolute': 0.01}, 'power': {'window': 10, 'relative': 0.1}},
+                          lambda *point: points.append(point))
+
+    for m, soc in enumerate([0.5, 0.505, 0.509, 0.52, 0.521]):
+        reduction.write('soc', {'agent_id': 1}, {'value': soc}, start + m * minute, 'db')
+    assert [point[2]['value'] for point in points] == [0.5, 0.52]
+
+    # 100 W for 6 minutes and 400 W for 4 minutes, then a window without changes
+    del points[:]
+    for m, power in [(0, 100.0), (6, 400.0), (25, 50.0)]:
+        reduction.write('power', {'agent_id': 1}, {'power': power}, start + m * minute, 'db')
+    assert [(point[3], point[2]) for point in points] == [
+        (start, {'power': 220.0, 'power_min': 100.0, 'power_max': 400.0, 'power_last': 400.0})]
+
+    # The window from minute 20 started at 400 W, flush writes it and the held soc
+    reduction.flush()
+    assert points[1][3] == start + 20 * minute and points[1][2]['power'] == 400.0 and points[1][2]['power_min'] == 50.0
+    assert points[2][2] == {'value': 0.521}
+    assert (reduction.received_points, reduction.written_points) == (8, 5)
+
+
+def test_rollup_of_points_with_other_fields():
+    points = []
+    start = datetime.datetime(2017, 6, 1)
+    minute = datetime.timedelta(minutes=1)
+    reduction = Reduction({'battery': {'window': 10}}, lambda *point: points.append(point))
+
+    # The soc is missing from the second point and keeps its value, the power is only known from minute 5
+    reduction.write('battery', {'agent_id': 1}, {'soc': 0.5}, start, 'db')
+    reduction.write('battery', {'agent_id': 1}, {'power': 100.0}, start + 5 * minute, 'db')
+    reduction.write('battery', {'agent_id': 1}, {'soc': 0.7, 'power': 300.0}, start + 8 * minute, 'db')
+    reduction.write('battery', {'agent_id': 1}, {'soc': 0.1}, start + 30 * minute, 'db')
+
+    fields = points[0][2]
+    assert fields['soc'] == 0.5 * 0.8 + 0.7 * 0.2 and fields['soc_last'] == 0.7
+    assert fields['power'] == 100.0 * 0.6 + 300.0 * 0.4 and fields['power_min'] == 100.0
+
+    # Nothing is written for the windows from minute 10 and 20 without points
+    reduction.flush()
+    assert [point[3] for point in points] == [start, start + 30 * minute]
+    assert points[1][2]['power'] == 300.0 and points[1][2]['soc'] == 0.1
+
+
+def test_reduction_of_simulation():
+    counts = []
+    for rules in (None, {'deviceagent_power': {'window': 15, 'relative': 0.01}, 'deviceagent_soc': {'absolute': 0.01}}):
+        environment, auctioneer = create_scenario(40, hours=6)
+        recorder = ColumnarRecorder()
+        influx.set_sink(recorder)
+        influx.set_reduction(Reduction(rules, influx._write_point) if rules else None)
+        try:
+            environment.start()
+        finally:
+            influx.set_sink(None)
+            influx.set_reduction(None)
+
+        series = [recorder.get(measurement, **tags) for measurement in ('deviceagent_power', 'deviceagent_soc')
+                  for tags in recorder.find(measurement)]
+        counts.append(sum(len(s['time']) for s in series))
+
+    assert counts[1] * 10 < counts[0]
+    # Same measurement, tags and field as before for the dashboards
+    power = recorder.get('deviceagent_power', deviceagent_id='LoadAgent-0', auctioneer_id='Benchmark')
+    assert set(power) == {'time', 'power', 'power_min', 'power_max', 'power_last'}
@@ -0,0 +1,92 @@
+from agents import BatteryAgent, ImbalanceAgent, LoadAgent, PVAgent
+from powermatcher import Auctioneer
+from recorder import ColumnarRecorder
+from runtime import Context
+from settings import Settings
+import datetime
+import os
+import random
+import subprocess
+import sys
+import threading
+
+
+def create_simulation(seed, batch_clearing):
+    # Own environment, telemetry and settings, the environment variables of the process don't matter
+    random.seed(seed)
+    context = Context(sink=ColumnarRecorder(), settings=Settings(environ={}, auctioneer_batch_clearing=batch_clearing))
+    environment = context.environment
+    environment.start_time = environment.current_time = datetime.datetime(2017, 6, 1)
+    environment.stop_time = environment.start_time + datetime.timedelta(hours=6)
+
+    auctioneer = Auctioneer(id='Market', context=context)
+    for n in range(8):
+        (LoadAgent, PVAgent, BatteryAgent, ImbalanceAgent)[n % 4](auctioneer, id=str(n))
+    environment.register_auctioneer(auctioneer)
+    return context, auctioneer
+
+
+def test_simulations_run_concurrently_in_one_interpreter():
+    alone = create_simulation(1, batch_clearing=True)
+    alone[0].environment.start()
+
+    simulations = [create_simulation(1, batch_clearing=True), create_simulation(2, batch_clearing=False)]
+    threads = [threading.Thread(target=context.environment.start) for context, _ in simulations]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert [auctioneer.batch_clearing for _, auctioneer in simulations] == [True, False]
+    prices = [context.sink.get('auctioneer_prices', auctioneer_id='Market') for context, _ in [alone] + simulations]
+    assert list(prices[1]['price']) == list(prices[0]['price']) != list(prices[2]['price'])
+    assert simulations[0][1].agents[2].soc == alone[1].agents[2].soc
+
+
+def test_auctioneer_runs_in_context_of_its_environment():
+    from environment import SimulationEnvironment
+    from powermatcher import Concentrator
+    import influx
+
+    recorder = ColumnarRecorder()
+    influx.set_sink(recorder)
+    environment = SimulationEnvironment(datetime.datetime(2017, 6, 1), datetime.datetime(2017, 6, 1, 0, 5))
+
+    # Created without a context, in the default one
+    auctioneer = Auctioneer(id='Market')
+    concentrator = Concentrator(auctioneer, id='Concentrator')
+    LoadAgent(concentrator, id='Load')
+    environment.register_auctioneer(auctioneer)
+    assert concentrator.context is concentrator.agents[0].context is environment.context
+    environment.start()
+
+    # Written through influx (the context has no sink), at the times of this environment
+    times = recorder.get('auctioneer_prices', auctioneer_id='Market')['time']
+    assert times[0] == influx.to_nanoseconds(environment.start_time)
+    assert times[-1] <= influx.to_nanoseconds(environment.stop_time)
+
+
+def test_import_has_no_side_effects():
+    # Nothing of InfluxDB, numpy or the default environment is loaded, no threads are started and no shutdown or fork
+    # hooks are registered
+    code = ("import atexit, os, sys, threading; hooks = []; "
+            "register = atexit.register; atexit.register = lambda f, *a, **k: (hooks.append(f), register(f, *a, **k))[1]; "
+            "os.register_at_fork = lambda **k: hooks.extend(k.values()); "
+            "import agents, bidtrace, influx, metrics, powermatcher, replay; "
+            "loaded = [m for m in ('influxdb', 'numpy', 'ext', 'runtime', 'concurrent.futures') if m in sys.modules]; "
+            "ours = [f for f in hooks if f.__module__ in sys.modules and 'pythonmatcher' in (sys.modules[f.__module__].__file__ or '')]; "
+            "assert loaded == ['runtime'] and influx.executor is None and threading.active_count() == 1, loaded; "
+            "assert not ours, ours")
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'pythonmatcher')
+    subprocess.run([sys.executable, '-c', code], check=True, env=dict(os.environ, PYTHONPATH=path))
+
+
+def test_settings_of_context_are_used(tmp_path):
+    from settings import Settings
+    import bidtrace
+
+    context = Context(sink=ColumnarRecorder(), settings=Settings(environ={}, numeric_backend='fixed'))
+    assert Auctioneer(context=context).numeric.name == 'fixed' and Auctioneer().numeric.name == 'decimal'
+
+    path = str(tmp_path / 'trace.bin')
+    assert bidtrace.start_recording(settings=Settings(environ={}, bid_trace_path=path)).path == path
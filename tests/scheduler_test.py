@@ -0,0 +1,89 @@
+from agents import PVAgent, BatteryAgent, LoadAgent, ImbalanceAgent
+from powermatcher import Auctioneer
+from recorder import ColumnarRecorder
+from scheduler import run_event_driven
+import datetime
+import ext
+import influx
+import os
+import pytest
+import random
+
+
+def run(event_driven, agent_types, days):
+    random.seed(1)
+    environment = ext.environment
+    environment.auctioneers = []
+    environment.start_time = datetime.datetime(2017, 6, 1)
+    environment.current_time = environment.start_time
+    environment.stop_time = environment.start_time + datetime.timedelta(days=days)
+
+    auctioneer = Auctioneer(id='Scheduler', batch_clearing=True)
+    for n, agent_type in enumerate(agent_types):
+        agent_type(auctioneer, id='{}-{}'.format(agent_type.__name__, n))
+    environment.register_auctioneer(auctioneer)
+
+    recorder = ColumnarRecorder()
+    influx.set_sink(recorder)
+    try:
+        if event_driven:
+            updates = run_event_driven(environment)
+        else:
+            environment.start()
+            updates = None
+    finally:
+        influx.set_sink(None)
+
+    return recorder.get('auctioneer_prices', auctioneer_id='Scheduler'), [agent.get_state() for agent in auctioneer.agents], updates
+
+
+def test_event_driven_equals_every_tick():
+    agent_types = [LoadAgent, PVAgent, PVAgent, BatteryAgent, ImbalanceAgent, ImbalanceAgent]
+    prices, states, _ = run(False, agent_types, 1)
+    event_prices, event_states, updates = run(True, agent_types, 1)
+
+    assert event_states == states
+    assert all((event_prices[k] == prices[k]).all() for k in prices)
+    assert updates < len(agent_types) * (24 * 60 + 1)
+
+
+def test_quiet_agents_sleep():
+    # PV agents only update during the day, imbalance agents only once
+    _, _, updates = run(True, [PVAgent, ImbalanceAgent], 3)
+    assert updates == 3 * (12 * 60 + 2) + 1 + 1
+
+
+def test_tick_hooks_run_on_skipped_ticks(tmp_path):
+    from checkpoint import Checkpointer
+
+    environment = ext.environment
+    environment.auctioneers = []
+    environment.start_time = datetime.datetime(2017, 6, 1)
+    environment.current_time = environment.start_time
+    environment.stop_time = environment.start_time + datetime.timedelta(hours=1)
+
+    # The only agent sleeps after its first update
+    auctioneer = Auctioneer(id='Scheduler', batch_clearing=True)
+    ImbalanceAgent(auctioneer)
+    environment.register_auctioneer(auctioneer)
+
+    environment.checkpointer = Checkpointer(str(tmp_path), datetime.timedelta(minutes=15), environment)
+    ticks = []
+    end_tick = environment.end_tick
+    environment.end_tick = lambda: (ticks.append(environment.current_time), end_tick())
+    try:
+        assert run_event_driven(environment) == 1
+    finally:
+        del environment.end_tick
+        environment.checkpointer = None
+
+    assert len(ticks) == 61 and ticks[-1] == environment.stop_time
+    assert len([name for name in os.listdir(str(tmp_path)) if name.startswith('snapshot-')]) == 4
+
+
+def test_event_driven_run_cannot_be_sharded():
+    from environment import SimulationEnvironment
+
+    environment = SimulationEnvironment(processes=2, event_driven=True)
+    with pytest.raises(ValueError):
+        environment.start()
@@ -0,0 +1,27 @@
+from agents import LoadAgent
+from benchmark import create_scenario, run_scenario
+import pytest
+
+
+def test_sharded_run_matches_single_process_run():
+    _, prices, states = run_scenario(12, None, seed=4, hours=2)
+    _, sharded_prices, sharded_states = run_scenario(12, 3, seed=4, hours=2)
+
+    assert len(prices['price']) > 1
+    assert all((sharded_prices[k] == prices[k]).all() for k in prices)
+    assert sharded_states == states
+
+
+class FailingAgent(LoadAgent):
+
+    def handle_state_update(self):
+        raise ZeroDivisionError("Failing agent")
+
+
+def test_failing_worker_is_reported():
+    environment, auctioneer = create_scenario(9, hours=1)
+    FailingAgent(auctioneer, id='Failing') # Tenth agent, in the last of two workers
+    environment.processes = 2
+
+    with pytest.raises(RuntimeError, match='exited with code 1'):
+        environment.start()
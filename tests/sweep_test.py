@@ -0,0 +1,46 @@
+from sweep import expand_grid, run_sweep, run_variant
+import csv
+
+
+def read_rows(path):
+    with open(path, newline='') as f:
+        return list(csv.DictReader(f))
+
+
+def test_sweep_runs_variants_and_resumes(tmp_path):
+    path = str(tmp_path / 'results.csv')
+    grid = {'battery_capacity': [10, 0], 'seed': [1, 2], 'days': 0.25, 'load_agents': 3}
+    assert len(expand_grid(grid)) == 4
+
+    # A battery without capacity fails its variants, the others complete
+    assert run_sweep(grid, path, processes=2) == 2
+    rows = read_rows(path)
+    assert sorted(row['status'] for row in rows) == ['failed', 'failed', 'ok', 'ok']
+    assert all(row['error'] == 'ZeroDivisionError: float division by zero' for row in rows if row['status'] == 'failed')
+
+    completed = [row for row in rows if row['status'] == 'ok']
+    assert completed[0]['energy_traded'] != completed[1]['energy_traded']
+    assert all(float(row['energy_traded']) > 0 and 0 <= float(row['soc_p50']) <= 1 for row in completed)
+
+    # Only the failed variants run again
+    assert run_sweep(grid, path, processes=2) == 2
+    retried = read_rows(path)
+    assert len(retried) == 4 and sorted(row['status'] for row in retried) == ['failed', 'failed', 'ok', 'ok']
+    assert [row for row in retried if row['status'] == 'ok'] == [row for row in rows if row['status'] == 'ok']
+
+    # Results of a variant don't depend on the process it runs in
+    seed_1 = [row for row in completed if row['seed'] == '1'][0]
+    row = run_variant(expand_grid({'battery_capacity': 10, 'seed': 1, 'days': 0.25, 'load_agents': 3})[0])
+    assert row['variant'] == seed_1['variant'] and str(row['energy_traded']) == seed_1['energy_traded']
+
+
+def test_variant_leaves_default_context_alone():
+    import ext
+    import influx
+
+    environment = ext.environment
+    auctioneers = environment.auctioneers
+    sink = influx.sink
+    run_variant(expand_grid({'days': 0.05})[0])
+    assert ext.environment is environment and environment.auctioneers is auctioneers
+    assert influx.sink is sink